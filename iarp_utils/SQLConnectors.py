@@ -1,4 +1,15 @@
+import collections
+import contextlib
+import datetime
+import decimal
+import functools
+import itertools
+import os
 import sqlite3
+import tempfile
+import threading
+import time
+import warnings
 
 from .exceptions import ImproperlyConfigured
 
@@ -15,10 +26,18 @@ except ImportError:
         connector = None
 
 
+SQLCacheInfo = collections.namedtuple('SQLCacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
 class BaseDatabaseConnector:
 
     _param_signature = None
     port = None
+    insert_batch_size = 1000
+    # Most parameters a single statement may have.
+    max_query_params = 999
+    # How many generated statements are kept for reuse.
+    sql_cache_size = 256
 
     def __init__(self):
         self.hostname = ''
@@ -29,6 +48,10 @@ class BaseDatabaseConnector:
         self.connection = None
         self.cursor = None
 
+        self._sql_cache = collections.OrderedDict()
+        self.sql_cache_hits = 0
+        self.sql_cache_misses = 0
+
     @property
     def param_signature(self):
         if not self._param_signature:
@@ -63,12 +86,26 @@ class BaseDatabaseConnector:
     def close(self):
         self.connection.close()
 
+    def ping(self):
+        """ Whether the connection still works, checked with a cheap query. """
+        try:
+            self.cursor.execute('SELECT 1')
+            self.cursor.fetchall()
+            return True
+        except Exception:
+            return False
+
     def use_database(self, database):
         self.cursor.execute(f'USE {database}')
 
-    def insert_item(self, table, values):
+    def insert_item(self, table, values, batch_size=None):
         """ Insert items into the table supplied
 
+        Rows are grouped by the columns they contain. Each group's INSERT is
+        built once and sent batch_size rows at a time with executemany, so rows
+        may not be inserted in the order given. values can be a generator, at
+        most one batch per column group is held in memory.
+
         >>> self.insert_item('TABLE1', {'CONTACT': 'John Doe', 'COMPANY': 'Fred Flintstone'})
         >>> # OR for multiple inserts
         >>> data = [
@@ -76,34 +113,197 @@ class BaseDatabaseConnector:
         >>>     {'CONTACT': 'Ronald', 'LASTNAME': 'McDonald'},
         >>> ]
         >>> self.insert_item('TABLE1', data)
+        >>> self.insert_item('TABLE1', (row for row in csv.DictReader(fo)), batch_size=5000)
 
         Args:
             table: The table to insert into
-            values: A single-level dict OR a list of single level dict's
+            values: A single-level dict OR an iterable of single level dict's
+            batch_size: How many rows are sent at a time, default is insert_batch_size
 
         Returns:
             Integer counting number of items inserted.
         """
-        if not isinstance(values, list):
+        total_inserted = 0
+        for columns, batch in self._batches_by_columns(values, batch_size):
+            total_inserted += self._insert_many(table, columns, batch)
+
+        return total_inserted
+
+    def _batches_by_columns(self, values, batch_size=None):
+        """ Groups dict rows by their columns, yielding (columns, list of value tuples) every batch_size rows. """
+        if isinstance(values, dict):
             values = [values]
 
-        total_inserted = 0
+        batch_size = batch_size or self.insert_batch_size
+
+        batches = {}
         for row in values:
-            question_marks = ','.join(self.param_signature for _ in row.keys())
-            columns = ','.join(row.keys())
+            columns = tuple(row.keys())
+            batch = batches.setdefault(columns, [])
+            batch.append(tuple(row.values()))
+
+            if len(batch) >= batch_size:
+                yield columns, batch
+                batches[columns] = []
+
+        for columns, batch in batches.items():
+            if batch:
+                yield columns, batch
+
+    def _insert_many(self, table, columns, rows):
+        def build():
+            question_marks = ','.join(self.param_signature for _ in columns)
+            return f"INSERT INTO {table} ({','.join(columns)}) VALUES ({question_marks})"
+
+        cursor = self._execute_cached(('insert', table, columns), build, rows, many=True)
+
+        return self._rowcount(cursor, len(rows))
+
+    @staticmethod
+    def _rowcount(cursor, default):
+        """ The cursors rowcount, or default when the driver does not report it (-1). """
+        if cursor.rowcount is None or cursor.rowcount < 0:
+            return default
+        return cursor.rowcount
+
+    def _cached_sql(self, key, build):
+        """ The SQL for key, (operation, table, columns, ...), calling build() only when it is not cached. """
+        try:
+            query = self._sql_cache[key]
+        except KeyError:
+            self.sql_cache_misses += 1
+            query = self._sql_cache[key] = build()
+            if len(self._sql_cache) > self.sql_cache_size:
+                self._sql_cache.popitem(last=False)
+        else:
+            self.sql_cache_hits += 1
+            self._sql_cache.move_to_end(key)
+        return query
+
+    def _execute_cached(self, key, build, params, many=False):
+        """ Execute the cached SQL for key and return the cursor it ran on. """
+        query = self._cached_sql(key, build)
+        cursor = self._statement_cursor(query)
+        if many:
+            cursor.executemany(query, params)
+        else:
+            cursor.execute(query, params)
+        return cursor
+
+    def _statement_cursor(self, query):
+        """ Cursor to run query on, drivers with prepared statements can keep one per statement. """
+        return self.cursor
+
+    def sql_cache_info(self):
+        """ Hit and miss counts of the generated SQL cache, like functools.lru_cache's cache_info().
+
+        >>> self.sql_cache_info()
+        SQLCacheInfo(hits=4998, misses=2, maxsize=256, currsize=2)
+        """
+        return SQLCacheInfo(self.sql_cache_hits, self.sql_cache_misses, self.sql_cache_size, len(self._sql_cache))
 
-            query = f"INSERT INTO {table} ({columns}) VALUES ({question_marks})"
+    def sql_cache_clear(self):
+        self._sql_cache.clear()
+        self.sql_cache_hits = self.sql_cache_misses = 0
 
-            self.cursor.execute(query, list(row.values()))
+    @contextlib.contextmanager
+    def transaction(self):
+        """ Run the statements inside the with block in one transaction.
 
-            if self.cursor.rowcount > 0:
-                total_inserted += self.cursor.rowcount
+        Commits when the block finishes and rolls back if it raises. When a
+        transaction is already open the block simply becomes part of it.
 
-        return total_inserted
+        >>> with self.transaction():
+        >>>     self.delete_item('TABLE1', 'id', old_ids)
+        >>>     self.insert_item('TABLE1', new_rows)
+        """
+        if self._in_transaction():
+            yield self
+            return
+
+        self._begin_transaction()
+        try:
+            yield self
+            self.connection.commit()
+        except BaseException:
+            self.connection.rollback()
+            raise
+        finally:
+            self._end_transaction()
+
+    def iter_query(self, sql, params=None, batch_size=1000, as_dict=False):
+        """ Run a query and yield its rows, fetched batch_size rows at a time.
+
+        Only one batch is held in memory at a time so large tables can be
+        read in constant memory. The query runs on its own cursor so
+        self.cursor keeps its last result, but only SQLite can run other
+        statements while the rows are being read. MySQL and SQL Server
+        (without MARS) can not use the connection again until every row has
+        been read or the generator is closed, use a second connection, for
+        example from a ConnectionPool, to write while reading.
+
+        >>> for row in self.iter_query('SELECT id, name FROM TABLE1 WHERE active = ?', [1], as_dict=True):
+        >>>     print(row['name'])
+
+        Args:
+            sql: The query to run
+            params: Parameters for the query
+            batch_size: How many rows are fetched from the server at a time
+            as_dict: Yield each row as a dict of column: value
 
-    def update_item(self, table: str, where_field: str, record_ids: [str, list], values: dict):
+        Yields:
+            Each row as returned by the driver, or a dict when as_dict
+        """
+        cursor = self._query_cursor()
+        try:
+            cursor.execute(sql, params or ())
+            columns = [column[0] for column in cursor.description] if as_dict else None
+
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                if as_dict:
+                    rows = [dict(zip(columns, row)) for row in rows]
+                yield from rows
+                del rows
+        finally:
+            self._close_query_cursor(cursor, batch_size)
+
+    def _query_cursor(self):
+        return self.connection.cursor()
+
+    def _close_query_cursor(self, cursor, batch_size):
+        cursor.close()
+
+    def _in_transaction(self):
+        return getattr(self.connection, 'in_transaction', False)
+
+    def _begin_transaction(self):
+        self.cursor.execute('BEGIN')
+
+    def _end_transaction(self):
+        pass
+
+    def _record_id_chunks(self, record_ids, reserved_params=0):
+        """ Splits record_ids, without duplicates, into chunks that fit the backends parameter limit. """
+        if not isinstance(record_ids, (list, tuple, set)):
+            record_ids = [record_ids]
+        record_ids = list(dict.fromkeys(record_ids))
+
+        chunk_size = self.max_query_params - reserved_params
+        if chunk_size <= 0:
+            raise ValueError(f'{reserved_params} values leave no room for record ids within '
+                             f'max_query_params ({self.max_query_params}), update fewer columns at a time.')
+        for start in range(0, len(record_ids), chunk_size):
+            yield record_ids[start:start + chunk_size]
+
+    def update_item(self, table: str, where_field: str, record_ids: [str, list], values: dict, atomic=False):
         """ Update items in the database where matching record ids are found.
 
+        Record ids are matched with WHERE where_field IN (...), as many ids
+        per statement as max_query_params allows.
+
         >>> data = {'CONTACT': 'Fred Flintstone', 'COMPANY': 'Miners Associated'}
         >>> self.update_item('TABLE1', 'id', '34256', data)
         >>> # OR if you want to update multiple record ids with the same values
@@ -114,37 +314,40 @@ class BaseDatabaseConnector:
             where_field: What column contains record id?
             record_ids: The record id to match against
             values: A single-level dict containing column: value
+            atomic: Run every statement in one transaction, see transaction()
 
         Returns:
             Integer counting number of items updated.
-        """
-
-        joiner = f'={self.param_signature},'
-        query_base = f'{{}}={self.param_signature}'  # {}=?
-        query = query_base.format(joiner.join(values.keys()))
-        query = f"UPDATE {table} SET {query} WHERE {where_field} = {self.param_signature}"
 
-        if not isinstance(record_ids, list):
-            record_ids = [record_ids]
+        Raises:
+            ValueError: If values has max_query_params or more columns.
+        """
+        columns = tuple(values.keys())
+        items = list(values.values())
 
-        items = [v for k, v in values.items()]
+        def build(id_count):
+            query = ','.join(f'{column}={self.param_signature}' for column in columns)
+            question_marks = ','.join([self.param_signature] * id_count)
+            return f"UPDATE {table} SET {query} WHERE {where_field} IN ({question_marks})"
 
         total_updated = 0
-        for record_id in record_ids:
-            items_copied = items.copy()
-            items_copied.append(record_id)
+        with self.transaction() if atomic else contextlib.nullcontext():
+            for chunk in self._record_id_chunks(record_ids, reserved_params=len(items)):
+                cursor = self._execute_cached(('update', table, columns, where_field, len(chunk)),
+                                              functools.partial(build, len(chunk)), items + chunk)
 
-            self.cursor.execute(query, items_copied)
-
-            if self.cursor.rowcount > 0:
-                total_updated += self.cursor.rowcount
+                if cursor.rowcount > 0:
+                    total_updated += cursor.rowcount
 
         return total_updated
 
-    def delete_item(self, table: str, where_field: str, record_ids: [str, list]):
+    def delete_item(self, table: str, where_field: str, record_ids: [str, list], atomic=False):
         """
          Delete items from the database for specific record ids
 
+        Record ids are matched with WHERE where_field IN (...), as many ids
+        per statement as max_query_params allows.
+
         >>> self.delete_item('TABLE1', 'id', '34256')
         >>> # OR to delete multiples
         >>> self.delete_item('TABLE1', 'id', ['34256', '36574'])
@@ -153,22 +356,100 @@ class BaseDatabaseConnector:
             table: The table we're deleting from
             where_field: Supply the column to match the record_id value to
             record_ids: List or string containing the record id(s) to be deleted
+            atomic: Run every statement in one transaction, see transaction()
 
         Returns:
             Integer counting number of items deleted.
         """
-        if not isinstance(record_ids, list):
-            record_ids = [record_ids]
+        def build(id_count):
+            question_marks = ','.join([self.param_signature] * id_count)
+            return f'DELETE FROM {table} WHERE {where_field} IN ({question_marks})'
 
         total_deleted = 0
-        for record_id in record_ids:
-            self.cursor.execute(f'DELETE FROM {table} WHERE {where_field} = {self.param_signature}', (record_id,))
+        with self.transaction() if atomic else contextlib.nullcontext():
+            for chunk in self._record_id_chunks(record_ids):
+                cursor = self._execute_cached(('delete', table, (where_field,), len(chunk)),
+                                              functools.partial(build, len(chunk)), chunk)
 
-            if self.cursor.rowcount > 0:
-                total_deleted += self.cursor.rowcount
+                if cursor.rowcount > 0:
+                    total_deleted += cursor.rowcount
 
         return total_deleted
 
+    def upsert_items(self, table, key_columns, values, batch_size=None):
+        """ Insert rows, updating the existing row instead when one with the same key is already there.
+
+        Each backend uses its own single statement upsert, sent batch_size
+        rows at a time, rows are grouped by their columns like insert_item.
+        Every column of a row that is not a key column is updated.
+
+        >>> self.upsert_items('TABLE1', 'ID', [{'ID': 1, 'NAME': 'John Doe'}, {'ID': 2, 'NAME': 'Ronald'}])
+        >>> self.upsert_items('STOCK', ['STORE', 'SKU'], rows, batch_size=5000)
+
+        Args:
+            table: The table to upsert into
+            key_columns: Column or columns of a unique key or primary key identifying the row
+            values: A single-level dict OR an iterable of single level dict's, each containing the key columns
+            batch_size: How many rows are sent at a time, default is insert_batch_size
+
+        Returns:
+            Integer counting the rows upserted. Every row sent is counted, whether
+            it was inserted, updated or already there with nothing to update, so
+            the count is the same on every backend.
+        """
+        if isinstance(key_columns, str):
+            key_columns = (key_columns,)
+        key_columns = tuple(key_columns)
+
+        total_upserted = 0
+        for columns, batch in self._batches_by_columns(values, batch_size):
+            missing = [column for column in key_columns if column not in columns]
+            if missing:
+                raise ValueError(f'Rows upserted into {table} must contain the key columns, missing {missing}')
+            total_upserted += self._upsert_many(table, key_columns, columns, batch)
+
+        return total_upserted
+
+    def _upsert_many(self, table, key_columns, columns, rows):
+        raise NotImplementedError('_upsert_many must be implemented for upsert_items to be used')
+
+    @staticmethod
+    def _row_tuples(columns, rows):
+        for row in rows:
+            yield tuple(row[column] for column in columns) if isinstance(row, dict) else row
+
+    def bulk_load(self, table, rows, columns, batch_size=None):
+        """ Load a large number of rows into a table as fast as the backend allows.
+
+        rows is only iterated once and can be a generator, rows are never
+        all held in memory. Everything is loaded in one transaction, the
+        backends override this with their own fast paths.
+
+        >>> self.bulk_load('TABLE1', ((row['id'], row['name']) for row in csv.DictReader(fo)), ['ID', 'NAME'])
+
+        Args:
+            table: The table to load into
+            rows: Iterable of sequences in the same order as columns, or of dicts keyed by column
+            columns: The columns being loaded
+            batch_size: How many rows are sent at a time, default is insert_batch_size
+
+        Returns:
+            Integer counting number of rows loaded.
+        """
+        columns = tuple(columns)
+        rows = self._row_tuples(columns, rows)
+        batch_size = batch_size or self.insert_batch_size
+
+        total_loaded = 0
+        with self.transaction():
+            while True:
+                batch = list(itertools.islice(rows, batch_size))
+                if not batch:
+                    break
+                total_loaded += self._insert_many(table, columns, batch)
+
+        return total_loaded
+
     def truncate_table(self, table):
         """ Truncate a table in the database
 
@@ -182,6 +463,9 @@ class MSSQL(BaseDatabaseConnector):
 
     _param_signature = '?'
     port = 1433
+    # 2100 is the hard limit, pyodbc sends statements through sp_executesql which uses two of them.
+    max_query_params = 2098
+    fast_executemany = True
 
     def __init__(self):
         super().__init__()
@@ -200,18 +484,68 @@ class MSSQL(BaseDatabaseConnector):
             autocommit=kwargs.get('autocommit', True)
         )  # type: pyodbc.Connection
 
+    @contextlib.contextmanager
+    def _fast_executemany(self):
+        """ Binds executemany batches as parameter arrays instead of a round trip per row, for the with block only. """
+        previous = self.cursor.fast_executemany
+        self.cursor.fast_executemany = self.fast_executemany
+        try:
+            yield
+        finally:
+            self.cursor.fast_executemany = previous
+
+    def _insert_many(self, table, columns, rows):
+        with self._fast_executemany():
+            return super()._insert_many(table, columns, rows)
+
+    def _upsert_many(self, table, key_columns, columns, rows):
+        def build():
+            update_columns = [column for column in columns if column not in key_columns]
+            query = (
+                f"MERGE INTO {table} WITH (HOLDLOCK) AS target "
+                f"USING (VALUES ({','.join(self.param_signature for _ in columns)})) AS source ({','.join(columns)}) "
+                f"ON {' AND '.join(f'target.{column} = source.{column}' for column in key_columns)} "
+            )
+            if update_columns:
+                query += f"WHEN MATCHED THEN UPDATE SET {','.join(f'{c} = source.{c}' for c in update_columns)} "
+            return query + (
+                f"WHEN NOT MATCHED THEN INSERT ({','.join(columns)}) "
+                f"VALUES ({','.join(f'source.{column}' for column in columns)});"
+            )
+
+        with self._fast_executemany():
+            self._execute_cached(('upsert', table, columns, key_columns), build, rows, many=True)
+
+        # Matched rows without columns to update are not counted by MERGE, every row sent was upserted.
+        return len(rows)
+
+    def _in_transaction(self):
+        return not self.connection.autocommit
+
+    def _begin_transaction(self):
+        self.connection.autocommit = False
+
+    def _end_transaction(self):
+        self.connection.autocommit = True
+
 
 class MySQL(BaseDatabaseConnector):
 
     _param_signature = '%s'
     port = 3306
+    max_query_params = 65535
+    # Run insert_item, update_item and delete_item as server side prepared statements.
+    prepared_statements = False
 
     def __init__(self):
         super().__init__()
         if mysql.connector is None:
             raise ImportError('mysql.connector required for MySQLServer')
 
+        self._prepared_cursors = collections.OrderedDict()
+
     def _connect(self, **kwargs):
+        self.prepared_statements = kwargs.get('prepared_statements', self.prepared_statements)
         return mysql.connector.connect(
             host=self.hostname,
             user=self.username,
@@ -219,15 +553,149 @@ class MySQL(BaseDatabaseConnector):
             port=self.port,
             buffered=kwargs.get('buffered', False),
             autocommit=kwargs.get('autocommit', True),
-            raw=kwargs.get('raw', False)
+            raw=kwargs.get('raw', False),
+            allow_local_infile=kwargs.get('allow_local_infile', False)
         )
 
+    def _rows_per_statement(self, columns, rows):
+        """ Splits rows so a multi-row VALUES statement stays within max_query_params placeholders. """
+        size = max(1, self.max_query_params // len(columns))
+        for start in range(0, len(rows), size):
+            yield rows[start:start + size]
+
+    def _insert_many(self, table, columns, rows):
+        # One INSERT ... VALUES (...),(...) statement per batch, or per max_query_params for wide tables.
+        def build(row_count):
+            question_marks = '(' + ','.join(self.param_signature for _ in columns) + ')'
+            return f"INSERT INTO {table} ({','.join(columns)}) VALUES {','.join([question_marks] * row_count)}"
+
+        total_inserted = 0
+        for chunk in self._rows_per_statement(columns, rows):
+            cursor = self._execute_cached(
+                ('insert', table, columns, len(chunk)), functools.partial(build, len(chunk)),
+                [value for row in chunk for value in row]
+            )
+            total_inserted += self._rowcount(cursor, len(chunk))
+
+        return total_inserted
+
+    def _upsert_many(self, table, key_columns, columns, rows):
+        def build(row_count):
+            # Updating a key column to itself leaves the row alone when there is nothing else to update.
+            update_columns = [column for column in columns if column not in key_columns] or key_columns[:1]
+            question_marks = '(' + ','.join(self.param_signature for _ in columns) + ')'
+            return (
+                f"INSERT INTO {table} ({','.join(columns)}) VALUES {','.join([question_marks] * row_count)} "
+                f"ON DUPLICATE KEY UPDATE {','.join(f'{column}=VALUES({column})' for column in update_columns)}"
+            )
+
+        for chunk in self._rows_per_statement(columns, rows):
+            self._execute_cached(
+                ('upsert', table, columns, key_columns, len(chunk)), functools.partial(build, len(chunk)),
+                [value for row in chunk for value in row]
+            )
+
+        # rowcount counts updated rows twice and unchanged rows not at all, every row sent was upserted.
+        return len(rows)
+
+    def _statement_cursor(self, query):
+        if not self.prepared_statements:
+            return self.cursor
+
+        # A prepared cursor keeps the statement it last prepared, one cursor per
+        # statement means repeated statements are never prepared again.
+        try:
+            self._prepared_cursors.move_to_end(query)
+        except KeyError:
+            self._prepared_cursors[query] = self.connection.cursor(prepared=True)
+            if len(self._prepared_cursors) > self.sql_cache_size:
+                self._prepared_cursors.popitem(last=False)[1].close()
+        return self._prepared_cursors[query]
+
+    def close(self):
+        for cursor in self._prepared_cursors.values():
+            cursor.close()
+        self._prepared_cursors.clear()
+        super().close()
+
+    def _begin_transaction(self):
+        self.connection.start_transaction()
+
+    def _query_cursor(self):
+        # Unbuffered, rows stay on the server until fetchmany asks for them.
+        return self.connection.cursor(buffered=False)
+
+    def _close_query_cursor(self, cursor, batch_size):
+        if self.connection.unread_result:
+            # Stopped early, the rest of the result has to be read off the connection before it can be used
+            # again. Read it a batch at a time so it is never all in memory at once.
+            while cursor.fetchmany(batch_size):
+                pass
+        cursor.close()
+
+    @staticmethod
+    def _load_data_field(value):
+        # Read back with FIELDS ENCLOSED BY '"' ESCAPED BY '', where an unquoted NULL is NULL.
+        if value is None:
+            return 'NULL'
+        if isinstance(value, bool):
+            return str(int(value))
+        if isinstance(value, (int, float, decimal.Decimal)):
+            return str(value)
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat(sep=' ')
+        if isinstance(value, (bytes, bytearray)):
+            # The file is loaded as utf8mb4 text, binary that is not utf-8 can not go through it.
+            try:
+                value = value.decode('utf-8')
+            except UnicodeDecodeError as e:
+                raise ValueError(f'bulk_load can only load utf-8 bytes, use insert_item for binary data: {e}')
+        return '"' + str(value).replace('"', '""') + '"'
+
+    def bulk_load(self, table, rows, columns, batch_size=None):
+        """ Streams rows to a temporary CSV file and loads it with LOAD DATA LOCAL INFILE.
+
+        Needs local_infile enabled on the server and connect(allow_local_infile=True),
+        batch_size is not used. bytes values are loaded as utf-8 text, ValueError
+        is raised for bytes that are not valid utf-8.
+        """
+        columns = tuple(columns)
+
+        fo = tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='', suffix='.csv', delete=False)
+        try:
+            with fo:
+                for row in self._row_tuples(columns, rows):
+                    fo.write(','.join(self._load_data_field(value) for value in row))
+                    fo.write('\n')
+
+            self.cursor.execute(
+                f"LOAD DATA LOCAL INFILE %s INTO TABLE {table} CHARACTER SET utf8mb4 "
+                "FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' ESCAPED BY '' "
+                f"LINES TERMINATED BY '\\n' ({','.join(columns)})",
+                (fo.name,)
+            )
+            return self.cursor.rowcount
+        finally:
+            os.remove(fo.name)
+
+    def ping(self):
+        # Goes around the cursor, which may still hold an unread result.
+        try:
+            self.connection.ping()
+            return True
+        except Exception:
+            return False
+
 
 class SQLITE(BaseDatabaseConnector):
 
     _param_signature = '?'
+    # SQLITE_MAX_VARIABLE_NUMBER before SQLite 3.32
+    max_query_params = 999
 
     def _connect(self, **kwargs):
+        # sqlite3 keeps statements prepared per SQL string, the SQL cache hands it the same strings.
+        kwargs.setdefault('cached_statements', self.sql_cache_size)
         return sqlite3.connect(self.database, **kwargs)  # type: sqlite3.Connection
 
     def use_database(self, database):
@@ -236,3 +704,238 @@ class SQLITE(BaseDatabaseConnector):
     def truncate_table(self, table):
         self.cursor.execute(f'DELETE FROM {table} WHERE 1=1')
         self.cursor.execute('VACUUM')
+
+    def _upsert_many(self, table, key_columns, columns, rows):
+        def build():
+            update_columns = [column for column in columns if column not in key_columns]
+            action = 'NOTHING'
+            if update_columns:
+                action = 'UPDATE SET ' + ','.join(f'{column}=excluded.{column}' for column in update_columns)
+            return (
+                f"INSERT INTO {table} ({','.join(columns)}) VALUES ({','.join('?' for _ in columns)}) "
+                f"ON CONFLICT ({','.join(key_columns)}) DO {action}"
+            )
+
+        self._execute_cached(('upsert', table, columns, key_columns), build, rows, many=True)
+
+        # DO NOTHING rows are not counted in rowcount, every row sent was upserted.
+        return len(rows)
+
+    def bulk_load(self, table, rows, columns, batch_size=None):
+        """ Loads every row with a single executemany over the rows, in one transaction.
+
+        The journal is switched to WAL and synchronous to OFF for the load and
+        both are set back afterwards, batch_size is not used. WAL is stored in
+        the database file and can only be left while no other connection has
+        the database open, a RuntimeWarning is raised when it could not be.
+        """
+        columns = tuple(columns)
+
+        # The journal mode can not change inside a transaction, loading into an open one keeps the settings.
+        pragmas = {}
+        if not self._in_transaction():
+            for pragma, value in [('journal_mode', 'WAL'), ('synchronous', 'OFF')]:
+                pragmas[pragma] = self.cursor.execute(f'PRAGMA {pragma}').fetchone()[0]
+                self.cursor.execute(f'PRAGMA {pragma}={value}')
+        try:
+            with self.transaction():
+                query = self._cached_sql(
+                    ('insert', table, columns),
+                    lambda: f"INSERT INTO {table} ({','.join(columns)}) VALUES ({','.join('?' for _ in columns)})"
+                )
+                self.cursor.executemany(query, self._row_tuples(columns, rows))
+                return self.cursor.rowcount
+        finally:
+            for pragma, value in reversed(pragmas.items()):
+                try:
+                    result = self.cursor.execute(f'PRAGMA {pragma}={value}').fetchone()
+                except sqlite3.OperationalError as e:
+                    result = (e,)
+                # Only journal_mode returns a row, the mode the database ended up in.
+                if result is not None and str(result[0]).lower() != str(value).lower():
+                    warnings.warn(f'bulk_load could not restore PRAGMA {pragma}={value}, it is {result[0]}',
+                                  RuntimeWarning)
+
+
+class ConnectionPool:
+    """ Thread safe pool of connectors for one database.
+
+    Every connection handed out is its own connector instance with its own
+    connection and cursor, so threads never share a cursor. Idle connections
+    are checked with ping() before they are handed out again and replaced
+    once they are older than max_age. An open transaction is rolled back
+    when a connection comes back to the pool.
+
+    >>> pool = ConnectionPool(MSSQL, max_size=8, hostname='sql01', database='sales', username='u', password='p')
+    >>> with pool.connection() as db:
+    >>>     db.insert_item('TABLE1', rows)
+    >>> pool.stats()
+    {'size': 1, 'idle': 1, 'in_use': 0, 'checkouts': 1, 'created': 1, 'recycled': 0, 'failed_pings': 0, ...}
+
+    SQLITE connections are only usable from the thread that made them unless
+    check_same_thread=False is passed, and every :memory: connection is a
+    separate empty database.
+
+    Args:
+        connector_class: MSSQL, MySQL, SQLITE or another BaseDatabaseConnector subclass
+        max_size: Most connections open at once
+        max_age: Seconds a connection is reused for before it is replaced, None keeps them forever
+        timeout: Seconds to wait for a free connection before raising TimeoutError, None waits forever
+        ping: Check idle connections with ping() before handing them out
+        **connect_kwargs: Passed to connector.connect()
+    """
+
+    def __init__(self, connector_class, max_size=5, max_age=3600, timeout=30, ping=True, **connect_kwargs):
+        self.connector_class = connector_class
+        self.max_size = max_size
+        self.max_age = max_age
+        self.timeout = timeout
+        self.ping = ping
+        self.connect_kwargs = connect_kwargs
+
+        self._condition = threading.Condition()
+        self._idle = collections.deque()
+        self._created_at = {}
+        self._size = 0
+        self._closed = False
+
+        self.checkouts = 0
+        self.created = 0
+        self.recycled = 0
+        self.failed_pings = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """ Check out a connector for the with block and return it to the pool afterwards. """
+        connector = self.acquire()
+        try:
+            yield connector
+        finally:
+            self.release(connector)
+
+    def acquire(self):
+        """ Check out a connector, wait for one if max_size are in use. Give it back with release(). """
+        started = time.monotonic()
+        deadline = None if self.timeout is None else started + self.timeout
+
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise ValueError('ConnectionPool is closed.')
+                if self._idle:
+                    connector = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    connector = None
+                    self._size += 1
+                    break
+
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self.timeouts += 1
+                    raise TimeoutError(f'No connection became free within {self.timeout} seconds.')
+                self._condition.wait(remaining)
+
+            waited = time.monotonic() - started
+            self.checkouts += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+
+        try:
+            return self._validate(connector) or self._create()
+        except BaseException:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+    def _validate(self, connector):
+        """ Returns connector when it can be reused, otherwise closes it and returns None. """
+        if connector is None:
+            return None
+
+        if self.max_age is not None and time.monotonic() - self._created_at[connector] > self.max_age:
+            with self._condition:
+                self.recycled += 1
+        elif self.ping and not connector.ping():
+            with self._condition:
+                self.failed_pings += 1
+        else:
+            return connector
+
+        self._discard(connector)
+        return None
+
+    def _create(self):
+        connector = self.connector_class()
+        connector.connect(**self.connect_kwargs)
+        with self._condition:
+            self.created += 1
+            self._created_at[connector] = time.monotonic()
+        return connector
+
+    def _discard(self, connector):
+        with self._condition:
+            self._created_at.pop(connector, None)
+        try:
+            connector.close()
+        except Exception:
+            pass
+
+    def release(self, connector):
+        """ Give a connector from acquire() back to the pool. """
+        discard = False
+        try:
+            if connector._in_transaction():
+                connector.connection.rollback()
+        except Exception:
+            discard = True
+
+        with self._condition:
+            discard = discard or self._closed
+            if discard:
+                self._size -= 1
+            else:
+                self._idle.append(connector)
+            self._condition.notify()
+
+        if discard:
+            self._discard(connector)
+
+    def close(self):
+        """ Close idle connections, connections still in use are closed when released. """
+        with self._condition:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._condition.notify_all()
+
+        for connector in idle:
+            self._discard(connector)
+
+    def stats(self):
+        """ Pool size and checkout metrics, wait times are in seconds. """
+        with self._condition:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'checkouts': self.checkouts,
+                'created': self.created,
+                'recycled': self.recycled,
+                'failed_pings': self.failed_pings,
+                'timeouts': self.timeouts,
+                'wait_time': self.wait_time,
+                'max_wait_time': self.max_wait_time,
+                'average_wait_time': self.wait_time / self.checkouts if self.checkouts else 0.0,
+            }
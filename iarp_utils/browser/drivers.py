@@ -10,7 +10,8 @@ import zipfile
 
 from ..exceptions import ImproperlyConfigured
 from ..files import (
-    download_file,
+    FileLock,
+    download_many,
     extract_tar_single_file,
     extract_zip_single_file,
     get_mime_types_as_str,
@@ -40,31 +41,44 @@ except ImportError:
 log = logging.getLogger('iarp_utils.browser.drivers')
 
 
-def download_and_extract_zip_file(url, local_zip_file, extracting_file, **kwargs):
+def download_and_extract_zip_file(url, local_zip_file, extracting_file, lock_timeout=300, **kwargs):
+
+    # Workers updating the same driver at the same time would overwrite each
+    # others download, hold the lock on the zip until it has been extracted.
+    with FileLock(local_zip_file, timeout=lock_timeout) as lock:
+        if lock.wait_time:
+            log.debug(f'waited {lock.wait_time:.3f} seconds for the lock on {local_zip_file}')
+
+        # download_many retries connection errors and 5xx responses with
+        # backoff, and reports a failed download instead of saving the error
+        # page over the archive.
+        result = download_many({url: local_zip_file}, max_workers=1)[local_zip_file]
+        if not result.success:
+            raise ValueError(f'Failed to download {url} to {local_zip_file}: {result.error}')
+        log.debug(f'downloaded {result.size} bytes from {url} in {result.elapsed:.3f} seconds '
+                  f'after {result.attempts} attempt(s)')
+
+        if zipfile.is_zipfile(local_zip_file):
+
+            extract_zip_single_file(
+                zip_file=local_zip_file,
+                file_to_extract=extracting_file,
+                folder_to_extract_to=settings.EXECUTABLE_ROOT,
+                log=log,
+                **kwargs
+            )
+
+        elif tarfile.is_tarfile(local_zip_file):
+            extract_tar_single_file(
+                tar_file=local_zip_file,
+                file_to_extract=extracting_file,
+                folder_to_extract_to=settings.EXECUTABLE_ROOT,
+                log=log,
+                **kwargs
+            )
 
-    download_file(url=url, path_to_file=local_zip_file)
-
-    if zipfile.is_zipfile(local_zip_file):
-
-        extract_zip_single_file(
-            zip_file=local_zip_file,
-            file_to_extract=extracting_file,
-            folder_to_extract_to=settings.EXECUTABLE_ROOT,
-            log=log,
-            **kwargs
-        )
-
-    elif tarfile.is_tarfile(local_zip_file):
-        extract_tar_single_file(
-            tar_file=local_zip_file,
-            file_to_extract=extracting_file,
-            folder_to_extract_to=settings.EXECUTABLE_ROOT,
-            log=log,
-            **kwargs
-        )
-
-    else:
-        raise ValueError(f'File {local_zip_file} is not compatible with zipfile or tarfile libraries.')
+        else:
+            raise ValueError(f'File {local_zip_file} is not compatible with zipfile or tarfile libraries.')
 
 
 class DriverBase:
@@ -1,8 +1,24 @@
+import array
+import asyncio
+import calendar
+import collections
+import concurrent.futures
 import datetime
+import functools
+import logging
 import random
 import re
 
 from .datetimes import weekday
+from .pidfile import PIDFile
+
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger('iarp_utils.crontabs')
 
 
 class ParseException(Exception):
@@ -63,14 +79,20 @@ class CrontabParser:
     _steps = r'/(\w+)?'
     _star = r'\*'
 
+    # Compiled once at import, every parser instance shares them.
+    _range_steps_re = re.compile(_range + _steps)
+    _range_re = re.compile(_range)
+    _star_steps_re = re.compile(_star + _steps)
+    _star_re = re.compile('^' + _star + '$')
+
     def __init__(self, max_=60, min_=0):
         self.max_ = max_
         self.min_ = min_
         self.pats = (
-            (re.compile(self._range + self._steps), self._range_steps),
-            (re.compile(self._range), self._expand_range),
-            (re.compile(self._star + self._steps), self._star_steps),
-            (re.compile('^' + self._star + '$'), self._expand_star),
+            (self._range_steps_re, self._range_steps),
+            (self._range_re, self._expand_range),
+            (self._star_steps_re, self._star_steps),
+            (self._star_re, self._expand_star),
         )
 
     def parse(self, spec):
@@ -162,55 +184,417 @@ def isoweekday_sunday_zero(isoweekday):
     return 0 if isoweekday == 7 else isoweekday
 
 
-def is_active_now(crontab, now):
-    minutes, hours, days_of_month, months_of_year, day_of_week = parse(crontab)
+def _to_bitmask(values):
+    mask = 0
+    for value in values:
+        mask |= 1 << value
+    return mask
+
+
+def _next_bit(mask, value):
+    """ Lowest set bit in mask that is >= value, None if there isn't one. """
+    if value < 0:
+        value = 0
+    mask = mask >> value << value
+    if not mask:
+        return None
+    return (mask & -mask).bit_length() - 1
+
 
-    # print(f"{minutes=}")
-    # print(f"{hours=}")
-    # print(f"{days_of_month=}")
-    # print(f"{months_of_year=}")
-    # print(f"{day_of_week=}")
+def _previous_bit(mask, value):
+    """ Highest set bit in mask that is <= value, None if there isn't one. """
+    if value < 0:
+        return None
+    mask &= (2 << value) - 1
+    if not mask:
+        return None
+    return mask.bit_length() - 1
+
+
+class CompiledCrontab:
+    """ A crontab expression parsed once and stored as one bitmask per field.
+
+    Use :func:`compile_crontab` to get a cached instance instead of building
+    these directly, repeated expressions then share the same object.
+
+    Matching follows :func:`is_active_now`: every field must match, including
+    both day of month and day of week, and seconds are ignored.
+
+    Examples:
+
+        >>> crontab = compile_crontab('30 8 * * 1-5')
+        >>> crontab.matches(datetime.datetime(2023, 6, 19, 8, 30))
+        True
+        >>> crontab.next_after(datetime.datetime(2023, 6, 19, 8, 30))
+        datetime.datetime(2023, 6, 20, 8, 30)
+        >>> crontab.previous_before(datetime.datetime(2023, 6, 19, 8, 30))
+        datetime.datetime(2023, 6, 16, 8, 30)
+    """
 
+    # Day of month and day of week combinations repeat every 400 years,
+    # if nothing matched within that span it never will.
+    SEARCH_YEARS = 400
+
+    def __init__(self, crontab):
+        self.crontab = crontab
+        self.minutes, self.hours, self.days_of_month, self.months_of_year, self.day_of_week = parse(crontab)
+
+        self.minute_mask = _to_bitmask(self.minutes)
+        self.hour_mask = _to_bitmask(self.hours)
+        self.day_of_month_mask = _to_bitmask(self.days_of_month)
+        self.month_mask = _to_bitmask(self.months_of_year)
+        self.day_of_week_mask = _to_bitmask(self.day_of_week)
+
+        # Every (hour, minute) the crontab fires at on a matching day, in order.
+        self.times_of_day = tuple(
+            (hour, minute) for hour in sorted(self.hours) for minute in sorted(self.minutes)
+        )
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.crontab!r}>'
+
+    def matches(self, dt):
+        """ Whether or not the crontab fires in the minute dt falls in. """
+        return bool(
+            self.minute_mask >> dt.minute & 1
+            and self.hour_mask >> dt.hour & 1
+            and self.day_of_month_mask >> dt.day & 1
+            and self.day_of_week_mask >> isoweekday_sunday_zero(dt.isoweekday()) & 1
+            and self.month_mask >> dt.month & 1
+        )
+
+    def _day_matches(self, day, first_weekday):
+        if not self.day_of_month_mask >> day & 1:
+            return False
+        # calendar weekdays are Monday = 0, crontab needs Sunday = 0
+        return bool(self.day_of_week_mask >> ((first_weekday + day) % 7) & 1)
+
+    def _next_day(self, year, month, day):
+        first_weekday, days_in_month = calendar.monthrange(year, month)
+        day = _next_bit(self.day_of_month_mask, day)
+        while day is not None and day <= days_in_month:
+            if self._day_matches(day, first_weekday):
+                return day
+            day = _next_bit(self.day_of_month_mask, day + 1)
+        return None
+
+    def _previous_day(self, year, month, day):
+        first_weekday, days_in_month = calendar.monthrange(year, month)
+        day = _previous_bit(self.day_of_month_mask, min(day, days_in_month))
+        while day is not None:
+            if self._day_matches(day, first_weekday):
+                return day
+            day = _previous_bit(self.day_of_month_mask, day - 1)
+        return None
+
+    def next_after(self, dt):
+        """ Returns the first datetime strictly after dt that the crontab fires on.
+
+        Each field is advanced to its next allowed value, resetting the smaller
+        fields whenever a larger one moves, so no minutes are stepped through.
+
+        Args:
+            dt: datetime to search from, tzinfo is carried over to the result.
+
+        Returns:
+            datetime or None if the crontab can never fire.
+        """
+        dt = dt.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        year, month, day, hour, minute = dt.year, dt.month, dt.day, dt.hour, dt.minute
+        last_year = min(dt.year + self.SEARCH_YEARS, datetime.MAXYEAR)
+
+        while year <= last_year:
+            next_month = _next_bit(self.month_mask, month)
+            if next_month is None:
+                year, month, day, hour, minute = year + 1, 1, 1, 0, 0
+                continue
+            if next_month != month:
+                month, day, hour, minute = next_month, 1, 0, 0
+
+            next_day = self._next_day(year, month, day)
+            if next_day is None:
+                month, day, hour, minute = month + 1, 1, 0, 0
+                continue
+            if next_day != day:
+                day, hour, minute = next_day, 0, 0
+
+            next_hour = _next_bit(self.hour_mask, hour)
+            if next_hour is None:
+                day, hour, minute = day + 1, 0, 0
+                continue
+            if next_hour != hour:
+                hour, minute = next_hour, 0
+
+            next_minute = _next_bit(self.minute_mask, minute)
+            if next_minute is None:
+                hour, minute = hour + 1, 0
+                continue
+
+            return datetime.datetime(year, month, day, hour, next_minute, tzinfo=dt.tzinfo)
+
+        return None
+
+    def previous_before(self, dt):
+        """ Returns the last datetime strictly before dt that the crontab fired on.
+
+        Args:
+            dt: datetime to search from, tzinfo is carried over to the result.
+
+        Returns:
+            datetime or None if the crontab can never fire.
+        """
+        truncated = dt.replace(second=0, microsecond=0)
+        if truncated == dt:
+            truncated -= datetime.timedelta(minutes=1)
+        dt = truncated
+        year, month, day, hour, minute = dt.year, dt.month, dt.day, dt.hour, dt.minute
+        first_year = max(dt.year - self.SEARCH_YEARS, datetime.MINYEAR)
+
+        while year >= first_year:
+            previous_month = _previous_bit(self.month_mask, month)
+            if previous_month is None:
+                year, month, day, hour, minute = year - 1, 12, 31, 23, 59
+                continue
+            if previous_month != month:
+                month, day, hour, minute = previous_month, 31, 23, 59
+
+            previous_day = self._previous_day(year, month, day)
+            if previous_day is None:
+                month, day, hour, minute = month - 1, 31, 23, 59
+                continue
+            if previous_day != day:
+                day, hour, minute = previous_day, 23, 59
+
+            previous_hour = _previous_bit(self.hour_mask, hour)
+            if previous_hour is None:
+                day, hour, minute = day - 1, 23, 59
+                continue
+            if previous_hour != hour:
+                hour, minute = previous_hour, 59
+
+            previous_minute = _previous_bit(self.minute_mask, minute)
+            if previous_minute is None:
+                hour, minute = hour - 1, 59
+                continue
+
+            return datetime.datetime(year, month, day, hour, previous_minute, tzinfo=dt.tzinfo)
+
+        return None
+
+    def iter_between(self, start, end):
+        """ Yields every datetime in [start, end) the crontab fires on, in order.
+
+        Matching days are found per month from the day bitmasks and each one
+        expands to the precomputed times_of_day, so months and days that can't
+        match are skipped entirely rather than stepped through.
+
+        Args:
+            start: datetime to start at, included if the crontab fires on it.
+            end: datetime to stop at, never included in the results.
+
+        Yields:
+            datetimes, tzinfo is carried over from start.
+        """
+        first = start.replace(second=0, microsecond=0)
+        if first < start:
+            first += datetime.timedelta(minutes=1)
+
+        year, month, day = first.year, first.month, first.day
+        while (year, month) <= (end.year, end.month):
+
+            if self.month_mask >> month & 1:
+                day = self._next_day(year, month, day)
+                while day is not None:
+                    midnight = datetime.datetime(year, month, day, tzinfo=first.tzinfo)
+                    if midnight >= end:
+                        return
+
+                    for hour, minute in self.times_of_day:
+                        timestamp = midnight.replace(hour=hour, minute=minute)
+                        if timestamp < first:
+                            continue
+                        if timestamp >= end:
+                            return
+                        yield timestamp
+
+                    day = self._next_day(year, month, day + 1)
+
+            year, month, day = (year + 1, 1, 1) if month == 12 else (year, month + 1, 1)
+
+
+@functools.lru_cache(maxsize=8192)
+def compile_crontab(crontab):
+    """ Returns a cached :class:`CompiledCrontab` for the crontab string supplied.
+
+    >>> compile_crontab('*/10 * * * *') is compile_crontab('*/10 * * * *')
+    True
+    """
+    return CompiledCrontab(crontab)
+
+
+def is_active_now(crontab, now):
     # minute calculation only works if this task runs and
     # completes within the minute it's expected to run.
     #   If it falls outside the expected minute, then the
     #   channel will not get scanned.
-    if now.minute not in minutes:
-        return
-    if now.hour not in hours:
-        return
-    if now.day not in days_of_month:
-        return
-
-    # weekday and isoweekday returns variations of 1-7, crontab needs 0-6
-    if isoweekday_sunday_zero(now.isoweekday()) not in day_of_week:
-        return
-    if now.month not in months_of_year:
-        return
+    if compile_crontab(crontab).matches(now):
+        return True
 
-    return True
+
+def iter_schedule(crontab, start, end):
+    """ Yields every datetime in [start, end) that the crontab fires on.
+
+        >>> start = datetime.datetime(2023, 6, 19)
+        >>> end = datetime.datetime(2023, 6, 21)
+        >>> for dt in iter_schedule('30 8 * * 1-5', start, end):
+        ...     print(dt)
+        2023-06-19 08:30:00
+        2023-06-20 08:30:00
+
+    Args:
+        crontab: crontab string '* * * * *'
+        start: datetime to start at, included if the crontab fires on it
+        end: datetime to end at, this datetime is not included in the results
+
+    Yields:
+        datetimes the crontab fires on
+    """
+    return compile_crontab(crontab).iter_between(start, end)
 
 
 def calculate_schedule(crontab, check_month=False, period=10, now=None):
+    """ Returns the datetimes in the day (or month) of now that the crontab fires on.
+
+    Only datetimes falling on a period minute step from midnight are returned,
+    use :func:`iter_schedule` to get every firing.
+
+    Args:
+        crontab: crontab string '* * * * *'
+        check_month: Calculate for the whole month instead of the day
+        period: Minute steps from midnight that are considered
+        now: datetime within the day or month to calculate, default is now
+
+    Returns:
+        list of datetimes
+    """
     if not now:
         now = datetime.datetime.now()
     now = now.replace(hour=0, minute=0, second=0, microsecond=0)
     if check_month:
         now = now.replace(day=1)
-    matched_timestamps = []
-    start_day = now.day
-    start_month = now.month
-    while True:
-        if is_active_now(crontab, now):
-            matched_timestamps.append(now)
+        end = (now + datetime.timedelta(days=32)).replace(day=1)
+    else:
+        end = now + datetime.timedelta(days=1)
 
-        now = now + datetime.timedelta(minutes=period)
-        if not check_month and now.day != start_day:
-            break
-        elif check_month and now.month != start_month:
-            break
+    return [
+        timestamp for timestamp in iter_schedule(crontab, now, end)
+        if (timestamp - now) // datetime.timedelta(minutes=1) % period == 0
+    ]
+
+
+class CrontabIndex:
+    """ Answers which of many crontabs fire at a given datetime.
+
+    Identical crontab strings are stored once, each of their five fields is
+    added to an inverted index of value -> crontabs so a lookup is the
+    intersection of five precomputed sets instead of a loop over every crontab.
+
+    Examples:
+
+        >>> index = CrontabIndex([('backup', '0 2 * * *'), ('report', '30 8 * * 1-5')])
+        >>> index.add('cleanup', '0 2 * * *')
+        >>> index.active_at(datetime.datetime(2023, 6, 19, 2, 0))
+        {'backup', 'cleanup'}
+        >>> index.remove('backup')
+        >>> index.active_at(datetime.datetime(2023, 6, 19, 2, 0))
+        {'cleanup'}
+
+    Args:
+        items: dict or iterable of (key, crontab) pairs to start with
+    """
 
-    return matched_timestamps
+    def __init__(self, items=None):
+        self._crontab_by_key = {}
+        self._keys_by_crontab = {}
+
+        # minute, hour, day of month, month, day of week
+        self._fields = tuple(collections.defaultdict(set) for _ in range(5))
+
+        if isinstance(items, dict):
+            items = items.items()
+        for key, crontab in items or ():
+            self.add(key, crontab)
+
+    def __len__(self):
+        return len(self._crontab_by_key)
+
+    def __contains__(self, key):
+        return key in self._crontab_by_key
+
+    def get(self, key, default=None):
+        return self._crontab_by_key.get(key, default)
+
+    def add(self, key, crontab):
+        """ Add or replace the crontab for key, an invalid crontab leaves the index unchanged. """
+        field_values = self._field_values(crontab)
+
+        if key in self._crontab_by_key:
+            self.remove(key)
+
+        keys = self._keys_by_crontab.get(crontab)
+        if keys is None:
+            for field, values in zip(self._fields, field_values):
+                for value in values:
+                    field[value].add(crontab)
+            keys = self._keys_by_crontab[crontab] = set()
+
+        keys.add(key)
+        self._crontab_by_key[key] = crontab
+
+    def remove(self, key):
+        """ Remove key from the index, raises KeyError if it was never added. """
+        crontab = self._crontab_by_key.pop(key)
+
+        keys = self._keys_by_crontab[crontab]
+        keys.discard(key)
+        if keys:
+            return
+
+        # Last key using this crontab, drop it from the field indexes.
+        del self._keys_by_crontab[crontab]
+        for field, values in zip(self._fields, self._field_values(crontab)):
+            for value in values:
+                field[value].discard(crontab)
+                if not field[value]:
+                    del field[value]
+
+    @staticmethod
+    def _field_values(crontab):
+        compiled = compile_crontab(crontab)
+        return (compiled.minutes, compiled.hours, compiled.days_of_month,
+                compiled.months_of_year, compiled.day_of_week)
+
+    def active_crontabs_at(self, dt):
+        """ Returns the set of distinct crontab strings firing in the minute of dt. """
+        values = (dt.minute, dt.hour, dt.day, dt.month, isoweekday_sunday_zero(dt.isoweekday()))
+
+        candidates = []
+        for field, value in zip(self._fields, values):
+            crontabs = field.get(value)
+            if not crontabs:
+                return set()
+            candidates.append(crontabs)
+
+        candidates.sort(key=len)
+        return candidates[0].intersection(*candidates[1:])
+
+    def active_at(self, dt):
+        """ Returns the set of keys whose crontab fires in the minute of dt. """
+        return {
+            key
+            for crontab in self.active_crontabs_at(dt)
+            for key in self._keys_by_crontab[crontab]
+        }
 
 
 def validate_crontab_values(minute=None, hour=None, day_of_week=None, day_of_month=None):
@@ -412,3 +796,497 @@ def generate_selection_daily_crontabs(length=22, minute=0, hour=16, increment_mi
             hour += increment_hour
 
     return vals
+
+
+class CrontabSlotAllocator:
+    """ Places new crontabs into the least loaded slots instead of random ones.
+
+    Occupancy is measured as firings per minute over a reference window,
+    February 2021 by default since it is exactly four weeks starting on a
+    Monday and covers days 1-28 once. The month field is ignored while
+    measuring so biyearly and yearly crontabs count as monthly ones, their
+    months are instead balanced against the months already in use.
+
+    Examples:
+
+        >>> allocator = CrontabSlotAllocator(existing=['0 8 * * *', '10 8 * * *'], capacity=1)
+        >>> allocator.allocate('daily')
+        ['0 9 * * *']
+        >>> allocator.allocate('weekly', count=2)
+        ['0 10 * * 0', '0 10 * * 1']
+        >>> allocator.peak()
+        1
+
+    Args:
+        existing: crontab strings already assigned
+        capacity: maximum firings allowed in any one minute, None for no limit
+        minutes: minutes new crontabs may use, default matches the generate_* functions
+        hours: hours new crontabs may use, default matches the generate_* functions
+        start: start of the reference window
+        days: length of the reference window in days
+    """
+
+    KINDS = ('daily', 'every_other_day', 'weekly', 'monthly', 'biyearly', 'yearly')
+
+    def __init__(self, existing=(), capacity=None, minutes=None, hours=None,
+                 start=datetime.datetime(2021, 2, 1), days=28):
+        self.capacity = capacity
+        self.minutes = list(minutes if minutes is not None else range(0, 60, 10))
+        self.hours = list(hours if hours is not None else range(8, 20))
+        self.start = start
+        self.end = start + datetime.timedelta(days=days)
+
+        for minute in self.minutes:
+            validate_crontab_values(minute=minute)
+        for hour in self.hours:
+            validate_crontab_values(hour=hour)
+
+        self._occupancy = collections.Counter()
+        self._hour_occupancy = collections.Counter()
+        self._day_occupancy = collections.Counter()
+        self._month_load = collections.Counter()
+        self._candidates = {}
+
+        for crontab in existing:
+            self.add(crontab)
+
+    def _firings(self, crontab):
+        """ Minute offsets from start that crontab fires on, ignoring its month. """
+        minute, hour, day_of_month, _, day_of_week = crontab.split(' ', 4)
+        crontab = f'{minute} {hour} {day_of_month} * {day_of_week}'
+        minute = datetime.timedelta(minutes=1)
+        return tuple(
+            (timestamp - self.start) // minute
+            for timestamp in compile_crontab(crontab).iter_between(self.start, self.end)
+        )
+
+    def add(self, crontab):
+        """ Count an already assigned crontab towards the occupancy. """
+        firings = self._firings(crontab)
+        self._occupancy.update(firings)
+        self._hour_occupancy.update(offset // 60 for offset in firings)
+        self._day_occupancy.update(offset // 1440 for offset in firings)
+
+        months = compile_crontab(crontab).months_of_year
+        if len(months) < 12:
+            self._month_load.update(months)
+
+    def _day_fields(self, kind):
+        if kind == 'daily':
+            return [('*', '*')]
+        if kind == 'every_other_day':
+            return [('*', '0-7/2'), ('*', '1-7/2')]
+        if kind == 'weekly':
+            return [('*', str(day_of_week)) for day_of_week in range(7)]
+        # 29 ensures it'll run even in February
+        return [(str(day), '*') for day in range(1, 29)]
+
+    def _candidates_for(self, kind):
+        if kind not in self._candidates:
+            self._candidates[kind] = [
+                ((minute, hour, day_of_month, day_of_week),
+                 self._firings(f'{minute} {hour} {day_of_month} * {day_of_week}'))
+                for day_of_month, day_of_week in self._day_fields(kind)
+                for hour in self.hours
+                for minute in self.minutes
+            ]
+        return self._candidates[kind]
+
+    def _months_for(self, kind):
+        if kind == 'yearly':
+            month = min(range(1, 13), key=lambda m: (self._month_load[m], m))
+            return str(month)
+        if kind == 'biyearly':
+            month = min(range(1, 7), key=lambda m: (self._month_load[m] + self._month_load[m + 6], m))
+            return f'{month},{month + 6}'
+        return '*'
+
+    def allocate(self, kind='daily', count=1):
+        """ Returns count new crontabs of kind, each placed in the least loaded slot.
+
+        Slots are ranked by the busiest minute they would fire in, then by their
+        total load and then by how busy the surrounding days and hours are.
+        Every allocation is counted before the next one is placed.
+
+        Raises:
+            ValueError: kind is unknown or no slot has capacity left
+        """
+        if kind not in self.KINDS:
+            raise ValueError(f'Unknown crontab kind {kind!r}, must be one of {", ".join(self.KINDS)}.')
+
+        candidates = self._candidates_for(kind)
+        allocated = []
+        for _ in range(count):
+            best, best_key = None, None
+            for fields, firings in candidates:
+                loads = [self._occupancy[offset] for offset in firings]
+                day_load = sum(self._day_occupancy[offset // 1440] for offset in firings)
+                hour_load = sum(self._hour_occupancy[offset // 60] for offset in firings)
+                key = (max(loads, default=0), sum(loads), day_load, hour_load)
+                if self.capacity is not None and key[0] >= self.capacity:
+                    continue
+                if best_key is None or key < best_key:
+                    best, best_key = fields, key
+
+            if best is None:
+                raise ValueError(f'No {kind} slot has capacity left, capacity={self.capacity}.')
+
+            minute, hour, day_of_month, day_of_week = best
+            crontab = f'{minute} {hour} {day_of_month} {self._months_for(kind)} {day_of_week}'
+            self.add(crontab)
+            allocated.append(crontab)
+
+        return allocated
+
+    def histogram(self):
+        """ Returns a Counter of datetime -> number of crontabs firing in that minute. """
+        minute = datetime.timedelta(minutes=1)
+        return collections.Counter({
+            self.start + offset * minute: total for offset, total in self._occupancy.items()
+        })
+
+    def peak(self):
+        """ The most crontabs firing in any one minute of the reference window. """
+        return max(self._occupancy.values(), default=0)
+
+
+def occupancy_matrix(crontabs, start, days, bucket=1, use_numpy=None):
+    """ Counts how many of the crontabs fire in each minute bucket of each day.
+
+    A crontab fires at a minute when its day fields match the day and its
+    hour/minute fields match the time of day. Crontabs are grouped by their
+    distinct day fields and time fields, each group is matched once and the
+    counts are combined as a (days x groups) by (groups x minutes) product,
+    no individual timestamps are checked.
+
+    Examples:
+
+        >>> matrix = occupancy_matrix(['0 8 * * *', '0 8 * * 1-5'], datetime.date(2021, 2, 1), days=7, bucket=60)
+        >>> matrix[0][8], matrix[6][8]
+        (2, 1)
+
+    Args:
+        crontabs: iterable of crontab strings, duplicates are counted
+        start: date or datetime of the first day, time is ignored
+        days: How many days to count
+        bucket: Minutes per bucket, must divide evenly into a day
+        use_numpy: Force numpy on or off, default uses numpy when installed
+
+    Returns:
+        numpy array of shape (days, 1440 // bucket) or, without numpy,
+        a list of array.array rows with the same shape.
+    """
+    if 1440 % bucket:
+        raise ValueError(f'bucket must divide evenly into 1440 minutes, was given {bucket=}')
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    elif use_numpy and numpy is None:
+        raise ImportError('numpy is required for use_numpy=True. "pip install numpy"')
+
+    if isinstance(start, datetime.datetime):
+        start = start.date()
+    dates = [start + datetime.timedelta(days=x) for x in range(days)]
+
+    # Distinct (day fields) and (time fields) groups, and how many crontabs share each pair.
+    day_groups, time_groups, pairs = {}, {}, collections.Counter()
+    for crontab, total in collections.Counter(crontabs).items():
+        compiled = compile_crontab(crontab)
+        day_key = (compiled.day_of_month_mask, compiled.month_mask, compiled.day_of_week_mask)
+        time_key = (compiled.hour_mask, compiled.minute_mask)
+        pairs[day_groups.setdefault(day_key, len(day_groups)),
+              time_groups.setdefault(time_key, len(time_groups))] += total
+
+    if use_numpy:
+        return _occupancy_matrix_numpy(dates, bucket, list(day_groups), list(time_groups), pairs)
+    return _occupancy_matrix_python(dates, bucket, list(day_groups), list(time_groups), pairs)
+
+
+def _occupancy_matrix_numpy(dates, bucket, day_groups, time_groups, pairs):
+    day_of_month = numpy.array([d.day for d in dates], dtype=numpy.int64)
+    month = numpy.array([d.month for d in dates], dtype=numpy.int64)
+    day_of_week = numpy.array([isoweekday_sunday_zero(d.isoweekday()) for d in dates], dtype=numpy.int64)
+
+    # (day groups x days) of whether the group fires on that day.
+    masks = numpy.array(day_groups, dtype=numpy.int64).reshape(-1, 3)
+    day_matches = (
+        (masks[:, 0:1] >> day_of_month[None, :])
+        & (masks[:, 1:2] >> month[None, :])
+        & (masks[:, 2:3] >> day_of_week[None, :])
+        & 1
+    )
+
+    # (time groups x minutes of the day) of whether the group fires at that minute.
+    masks = numpy.array(time_groups, dtype=numpy.int64).reshape(-1, 2)
+    hour_bits = (masks[:, 0:1] >> numpy.arange(24)[None, :]) & 1
+    minute_bits = (masks[:, 1:2] >> numpy.arange(60)[None, :]) & 1
+    time_matches = (hour_bits[:, :, None] * minute_bits[:, None, :]).reshape(len(time_groups), 1440)
+
+    # (day groups x time groups) of how many crontabs share both.
+    weights = numpy.zeros((len(day_groups), len(time_groups)), dtype=numpy.int64)
+    for (day_index, time_index), total in pairs.items():
+        weights[day_index, time_index] = total
+
+    matrix = day_matches.T @ weights @ time_matches
+    return matrix.reshape(len(dates), 1440 // bucket, bucket).sum(axis=2)
+
+
+def _occupancy_matrix_python(dates, bucket, day_groups, time_groups, pairs):
+    fires_on = [
+        [
+            bool(dom_mask >> d.day & 1 and month_mask >> d.month & 1
+                 and dow_mask >> isoweekday_sunday_zero(d.isoweekday()) & 1)
+            for d in dates
+        ]
+        for dom_mask, month_mask, dow_mask in day_groups
+    ]
+    buckets = [
+        [(hour * 60 + minute) // bucket
+         for hour in range(24) if hour_mask >> hour & 1
+         for minute in range(60) if minute_mask >> minute & 1]
+        for hour_mask, minute_mask in time_groups
+    ]
+
+    matrix = [array.array('q', bytes(8 * (1440 // bucket))) for _ in dates]
+    for (day_index, time_index), total in pairs.items():
+        for row, fires in zip(matrix, fires_on[day_index]):
+            if fires:
+                for column in buckets[time_index]:
+                    row[column] += total
+    return matrix
+
+
+class CronJob:
+    """ A callable registered against a crontab in :class:`CronScheduler`. """
+
+    def __init__(self, name, crontab, func, args=(), kwargs=None):
+        self.name = name
+        self.crontab = crontab
+        self.compiled = compile_crontab(crontab)
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+
+        self.next_run = None
+        self.last_run = None
+        self.running = None
+
+        self.runs = 0
+        self.missed = 0
+        self.late = 0
+        self.failed = 0
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.name!r} {self.crontab!r}>'
+
+
+class CronScheduler:
+    """ Runs registered callables whenever their crontab fires.
+
+    Rather than waking every minute and checking :func:`is_active_now`, the
+    scheduler sleeps until the earliest next fire time of all jobs, so a slow
+    job never shifts the schedule. Jobs run in a bounded thread or process
+    pool (coroutine functions run on the loop itself) and a job still running
+    from its previous fire time is skipped rather than stacked.
+
+    Fire times that passed without running, e.g. when the machine was
+    suspended or the job was still running, are counted as missed. Runs that
+    start more than late_after seconds past their fire time are counted as late.
+
+    Examples::
+
+        scheduler = CronScheduler(max_workers=4, pid_file_name='cron')
+
+        @scheduler.register('*/10 * * * *')
+        def scan_channels():
+            ...
+
+        scheduler.register('0 2 * * *', backup, '/srv/data', name='backup')
+        scheduler.start()
+
+    Args:
+        max_workers: Maximum jobs running at the same time
+        executor: 'thread', 'process' or a concurrent.futures.Executor instance
+        pid_file_name: When supplied, run holds a PIDFile with this name and
+            returns immediately if another instance already holds it
+        pid_folder: Folder to store the PIDFile in
+        late_after: Seconds after the fire time that a run is considered late
+        on_missed: Called with (job, fire_time) for every missed fire time
+        on_late: Called with (job, fire_time, seconds_late) for every late run
+        clock: Returns the current datetime, tzinfo is carried over to fire times
+    """
+
+    def __init__(self, max_workers=4, executor='thread', pid_file_name=None, pid_folder='', late_after=60,
+                 on_missed=None, on_late=None, clock=datetime.datetime.now):
+        self.max_workers = max_workers
+        self.executor = executor
+        self.pid_file_name = pid_file_name
+        self.pid_folder = pid_folder
+        self.late_after = late_after
+        self.on_missed = on_missed
+        self.on_late = on_late
+        self.clock = clock
+
+        self.jobs = {}
+
+        self._loop = None
+        self._wakeup = None
+        self._stopping = False
+
+    def register(self, crontab, func=None, *args, name=None, **kwargs):
+        """ Register func to be called with args and kwargs whenever crontab fires.
+
+        Can also be used as a decorator, in which case name defaults to the
+        function name. Registering an existing name replaces that job.
+
+        Returns:
+            CronJob, or the decorator when func is not supplied.
+        """
+        if func is None:
+            def decorator(f):
+                self.register(crontab, f, *args, name=name, **kwargs)
+                return f
+            return decorator
+
+        job = CronJob(name or getattr(func, '__name__', repr(func)), crontab, func, args, kwargs)
+        job.next_run = job.compiled.next_after(self.clock())
+        self.jobs[job.name] = job
+        self._notify()
+        return job
+
+    def unregister(self, name):
+        job = self.jobs.pop(name)
+        self._notify()
+        return job
+
+    def stop(self):
+        """ Stop a running scheduler, safe to call from any thread. """
+        self._stopping = True
+        self._notify()
+
+    def _notify(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _make_executor(self):
+        if isinstance(self.executor, concurrent.futures.Executor):
+            return self.executor, False
+        if self.executor == 'thread':
+            return concurrent.futures.ThreadPoolExecutor(self.max_workers, thread_name_prefix='CronScheduler'), True
+        if self.executor == 'process':
+            return concurrent.futures.ProcessPoolExecutor(self.max_workers), True
+        raise ValueError(f"executor must be 'thread', 'process' or an Executor, was given {self.executor!r}")
+
+    def due_jobs(self, now):
+        """ Returns [(job, fire_time)] due at now, recording any missed and late runs.
+
+        Each job's next_run is moved past now, only the most recent fire time
+        of a job is returned.
+        """
+        due = []
+        for job in list(self.jobs.values()):
+            if job.next_run is None or job.next_run > now:
+                continue
+
+            fire_time = job.next_run
+            following = job.compiled.next_after(fire_time)
+            while following is not None and following <= now:
+                self._missed(job, fire_time)
+                fire_time = following
+                following = job.compiled.next_after(fire_time)
+            job.next_run = following
+
+            if job.running is not None and not job.running.done():
+                self._missed(job, fire_time)
+                continue
+
+            seconds_late = (now - fire_time).total_seconds()
+            if seconds_late > self.late_after:
+                job.late += 1
+                log.warning(f'{job.name} started {seconds_late:.0f} seconds late for {fire_time}.')
+                if self.on_late:
+                    self.on_late(job, fire_time, seconds_late)
+
+            due.append((job, fire_time))
+        return due
+
+    def _missed(self, job, fire_time):
+        job.missed += 1
+        log.warning(f'{job.name} missed its run at {fire_time}.')
+        if self.on_missed:
+            self.on_missed(job, fire_time)
+
+    def _dispatch(self, job, fire_time, executor):
+        job.runs += 1
+        job.last_run = fire_time
+
+        if asyncio.iscoroutinefunction(job.func):
+            job.running = asyncio.ensure_future(job.func(*job.args, **job.kwargs))
+        else:
+            job.running = self._loop.run_in_executor(executor, functools.partial(job.func, *job.args, **job.kwargs))
+        job.running.add_done_callback(functools.partial(self._finished, job))
+
+    @staticmethod
+    def _finished(job, future):
+        if not future.cancelled() and future.exception() is not None:
+            job.failed += 1
+            log.error(f'{job.name} failed.', exc_info=future.exception())
+
+    async def run(self, until=None):
+        """ Run jobs until stop() is called or the clock reaches until.
+
+        Returns:
+            False if pid_file_name is set and another instance is running, otherwise True.
+        """
+        if self.pid_file_name:
+            with PIDFile(self.pid_file_name, folder=self.pid_folder) as good:
+                if not good:
+                    log.warning(f'{self.pid_file_name} is already running.')
+                    raise PIDFile.Break
+                await self._run(until)
+                return True
+            return False
+
+        await self._run(until)
+        return True
+
+    async def _run(self, until):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        executor, owns_executor = self._make_executor()
+
+        now = self.clock()
+        for job in self.jobs.values():
+            job.next_run = job.compiled.next_after(now)
+
+        try:
+            while not self._stopping:
+                now = self.clock()
+                if until is not None and now >= until:
+                    break
+
+                for job, fire_time in self.due_jobs(now):
+                    self._dispatch(job, fire_time, executor)
+
+                wake_at = min((job.next_run for job in self.jobs.values() if job.next_run is not None), default=None)
+                if until is not None and (wake_at is None or until < wake_at):
+                    wake_at = until
+
+                # Woken early by register/unregister/stop, or the sleep ends just
+                # before the clock reaches wake_at. Either way everything is rechecked.
+                timeout = None if wake_at is None else max((wake_at - self.clock()).total_seconds(), 0)
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            running = [job.running for job in self.jobs.values() if job.running is not None]
+            await asyncio.gather(*running, return_exceptions=True)
+            if owns_executor:
+                executor.shutdown(wait=True)
+            self._loop = None
+
+    def start(self, until=None):
+        """ Blocking version of run. """
+        return asyncio.run(self.run(until))
@@ -1,15 +1,55 @@
+import collections
+import concurrent.futures
+import ctypes
+import ctypes.util
+import fnmatch
+import functools
 import glob
 import hashlib
+import json
+import mimetypes
+import mmap
 import os
+import re
 import requests
+import select
 import shutil
+import sqlite3
+import string
+import struct
+import sys
 import tarfile
+import tempfile
+import threading
 import time
+import urllib.parse
 import zipfile
+import zlib
 
 from .strings import random_character_generator
 
 
+try:
+    import bz2
+except ImportError:  # pragma: no cover
+    bz2 = None
+
+try:
+    import lzma
+except ImportError:  # pragma: no cover
+    lzma = None
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+
 class ZipFileWithPermissions(zipfile.ZipFile):
     """ Custom ZipFile class for handling file permissions.
 
@@ -44,7 +84,513 @@ def generate_file_hash(opened_file, func=hashlib.md5):
     return output
 
 
-def download_file(url: str, path_to_file, requests_kwargs=None):
+HASH_CHUNK_SIZE = 1048576
+
+
+def _new_hasher(algorithm):
+    if isinstance(algorithm, str):
+        return hashlib.new(algorithm)
+    return algorithm()
+
+
+def generate_file_hashes(file, algorithms=('md5', 'sha256'), chunk_size=HASH_CHUNK_SIZE, buffer=None):
+    """ Calculate several hashes of a file while only reading it once.
+
+    Chunks are read into one reusable buffer with readinto and each hasher
+    is fed a memoryview of it, so no new bytes object is made per chunk.
+
+    Examples:
+
+        >>> generate_file_hashes('/tmp/download.zip')
+        {'md5': '47bce5c74f589f4867dbd57e9ca9f808', 'sha256': '9834876dcfb05cb1...'}
+
+        >>> generate_file_hashes('/tmp/download.zip', algorithms=[hashlib.sha1])
+        {'sha1': '7e240de74fb1ed08fa08d38063f6a6a91462a815'}
+
+    Args:
+        file: Path to the file or a file opened in binary mode
+        algorithms: hashlib algorithm names or constructors like hashlib.md5
+        chunk_size: How many bytes to read at a time
+        buffer: bytearray to read into, reused when hashing many files
+
+    Returns:
+        dict of algorithm name: hexdigest
+    """
+    hashers = [_new_hasher(algorithm) for algorithm in algorithms]
+
+    if buffer is None:
+        buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+
+    if isinstance(file, (str, bytes, os.PathLike)):
+        opened_file = open(file, 'rb', buffering=0)
+    else:
+        opened_file = file
+        opened_file.seek(0)
+
+    try:
+        while True:
+            size = opened_file.readinto(view)
+            if not size:
+                break
+            chunk = view[:size]
+            for hasher in hashers:
+                hasher.update(chunk)
+    finally:
+        if opened_file is file:
+            opened_file.seek(0)
+        else:
+            opened_file.close()
+
+    return {hasher.name: hasher.hexdigest() for hasher in hashers}
+
+
+def hash_files(paths, algorithms=('md5', 'sha256'), max_workers=None, chunk_size=HASH_CHUNK_SIZE):
+    """ Calculate the hashes of many files across a thread pool.
+
+    hashlib releases the GIL while hashing, so large files hash in parallel.
+    Each worker thread reuses its own read buffer.
+
+    Examples:
+
+        >>> hash_files(glob.glob('/tmp/downloads/*'), algorithms=['sha256'])
+        {'/tmp/downloads/a.zip': {'sha256': '...'}, '/tmp/downloads/b.zip': {'sha256': '...'}}
+
+    Args:
+        paths: Iterable of paths to hash
+        algorithms: hashlib algorithm names or constructors like hashlib.md5
+        max_workers: Thread count, default is decided by ThreadPoolExecutor
+        chunk_size: How many bytes to read at a time
+
+    Returns:
+        dict of path: {algorithm name: hexdigest}
+    """
+    local = threading.local()
+
+    def worker(path):
+        if not hasattr(local, 'buffer'):
+            local.buffer = bytearray(chunk_size)
+        return generate_file_hashes(path, algorithms=algorithms, buffer=local.buffer)
+
+    paths = list(paths)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(paths, executor.map(worker, paths)))
+
+
+MMAP_WINDOW_SIZE = 8388608
+
+
+def _map_file(opened_file):
+    mapped = mmap.mmap(opened_file.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mapped, 'madvise'):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+    return mapped
+
+
+def generate_file_hashes_mmap(path, algorithms=('md5', 'sha256'), window_size=MMAP_WINDOW_SIZE):
+    """ Calculate several hashes of a file by memory mapping it.
+
+    Each hasher is fed memoryview windows of the mapping, so the file is
+    never copied into Python objects and pages are released by the OS as
+    the hash moves along. Gives the same result as :func:`generate_file_hashes`.
+
+    Examples:
+
+        >>> generate_file_hashes_mmap('/exports/daily.csv', algorithms=['sha256'])
+        {'sha256': '9834876dcfb05cb167a5c24953eba58c4ac89b1adf57f28f2f9d09af107ee8f0'}
+
+    Args:
+        path: Path to the file
+        algorithms: hashlib algorithm names or constructors like hashlib.md5
+        window_size: How many bytes are passed to the hashers at a time
+
+    Returns:
+        dict of algorithm name: hexdigest
+    """
+    hashers = [_new_hasher(algorithm) for algorithm in algorithms]
+
+    with open(path, 'rb') as opened_file:
+        if os.fstat(opened_file.fileno()).st_size:
+            with _map_file(opened_file) as mapped, memoryview(mapped) as view:
+                for start in range(0, len(view), window_size):
+                    with view[start:start + window_size] as window:
+                        for hasher in hashers:
+                            hasher.update(window)
+
+    return {hasher.name: hasher.hexdigest() for hasher in hashers}
+
+
+def files_equal(a, b, window_size=MMAP_WINDOW_SIZE):
+    """ Whether two files have identical contents.
+
+    Sizes are compared first, then both files are memory mapped and compared
+    window by window, stopping at the first window that differs.
+
+    Examples:
+
+        >>> files_equal('/exports/daily.csv', '/backups/daily.csv')
+        True
+
+    Args:
+        a: Path to the first file
+        b: Path to the second file
+        window_size: How many bytes are compared at a time
+
+    Returns:
+        bool
+    """
+    stat_a, stat_b = os.stat(a), os.stat(b)
+    if stat_a.st_size != stat_b.st_size:
+        return False
+    if (stat_a.st_dev, stat_a.st_ino) == (stat_b.st_dev, stat_b.st_ino) or not stat_a.st_size:
+        return True
+
+    with open(a, 'rb') as file_a, open(b, 'rb') as file_b:
+        with _map_file(file_a) as mapped_a, _map_file(file_b) as mapped_b:
+            if len(mapped_a) != len(mapped_b):
+                # Changed between the stat and the mapping.
+                return False
+            for start in range(0, len(mapped_a), window_size):
+                # Slicing an mmap makes a window sized bytes object which compares
+                # with memcmp, far faster than comparing memoryviews item by item.
+                if mapped_a[start:start + window_size] != mapped_b[start:start + window_size]:
+                    return False
+    return True
+
+
+class FileHashCache:
+    """ On-disk cache of file hashes so unchanged files are never hashed twice.
+
+    Hashes are stored in an SQLite database keyed by the files device, inode,
+    size and mtime_ns. Looking up an unchanged file is a stat plus a query,
+    any change to the file changes its key and it is hashed again.
+
+    Examples:
+
+        >>> with FileHashCache('/tmp/hashes.sqlite3') as cache:
+        ...     cache.hash_file('/tmp/downloads/a.zip')
+        ...     manifest = cache.hash_tree('/tmp/downloads')
+        ...     print(cache.hits, cache.misses)
+        {'md5': '...', 'sha256': '...'}
+        2 1
+
+        # Or keep the cache inside the tree itself
+        >>> with FileHashCache.for_tree('/tmp/downloads') as cache:
+        ...     manifest = cache.hash_tree('/tmp/downloads')
+
+    Args:
+        cache_file: Path to the SQLite database, created if it does not exist
+        algorithms: hashlib algorithm names to calculate and store
+    """
+
+    def __init__(self, cache_file, algorithms=('md5', 'sha256')):
+        self.cache_file = cache_file
+        # Stored under hasher.name, so constructors and names in any case all hit the same rows.
+        self.algorithms = tuple(_new_hasher(algorithm).name for algorithm in algorithms)
+        self.hits = 0
+        self.misses = 0
+
+        self.connection = sqlite3.connect(cache_file)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS file_hashes ('
+            'device INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER, algorithm TEXT, digest TEXT, '
+            'PRIMARY KEY (device, inode, algorithm))'
+        )
+        self.connection.commit()
+
+    @classmethod
+    def for_tree(cls, root, filename='.file_hashes.sqlite3', **kwargs):
+        """ Cache stored inside the directory tree it is used for. """
+        return cls(os.path.join(root, filename), **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def _key(stat):
+        return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def _lookup(self, key):
+        rows = self.connection.execute(
+            'SELECT algorithm, digest FROM file_hashes WHERE device=? AND inode=? AND size=? AND mtime_ns=?', key
+        ).fetchall()
+        digests = dict(rows)
+        if all(algorithm in digests for algorithm in self.algorithms):
+            return {algorithm: digests[algorithm] for algorithm in self.algorithms}
+        return None
+
+    def _store(self, key, digests):
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO file_hashes (device, inode, size, mtime_ns, algorithm, digest) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            [(*key, algorithm, digest) for algorithm, digest in digests.items()]
+        )
+
+    def hash_file(self, path):
+        """ Returns {algorithm: hexdigest} for path, from the cache when unchanged. """
+        key = self._key(os.stat(path))
+        digests = self._lookup(key)
+        if digests is not None:
+            self.hits += 1
+            return digests
+
+        self.misses += 1
+        digests = generate_file_hashes(path, algorithms=self.algorithms)
+        self._store(key, digests)
+        self.connection.commit()
+        return digests
+
+    def hash_tree(self, root, max_workers=None):
+        """ Hash every file under root, only hashing files that changed.
+
+        Changed files are hashed across a thread pool with :func:`hash_files`.
+        The cache file itself is skipped if it lives inside root.
+
+        Returns:
+            dict of path relative to root: {algorithm: hexdigest}, sorted by path
+        """
+        cache_file = os.path.abspath(self.cache_file)
+        cache_files = {cache_file} | {f'{cache_file}-{suffix}' for suffix in ('journal', 'wal', 'shm')}
+
+        keys = {}
+        for folder, _, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(folder, filename)
+                if os.path.abspath(path) in cache_files:
+                    continue
+                keys[path] = self._key(os.stat(path))
+
+        manifest, changed = {}, []
+        for path, key in keys.items():
+            digests = self._lookup(key)
+            if digests is None:
+                changed.append(path)
+            else:
+                manifest[path] = digests
+        self.hits += len(manifest)
+        self.misses += len(changed)
+
+        for path, digests in hash_files(changed, algorithms=self.algorithms, max_workers=max_workers).items():
+            self._store(keys[path], digests)
+            manifest[path] = digests
+        self.connection.commit()
+
+        return {os.path.relpath(path, root): manifest[path] for path in sorted(manifest)}
+
+
+PARTIAL_HASH_SIZE = 4096
+
+DuplicateGroup = collections.namedtuple('DuplicateGroup', ['size', 'digest', 'paths'])
+DuplicateAction = collections.namedtuple('DuplicateAction', ['action', 'path', 'kept', 'size', 'error'])
+
+
+def _scan_folder(folder):
+    files, folders = [], []
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        files.append((entry.path, entry.stat(follow_symlinks=False)))
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return files, folders
+
+
+def _scan_trees(roots, executor):
+    """ Yields (path, stat) of every regular file under roots, scanning folders across the executor. """
+    pending = set()
+    for root in roots:
+        if os.path.isdir(root):
+            pending.add(executor.submit(_scan_folder, root))
+        elif os.path.isfile(root):
+            yield root, os.stat(root)
+
+    while pending:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            files, folders = future.result()
+            yield from files
+            pending.update(executor.submit(_scan_folder, folder) for folder in folders)
+
+
+def _partial_hash(path, size, partial_size, algorithm):
+    """ Hash of the first and last partial_size bytes, which is the whole file when size <= 2 * partial_size. """
+    hasher = _new_hasher(algorithm)
+    with open(path, 'rb') as fo:
+        hasher.update(fo.read(partial_size))
+        if size > partial_size:
+            fo.seek(max(partial_size, size - partial_size))
+            hasher.update(fo.read(partial_size))
+    return hasher.hexdigest()
+
+
+def find_duplicates(roots, algorithm='sha256', min_size=1, max_workers=None, partial_size=PARTIAL_HASH_SIZE):
+    """ Find files with identical contents under one or more folders.
+
+    Candidates are narrowed down in three passes so most files are never read:
+
+    1. Files are grouped by size, a file with a unique size has no duplicate.
+    2. Same sized files are grouped by a hash of their first and last partial_size bytes.
+    3. Only files that still collide are hashed in full.
+
+    Folders are scanned and files hashed across a thread pool, groups are
+    yielded as soon as they are confirmed. Hardlinks to the same file are
+    only reported once.
+
+    Examples:
+
+        >>> for group in find_duplicates(['/mnt/share1', '/mnt/share2']):
+        ...     print(group.size, group.paths)
+        1048576 ('/mnt/share1/report.pdf', '/mnt/share2/old/report (1).pdf')
+
+    Args:
+        roots: Folders (or files) to search through
+        algorithm: hashlib algorithm name used to confirm duplicates
+        min_size: Files smaller than this many bytes are ignored
+        max_workers: Thread count, default is decided by ThreadPoolExecutor
+        partial_size: How many bytes from each end of a file go into the partial hash
+
+    Yields:
+        DuplicateGroup(size, digest, paths) with paths sorted
+    """
+    if isinstance(roots, (str, bytes, os.PathLike)):
+        roots = [roots]
+
+    local = threading.local()
+
+    def full_hash(path):
+        if not hasattr(local, 'buffer'):
+            local.buffer = bytearray(HASH_CHUNK_SIZE)
+        return generate_file_hashes(path, algorithms=[algorithm], buffer=local.buffer).popitem()[1]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        by_size = collections.defaultdict(list)
+        seen = set()
+        for path, stat in _scan_trees(roots, executor):
+            if stat.st_size < min_size or (stat.st_dev, stat.st_ino) in seen:
+                continue
+            seen.add((stat.st_dev, stat.st_ino))
+            by_size[stat.st_size].append(path)
+
+        pending = {}
+        remaining = collections.Counter()
+        for size, paths in by_size.items():
+            if len(paths) < 2:
+                continue
+            remaining[size] = len(paths)
+            for path in paths:
+                pending[executor.submit(_partial_hash, path, size, partial_size, algorithm)] = (size, path)
+        del by_size
+
+        # Digests collected per size (partial pass) or per (size, partial digest) (full pass),
+        # a set of candidates is resolved once all of its hashes are in.
+        digests = collections.defaultdict(lambda: collections.defaultdict(list))
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                key, path = pending.pop(future)
+                try:
+                    digests[key][future.result()].append(path)
+                except OSError:
+                    pass
+                remaining[key] -= 1
+                if remaining[key]:
+                    continue
+                del remaining[key]
+
+                full_pass = isinstance(key, tuple)
+                size = key[0] if full_pass else key
+                for digest, paths in digests.pop(key, {}).items():
+                    if len(paths) < 2:
+                        continue
+                    if full_pass or size <= partial_size * 2:
+                        # A partial hash of a small file already covered the whole file.
+                        yield DuplicateGroup(size, digest, tuple(sorted(paths)))
+                        continue
+                    remaining[size, digest] = len(paths)
+                    for candidate in paths:
+                        pending[executor.submit(full_hash, candidate)] = ((size, digest), candidate)
+
+
+def deduplicate_files(groups, action='hardlink', dry_run=True, keep=None):
+    """ Replace duplicate files with hardlinks or delete them.
+
+    One file of each group is kept, every other file in the group is either
+    replaced with a hardlink to it or deleted. With dry_run nothing is
+    touched and the returned report lists what would have been done.
+
+    Hardlinks are created beside the duplicate and renamed over it, so the
+    duplicate path always exists. Files whose size changed since they were
+    found are skipped.
+
+    Examples:
+
+        >>> report = deduplicate_files(find_duplicates('/mnt/share'), action='delete')
+        >>> sum(item.size for item in report if not item.error)
+        73400320
+
+        >>> deduplicate_files(find_duplicates('/mnt/share'), dry_run=False)
+        [DuplicateAction(action='hardlink', path='/mnt/share/b.zip', kept='/mnt/share/a.zip', size=1024, error=None)]
+
+    Args:
+        groups: Iterable of DuplicateGroup, usually from :func:`find_duplicates`
+        action: 'hardlink' or 'delete'
+        dry_run: Only report what would be done
+        keep: Callable given a groups paths that returns the path to keep, default is the first path
+
+    Returns:
+        list of DuplicateAction(action, path, kept, size, error), error is None on success
+    """
+    if action not in ('hardlink', 'delete'):
+        raise ValueError(f"action must be 'hardlink' or 'delete', not {action!r}")
+
+    if keep is None:
+        def keep(paths):
+            return paths[0]
+
+    report = []
+    for group in groups:
+        kept = keep(group.paths)
+        for path in group.paths:
+            if path == kept:
+                continue
+
+            error = None
+            try:
+                if os.stat(path).st_size != group.size or os.stat(kept).st_size != group.size:
+                    error = 'file changed since it was found'
+                elif not dry_run:
+                    if action == 'delete':
+                        os.remove(path)
+                    else:
+                        temporary = f'{path}.{random_character_generator(length=8)}.link'
+                        os.link(kept, temporary)
+                        try:
+                            os.replace(temporary, path)
+                        except OSError:
+                            os.remove(temporary)
+                            raise
+            except OSError as e:
+                error = str(e)
+
+            report.append(DuplicateAction(action, path, kept, group.size, error))
+
+    return report
+
+
+def download_file(url: str, path_to_file, requests_kwargs=None, session=None):
     """ Download a file from a remote HTTP server.
 
     Examples:
@@ -55,31 +601,463 @@ def download_file(url: str, path_to_file, requests_kwargs=None):
         url: URL to the file
         path_to_file: filename to save to locally
         requests_kwargs:
+        session: requests.Session to reuse connections from, default is a one-off request
     """
     if requests_kwargs is None:
         requests_kwargs = {}
-    with requests.get(url, stream=True, **requests_kwargs) as response, open(path_to_file, 'wb') as out_file:
+    get = session.get if session is not None else requests.get
+    with get(url, stream=True, **requests_kwargs) as response, open(path_to_file, 'wb') as out_file:
         shutil.copyfileobj(response.raw, out_file)
 
 
-def _extract__single_file(extractor, compressed_file, file_to_extract, destination,
-                          max_attempts=10, max_wait_in_seconds=30, log=None, **kwargs):
-    with extractor(compressed_file) as open_file:
+DownloadResult = collections.namedtuple(
+    'DownloadResult', 'url path success status_code size elapsed attempts error'
+)
+
+
+def download_many(urls_to_paths, max_workers=8, session=None, max_per_host=4, max_retries=3, backoff=0.5,
+                  requests_kwargs=None):
+    """ Download many files over a shared, pooled requests.Session.
+
+    Connections are reused between files so each host only pays for TCP and
+    TLS setup once per pooled connection. Connection errors, 429 and 5xx
+    responses are retried with exponential backoff, other error statuses fail
+    straight away.
+
+    Examples:
+
+        >>> results = download_many({
+        ...     'https://example.com/report1.csv': '/tmp/report1.csv',
+        ...     'https://example.com/report2.csv': '/tmp/report2.csv',
+        ... }, max_workers=4)
+        >>> results['/tmp/report1.csv']
+        DownloadResult(url='https://example.com/report1.csv', path='/tmp/report1.csv', success=True,
+                       status_code=200, size=10423, elapsed=0.041, attempts=1, error=None)
+
+    Args:
+        urls_to_paths: dict or iterable of (url, path_to_file) pairs
+        max_workers: How many downloads run at the same time
+        session: requests.Session to use, one sized to max_workers is created when not supplied
+        max_per_host: How many downloads may run against the same host at the same time
+        max_retries: How many times a failing download is retried
+        backoff: Seconds to wait before the first retry, doubled on every retry
+        requests_kwargs: passed into every requests.get call
+
+    Returns:
+        dict of path_to_file: DownloadResult
+    """
+    if isinstance(urls_to_paths, dict):
+        urls_to_paths = urls_to_paths.items()
+    urls_to_paths = list(urls_to_paths)
+    requests_kwargs = requests_kwargs or {}
+
+    owns_session = session is None
+    if owns_session:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+    # Created up front, worker threads only ever read from it.
+    host_limits = {
+        urllib.parse.urlsplit(url).netloc: threading.Semaphore(max_per_host) for url, _ in urls_to_paths
+    }
+
+    def fetch(url, path_to_file):
+        started = time.perf_counter()
+        status_code, error = None, None
+        for attempt in range(1, max_retries + 2):
+            try:
+                with host_limits[urllib.parse.urlsplit(url).netloc]:
+                    with session.get(url, stream=True, **requests_kwargs) as response:
+                        status_code = response.status_code
+                        if response.ok:
+                            with open(path_to_file, 'wb') as out_file:
+                                shutil.copyfileobj(response.raw, out_file)
+                            return DownloadResult(url, path_to_file, True, status_code, os.path.getsize(path_to_file),
+                                                  time.perf_counter() - started, attempt, None)
+                        error = f'HTTP {status_code}'
+                        if status_code != 429 and status_code < 500:
+                            break
+            except (requests.RequestException, OSError) as e:
+                status_code, error = None, repr(e)
+
+            if attempt <= max_retries:
+                time.sleep(backoff * 2 ** (attempt - 1))
+
+        return DownloadResult(url, path_to_file, False, status_code, 0, time.perf_counter() - started, attempt, error)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(fetch, url, path_to_file) for url, path_to_file in urls_to_paths]
+            return {result.path: result for result in (future.result() for future in futures)}
+    finally:
+        if owns_session:
+            session.close()
+
+
+def download_file_ranged(url: str, path_to_file, segments=4, expected_hash=None, hash_algorithm='sha256',
+                         progress=None, session=None, max_retries=3, chunk_size=HASH_CHUNK_SIZE, requests_kwargs=None):
+    """ Download a file over several concurrent HTTP Range requests, resuming earlier attempts.
+
+    The file is preallocated and each segment is written at its own offset.
+    Progress is kept in a sidecar file (path_to_file + '.download') so calling
+    this again after a failure only fetches what is missing. Servers that do
+    not support ranges fall back to a single streamed request.
+
+    Examples:
+
+        >>> download_file_ranged('https://example.com/big.iso', '/tmp/big.iso', segments=8,
+        ...                      expected_hash='9834876dcfb05cb1...', progress=print)
+        1048576 2147483648
+        2097152 2147483648
+        ...
+
+    Args:
+        url: URL to the file
+        path_to_file: filename to save to locally
+        segments: How many ranges to download at the same time
+        expected_hash: hexdigest the finished file must match
+        hash_algorithm: hashlib algorithm name or constructor for expected_hash
+        progress: Called with (bytes_downloaded, total_bytes) after every chunk
+        session: requests.Session to use, one is created when not supplied
+        max_retries: How many times a failing segment is retried before giving up
+        chunk_size: How many bytes to read from the response at a time
+        requests_kwargs: passed into every requests call
+
+    Raises:
+        ValueError: The downloaded file does not match expected_hash, it is deleted.
+    """
+    owns_session = session is None
+    if owns_session:
+        session = requests.Session()
+
+    try:
+        _download_file_ranged(url, path_to_file, segments, expected_hash, hash_algorithm, progress, session,
+                              max_retries, chunk_size, requests_kwargs)
+    finally:
+        if owns_session:
+            session.close()
+
+
+def _download_file_ranged(url, path_to_file, segments, expected_hash, hash_algorithm, progress, session,
+                          max_retries, chunk_size, requests_kwargs):
+    requests_kwargs = dict(requests_kwargs or {})
+    base_headers = requests_kwargs.pop('headers', {})
+    state_file = f'{path_to_file}.download'
+
+    response = session.head(url, allow_redirects=True, headers=base_headers, **requests_kwargs)
+    response.raise_for_status()
+    size = int(response.headers.get('Content-Length') or 0)
+    validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+
+    if not size or response.headers.get('Accept-Ranges') != 'bytes':
+        hasher = _new_hasher(hash_algorithm)
+        downloaded = 0
+        with session.get(url, stream=True, headers=base_headers, **requests_kwargs) as response, \
+                open(path_to_file, 'wb') as out_file:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size):
+                out_file.write(chunk)
+                hasher.update(chunk)
+                downloaded += len(chunk)
+                if progress:
+                    progress(downloaded, size or downloaded)
+        _verify_download(path_to_file, expected_hash, hasher.hexdigest())
+        return
+
+    state = None
+    if os.path.isfile(state_file) and os.path.isfile(path_to_file) and os.path.getsize(path_to_file) == size:
+        with open(state_file) as fo:
+            state = json.load(fo)
+        if (state.get('url'), state.get('size'), state.get('validator')) != (url, size, validator):
+            state = None
+
+    if state is None:
+        segment_size = -(-size // max(segments, 1))
+        state = {
+            'url': url, 'size': size, 'validator': validator,
+            # [first byte, last byte, next byte to fetch]
+            'segments': [[start, min(start + segment_size, size) - 1, start] for start in range(0, size, segment_size)],
+        }
+        with open(path_to_file, 'wb') as fo:
+            fo.truncate(size)
+
+    lock = threading.Lock()
+    downloaded = [sum(segment[2] - segment[0] for segment in state['segments'])]
+    last_saved = [0.0]
+
+    def save_state(force=False):
+        # Called with lock held, throttled to once a second.
+        if force or time.monotonic() - last_saved[0] >= 1:
+            with open(f'{state_file}.tmp', 'w') as fo:
+                json.dump(state, fo)
+            os.replace(f'{state_file}.tmp', state_file)
+            last_saved[0] = time.monotonic()
+
+    def fetch(segment):
         attempt = 0
-        while attempt <= max_attempts:
-            attempt += 1
+        while segment[2] <= segment[1]:
+            headers = {**base_headers, 'Range': f'bytes={segment[2]}-{segment[1]}'}
+            if validator:
+                headers['If-Range'] = validator
+            started = segment[2]
+            try:
+                with session.get(url, stream=True, headers=headers, **requests_kwargs) as response:
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        raise ValueError(f'{url} ignored the Range request, responded {response.status_code}.')
+
+                    # bytes <first>-<last>/<size>, anything else would be written at the wrong offset.
+                    content_range = response.headers.get('Content-Range', '')
+                    match = re.match(r'bytes (\d+)-\d+/', content_range)
+                    if not match or int(match.group(1)) != segment[2]:
+                        raise ValueError(f'{url} responded with Content-Range {content_range!r} '
+                                         f'to a request for bytes {segment[2]}-{segment[1]}.')
+
+                    # Unbuffered so every byte recorded in the state file is already on disk.
+                    with open(path_to_file, 'r+b', buffering=0) as out_file:
+                        out_file.seek(segment[2])
+                        for chunk in response.iter_content(chunk_size):
+                            chunk = chunk[:segment[1] - segment[2] + 1]
+                            out_file.write(chunk)
+                            with lock:
+                                segment[2] += len(chunk)
+                                downloaded[0] += len(chunk)
+                                if progress:
+                                    progress(downloaded[0], size)
+                                save_state()
+                            if segment[2] > segment[1]:
+                                break
+            except requests.RequestException:
+                attempt += 1
+                if attempt > max_retries:
+                    raise
+            else:
+                if segment[2] != started:
+                    continue
+                # The response ended without any of the range, would otherwise be requested again forever.
+                attempt += 1
+                if attempt > max_retries:
+                    raise ValueError(f'{url} sent no data for bytes {segment[2]}-{segment[1]} in {attempt} attempts.')
+            time.sleep(min(2 ** attempt * 0.1, 5))
+
+    try:
+        pending = [segment for segment in state['segments'] if segment[2] <= segment[1]]
+        if pending:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(pending)) as executor:
+                for future in [executor.submit(fetch, segment) for segment in pending]:
+                    future.result()
+    except BaseException:
+        with lock:
+            save_state(force=True)
+        raise
+
+    if os.path.isfile(state_file):
+        os.remove(state_file)
+
+    if expected_hash:
+        _verify_download(path_to_file, expected_hash,
+                         next(iter(generate_file_hashes(path_to_file, algorithms=[hash_algorithm]).values())))
+
+
+def _verify_download(path_to_file, expected_hash, actual_hash):
+    if expected_hash and expected_hash.lower() != actual_hash:
+        os.remove(path_to_file)
+        raise ValueError(f'{path_to_file} hash {actual_hash} does not match the expected {expected_hash}.')
+
+
+class FileLock:
+    """ Advisory lock shared between processes and threads on a given path.
+
+    Uses fcntl.flock on Unix and msvcrt.locking on Windows. Acquiring retries
+    with exponential backoff starting at initial_wait seconds, capped at
+    max_wait, until timeout. The lock is re-entrant within the same thread.
+
+    The lock is held on a file in lock_dir named after a hash of the absolute
+    path, so nothing is left next to the protected file. Lock files are kept
+    after release, removing one could let two processes lock different files
+    for the same path. The default lock_dir is shared by every user so their
+    processes lock each other out too, like the temp folder it is created
+    with mode 1777 and lock files are readable and writable by everyone.
+
+    Examples::
+
+        with FileLock('/tmp/chromedriver.zip', timeout=60) as lock:
+            download_file(url, '/tmp/chromedriver.zip')
+            print(f'waited {lock.wait_time} seconds over {lock.attempts} attempts')
+
+    Args:
+        path: The file being protected
+        timeout: Seconds to keep trying before raising TimeoutError, None waits forever
+        initial_wait: Seconds to wait after the first failed attempt
+        max_wait: Longest single wait between attempts
+        lock_dir: Folder the lock files are held in, default is iarp_utils-locks in the temp folder
+
+    Raises:
+        NotImplementedError: If neither fcntl nor msvcrt is available on this platform.
+    """
+
+    _held = {}
+    _held_lock = threading.Lock()
+
+    def __init__(self, path, timeout=None, initial_wait=0.001, max_wait=1.0, lock_dir=None):
+        if fcntl is None and msvcrt is None:
+            raise NotImplementedError('FileLock requires fcntl or msvcrt, neither is available on this platform.')
+
+        self.path = os.path.abspath(path)
+        self.shared_lock_dir = lock_dir is None
+        self.lock_dir = lock_dir or os.path.join(tempfile.gettempdir(), 'iarp_utils-locks')
+        self.lock_file = os.path.join(
+            self.lock_dir, f'{hashlib.sha1(os.path.normcase(self.path).encode()).hexdigest()}.lock'
+        )
+        self.timeout = timeout
+        self.initial_wait = initial_wait
+        self.max_wait = max_wait
+
+        self.wait_time = 0.0
+        self.attempts = 0
+
+    def _open_lock_file(self):
+        if not os.path.isdir(self.lock_dir):
+            os.makedirs(self.lock_dir, exist_ok=True)
+            if self.shared_lock_dir:
+                # makedirs' mode is reduced by the umask, set it directly. Fails when another
+                # user created the folder at the same time, in which case they set it.
+                try:
+                    os.chmod(self.lock_dir, 0o1777)
+                except PermissionError:
+                    pass
+
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0), 0o666)
+        if hasattr(os, 'fchmod'):
+            # Same umask problem, only the user that created the lock file can change it.
+            try:
+                os.fchmod(fd, 0o666)
+            except PermissionError:
+                pass
+        return fd
+
+    @staticmethod
+    def _try_lock(fd):
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:  # pragma: no cover
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+        return True
+
+    @staticmethod
+    def _unlock(fd):
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        else:  # pragma: no cover
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+    def acquire(self):
+        with self._held_lock:
+            held = self._held.get(self.lock_file)
+            if held is not None and held[0] == threading.get_ident():
+                held[1] += 1
+                return self
+
+        started = time.monotonic()
+        wait = self.initial_wait
+        fd = self._open_lock_file()
+        try:
+            while True:
+                self.attempts += 1
+                if self._try_lock(fd):
+                    break
+
+                elapsed = time.monotonic() - started
+                if self.timeout is not None and elapsed >= self.timeout:
+                    raise TimeoutError(f'Could not lock {self.path} within {self.timeout} seconds.')
+                if self.timeout is not None:
+                    wait = min(wait, self.timeout - elapsed)
+                time.sleep(wait)
+                wait = min(wait * 2, self.max_wait)
+        except BaseException:
+            os.close(fd)
+            raise
+        finally:
+            self.wait_time += time.monotonic() - started
+
+        with self._held_lock:
+            self._held[self.lock_file] = [threading.get_ident(), 1, fd]
+        return self
+
+    def release(self):
+        with self._held_lock:
+            held = self._held[self.lock_file]
+            held[1] -= 1
+            if held[1]:
+                return
+            del self._held[self.lock_file]
+
+        self._unlock(held[2])
+        os.close(held[2])
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+def _extract__single_file(extractor, compressed_file, file_to_extract, destination,
+                          max_attempts=10, max_wait_in_seconds=30, log=None, timeout=None, initial_wait=0.01,
+                          **kwargs):
+    """ Extract one member, holding a FileLock on the archive while doing so.
+
+    PermissionError (something else has the destination open) is retried with
+    exponential backoff starting at initial_wait seconds and capped at
+    max_wait_in_seconds, until max_attempts or the timeout deadline is reached.
+
+    Returns:
+        dict describing the extraction:
+            extracted: True if the file was extracted, False if every attempt failed
+            attempts: How many times the extract was tried
+            lock_wait: Seconds spent waiting for the FileLock on the archive
+            retry_wait: Seconds spent sleeping between failed attempts
+    """
+    stats = {'extracted': False, 'attempts': 0, 'lock_wait': 0.0, 'retry_wait': 0.0}
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    with FileLock(compressed_file, timeout=timeout) as lock, extractor(compressed_file) as open_file:
+        stats['lock_wait'] = lock.wait_time
+
+        wait = initial_wait
+        while stats['attempts'] <= max_attempts:
+            stats['attempts'] += 1
 
             try:
                 open_file.extract(file_to_extract, destination, **kwargs)
+                stats['extracted'] = True
                 break
             except PermissionError:
                 if log:
-                    log.exception(f'{file_to_extract} to {destination} failed {attempt}/{max_attempts}.')
-                time.sleep(max_wait_in_seconds)
+                    log.exception(f'{file_to_extract} to {destination} failed {stats["attempts"]}/{max_attempts}.')
+
+                if deadline is not None:
+                    wait = min(wait, deadline - time.monotonic())
+                    if wait <= 0:
+                        break
+                time.sleep(wait)
+                stats['retry_wait'] += wait
+                wait = min(wait * 2, max_wait_in_seconds)
+
+    if log and (stats['lock_wait'] or stats['retry_wait']):
+        log.debug(f'{file_to_extract} from {compressed_file} waited {stats["lock_wait"]:.3f}s for the lock '
+                  f'and {stats["retry_wait"]:.3f}s between {stats["attempts"]} attempts.')
+    return stats
 
 
 def extract_zip_single_file(zip_file: str, file_to_extract: str, folder_to_extract_to: str, delete_zip_on_finish=True,
-                            max_attempts=10, max_wait_in_seconds=30, log=None, **kwargs):
+                            max_attempts=10, max_wait_in_seconds=30, log=None, timeout=None, **kwargs):
     """ Extracts a single file from a zip file.
 
     Examples:
@@ -100,27 +1078,36 @@ def extract_zip_single_file(zip_file: str, file_to_extract: str, folder_to_extra
         folder_to_extract_to: Where to extract the file to
         delete_zip_on_finish: Remove the zip when done?
         max_attempts: How many times do we try reading the zip file if something has a lock on it?
-        max_wait_in_seconds: How many seconds to we wait between attempts?
+        max_wait_in_seconds: Longest wait between attempts, waits start at 10ms and double
         log: If using logging, supply the logger here
+        timeout: Total seconds to spend waiting on the lock and retries, None for no limit
         **kwargs: passed into zipfile.extract, namely for passworded zip files
+
+    Returns:
+        dict describing the extraction:
+            extracted: True if the file was extracted, False if every attempt failed
+            attempts: How many times the extract was tried
+            lock_wait: Seconds spent waiting for the FileLock on the archive
+            retry_wait: Seconds spent sleeping between failed attempts
     """
-    # If another process happens to be running and is locked onto the zip file,
-    # it'll raise PermissionError. Retry every 30 seconds for 10 attempts.
-    _extract__single_file(
+    # Concurrent callers are serialised by a FileLock on the zip file. If another
+    # process still has the destination open it raises PermissionError, retry with backoff.
+    stats = _extract__single_file(
         extractor=ZipFileWithPermissions,
         compressed_file=zip_file,
         file_to_extract=file_to_extract,
         destination=folder_to_extract_to,
         max_attempts=max_attempts, max_wait_in_seconds=max_wait_in_seconds,
-        log=log,
+        log=log, timeout=timeout,
         **kwargs
     )
     if delete_zip_on_finish:
         os.remove(zip_file)
+    return stats
 
 
 def extract_tar_single_file(tar_file: str, file_to_extract: str, folder_to_extract_to: str, delete_tar_on_finish=True,
-                            max_attempts=10, max_wait_in_seconds=30, log=None, **kwargs):
+                            max_attempts=10, max_wait_in_seconds=30, log=None, timeout=None, **kwargs):
     """ Extracts a single file from a tar file.
 
     Examples:
@@ -141,26 +1128,441 @@ def extract_tar_single_file(tar_file: str, file_to_extract: str, folder_to_extra
         folder_to_extract_to: Where to extract the file to
         delete_tar_on_finish: Remove the tar when done?
         max_attempts: How many times do we try reading the tar file if something has a lock on it?
-        max_wait_in_seconds: How many seconds to we wait between attempts?
+        max_wait_in_seconds: Longest wait between attempts, waits start at 10ms and double
         log: If using logging, supply the logger here
+        timeout: Total seconds to spend waiting on the lock and retries, None for no limit
         **kwargs: passed into tarfile.extract, namely for passworded tar files
+
+    Returns:
+        dict describing the extraction:
+            extracted: True if the file was extracted, False if every attempt failed
+            attempts: How many times the extract was tried
+            lock_wait: Seconds spent waiting for the FileLock on the archive
+            retry_wait: Seconds spent sleeping between failed attempts
     """
-    # If another process happens to be running and is locked onto the zip file,
-    # it'll raise PermissionError. Retry every 30 seconds for 10 attempts.
-    _extract__single_file(
+    # Concurrent callers are serialised by a FileLock on the tar file. If another
+    # process still has the destination open it raises PermissionError, retry with backoff.
+    stats = _extract__single_file(
         extractor=tarfile.open,
         compressed_file=tar_file,
         file_to_extract=file_to_extract,
         destination=folder_to_extract_to,
         max_attempts=max_attempts, max_wait_in_seconds=max_wait_in_seconds,
-        log=log,
+        log=log, timeout=timeout,
         **kwargs
     )
     if delete_tar_on_finish:
         os.remove(tar_file)
+    return stats
+
+
+def _member_matcher(patterns):
+    if patterns is None:
+        return lambda name: True
+    if callable(patterns):
+        return patterns
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    patterns = list(patterns)
+    return lambda name: any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+
+
+def _zip_member_folder(destination, member):
+    # Same sanitising zipfile._extract_member applies to the members path.
+    arcname = member.filename.replace('/', os.path.sep)
+    if os.path.altsep:
+        arcname = arcname.replace(os.path.altsep, os.path.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    parts = [x for x in arcname.split(os.path.sep) if x not in ('', os.path.curdir, os.path.pardir)]
+    if member.is_dir():
+        return os.path.join(destination, *parts)
+    return os.path.join(destination, *parts[:-1])
+
+
+def extract_members(archive: str, patterns, destination: str, threads=None, pwd=None):
+    """ Extract every member of a zip or tar file that matches patterns in one pass.
+
+    The archive is opened once. Tar files (including .tar.gz and friends) are
+    read as a stream so compressed tars are only decompressed once. Zip
+    members keep their Unix permissions like ZipFileWithPermissions and can
+    be decompressed across threads, each thread with its own handle on the
+    zip since zlib releases the GIL.
+
+    Examples:
+
+        >>> extract_members('/tmp/drivers.zip', ['*/chromedriver', '*.dll'], '/etc/my-app')
+        ['/etc/my-app/chromedriver-linux64/chromedriver']
+
+        >>> extract_members('/tmp/reports.tar.gz', lambda name: name.endswith('.csv'), '/tmp/reports')
+
+        >>> extract_members('/tmp/reports.zip', '*.csv', '/tmp/reports', threads=4)
+
+    Args:
+        archive: Path to the zip or tar file
+        patterns: glob string, list of globs, or a function given the member name
+            returning whether to extract it. None extracts everything.
+        destination: Folder to extract to
+        threads: Zip only, how many threads decompress members at the same time
+        pwd: Zip only, password for the zip file
+
+    Returns:
+        list of extracted paths in archive order
+    """
+    matches = _member_matcher(patterns)
+
+    if not zipfile.is_zipfile(archive):
+        extracted = []
+        extract_kwargs = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+        with tarfile.open(archive, 'r|*') as open_file:
+            for member in open_file:
+                if matches(member.name):
+                    open_file.extract(member, destination, **extract_kwargs)
+                    extracted.append(os.path.join(destination, member.name))
+        return extracted
+
+    with ZipFileWithPermissions(archive) as open_file:
+        members = [member for member in open_file.infolist() if matches(member.filename)]
+
+        if not threads or threads < 2 or len(members) < 2:
+            return [open_file.extract(member, destination, pwd) for member in members]
+
+    # zipfile creates parent folders with an exists check, racing threads could collide.
+    for folder in {_zip_member_folder(destination, member) for member in members}:
+        os.makedirs(folder, exist_ok=True)
+
+    local = threading.local()
+    handles = []
+    lock = threading.Lock()
+
+    def extract(member):
+        if not hasattr(local, 'zip_file'):
+            local.zip_file = ZipFileWithPermissions(archive)
+            with lock:
+                handles.append(local.zip_file)
+        return local.zip_file.extract(member, destination, pwd)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            return list(executor.map(extract, members))
+    finally:
+        for handle in handles:
+            handle.close()
+
+
+ARCHIVE_BLOCK_SIZE = 1048576
+
+
+class _OrderedWriter:
+    """ Runs jobs across an executor but hands their results to write in the order they were submitted.
+
+    Plain callables queued with call run in this thread once everything queued
+    before them has been written. At most max_pending jobs are held at a time.
+    """
+
+    def __init__(self, executor, write, max_pending):
+        self.executor = executor
+        self.write = write
+        self.max_pending = max_pending
+        self.pending = collections.deque()
+
+    def submit(self, func, *args):
+        self.pending.append(self.executor.submit(func, *args))
+        self._drain(self.max_pending)
+
+    def call(self, func, *args):
+        self.pending.append(functools.partial(func, *args))
+        self._drain(self.max_pending)
+
+    def flush(self):
+        self._drain(0)
+
+    def _drain(self, limit):
+        while self.pending:
+            is_job = isinstance(self.pending[0], concurrent.futures.Future)
+            if is_job and len(self.pending) <= limit:
+                break
+            item = self.pending.popleft()
+            if is_job:
+                self.write(item.result())
+            else:
+                item()
+
+
+class _CompressingFile:
+    """ Write only file object handing every block_size bytes written to compress(block, last) on a writer.
+
+    Keeps the CRC32 and size of everything written for the gzip trailer.
+    """
+
+    def __init__(self, writer, compress, block_size):
+        self.writer = writer
+        self.compress = compress
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.crc = 0
+        self.size = 0
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self.writer.submit(self.compress, bytes(self.buffer[:self.block_size]), False)
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def close(self):
+        self.writer.submit(self.compress, bytes(self.buffer), True)
+        self.buffer.clear()
+
+
+def _deflate_block(data, level, last):
+    # Raw deflate blocks ended with a sync flush can be concatenated into one stream, the last one is finished.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def _archive_sources(sources):
+    if isinstance(sources, (str, bytes, os.PathLike)):
+        sources = [sources]
+    if isinstance(sources, dict):
+        return list(sources.items())
+    return [(source, os.path.basename(os.path.normpath(source))) for source in sources]
+
+
+def _walk_source(source, arcname):
+    yield source, arcname
+    if not os.path.isdir(source):
+        return
+    for folder, folders, filenames in os.walk(source):
+        folders.sort()
+        relative_folder = os.path.relpath(folder, source)
+        for name in folders + sorted(filenames):
+            yield os.path.join(folder, name), os.path.normpath(os.path.join(arcname, relative_folder, name))
+
+
+def _create_zip(sources, dest, level):
+    with zipfile.ZipFile(dest, 'w', zipfile.ZIP_DEFLATED, compresslevel=level) as archive:
+        for source, arcname in _archive_sources(sources):
+            for path, member_name in _walk_source(source, arcname):
+                # ZipFile.write streams the file, switches to zip64 when needed and keeps
+                # st_mode in external_attr, which ZipFileWithPermissions restores.
+                archive.write(path, member_name)
+
+
+def create_archive(sources, dest: str, format='zip', compresslevel=None, max_workers=None,
+                   block_size=ARCHIVE_BLOCK_SIZE):
+    """ Create a zip or tar file from files and folders, compressing tar.gz across threads.
+
+    For gztar the tar stream is cut into block_size blocks and each block is
+    deflated in a worker thread (zlib releases the GIL), blocks are written to
+    dest in order as they finish. Only a few blocks per worker are held in
+    memory no matter how large the files are. Blocks are ended with a sync
+    flush so the result is still a single ordinary gzip member, readable by
+    anything including tarfile's streaming mode.
+
+    bz2 and xz can not be split like that and are compressed on one thread
+    while the next blocks are read.
+
+    zip is always compressed on a single core: members are written with
+    zipfile.ZipFile.write on the calling thread, since zipfile has no public
+    way to add data that was deflated elsewhere. max_workers and block_size
+    are ignored for zip, use format='gztar' when compression speed matters.
+
+    Unix permissions are kept, zip files created here are restored with their
+    permissions by ZipFileWithPermissions.
+
+    Examples:
+
+        >>> create_archive(['/var/log/my-app', '/etc/my-app/config.ini'], '/backups/my-app.zip')
+        '/backups/my-app.zip'
+
+        >>> create_archive('/var/log/my-app', '/backups/logs.tar.gz', format='gztar', max_workers=8)
+        '/backups/logs.tar.gz'
+
+        # Choose the names inside the archive
+        >>> create_archive({'/var/log/my-app': 'logs/2021'}, '/backups/logs.tar', format='tar')
+
+    Args:
+        sources: Path, list of paths, or dict of path: name inside the archive.
+            Folders are added recursively under their own name.
+        dest: Path of the archive to create, it is removed again if creating fails
+        format: zip, tar, gztar, bztar or xztar
+        compresslevel: Compression level, default is the same as zipfile and tarfile use
+        max_workers: gztar compression thread count, default is the same as ThreadPoolExecutor.
+            Not used for zip, which is compressed on the calling thread.
+        block_size: How many bytes of the tar stream are compressed at a time
+
+    Returns:
+        dest
+    """
+    if format not in ('zip', 'tar', 'gztar', 'bztar', 'xztar'):
+        raise ValueError(f'Unknown archive format {format!r}, expected zip, tar, gztar, bztar or xztar')
+    if (format == 'bztar' and bz2 is None) or (format == 'xztar' and lzma is None):
+        raise ImportError(f'{format} requires the {format[:2]} module which this python was built without')
+
+    try:
+        if format == 'zip':
+            _create_zip(sources, dest, compresslevel)
+            return dest
+
+        if format == 'tar':
+            with tarfile.open(dest, 'w') as archive:
+                for source, arcname in _archive_sources(sources):
+                    archive.add(source, arcname)
+            return dest
+
+        if format == 'bztar':
+            compressor = bz2.BZ2Compressor(9 if compresslevel is None else compresslevel)
+        elif format == 'xztar':
+            compressor = lzma.LZMACompressor(preset=compresslevel)
+        elif max_workers is None:
+            max_workers = min(32, (os.cpu_count() or 1) + 4)
+
+        if format in ('bztar', 'xztar'):
+            # Neither can be split into independent blocks within one stream, compress on a
+            # single thread alongside the reading instead.
+            max_workers = 1
+
+            def compress(data, last):
+                return compressor.compress(data) + (compressor.flush() if last else b'')
+        else:
+            level = 9 if compresslevel is None else compresslevel
+
+            def compress(data, last):
+                return _deflate_block(data, level, last)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            with open(dest, 'wb') as opened_file:
+                writer = _OrderedWriter(executor, opened_file.write, max_workers * 2)
+                compressing_file = _CompressingFile(writer, compress, block_size)
+                if format == 'gztar':
+                    # One gzip member, so streaming readers like tarfile's r|gz can read it too.
+                    writer.call(opened_file.write, b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff')
+
+                with tarfile.open(fileobj=compressing_file, mode='w|') as archive:
+                    for source, arcname in _archive_sources(sources):
+                        archive.add(source, arcname)
+                compressing_file.close()
+
+                if format == 'gztar':
+                    writer.call(opened_file.write, struct.pack(
+                        '<II', compressing_file.crc, compressing_file.size & 0xFFFFFFFF
+                    ))
+                writer.flush()
+            return dest
+    except BaseException:
+        if os.path.exists(dest):
+            os.remove(dest)
+        raise
+
+
+def _reserve_file(path):
+    """ Atomically create path, returns False if it already exists. """
+    try:
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return False
+    return True
+
+
+class UniqueFileAllocator:
+    """ Hands out unique filenames in a folder, scanning the folder only once.
+
+    The next counter is one past the highest counter already in the folder, so
+    a folder with thousands of report_#.pdf files costs one os.scandir instead
+    of a stat per existing file. Each allocated file is created with
+    O_CREAT | O_EXCL, if another process took the name first the next counter
+    is tried, so two processes never get the same file.
+
+    Unlike unique_file_exists, gaps in the counters are not reused.
+
+    Examples:
+
+        >>> allocator = UniqueFileAllocator('/tmp/screenshots')
+        >>> allocator.allocate('screenshot', 'png')
+        '/tmp/screenshots/screenshot_1532.png'
+        >>> allocator.allocate('screenshot', 'png')
+        '/tmp/screenshots/screenshot_1533.png'
 
+    Args:
+        folder: Where the files are saved
+        filename_format: Format of the unique names, same as unique_file_exists
+
+    Raises:
+        ValueError: If filename_format does not contain {value}.
+    """
 
-def unique_file_exists(folder, filename, extension, filename_format="{filename}_{value}.{extension}", **kwargs):
+    def __init__(self, folder, filename_format="{filename}_{value}.{extension}"):
+        if 'value' not in {field for _, field, _, _ in string.Formatter().parse(filename_format)}:
+            raise ValueError(f'filename_format must contain {{value}}, got {filename_format!r}')
+
+        self.folder = folder
+        self.filename_format = filename_format
+        self._names = None
+        self._next_counter = {}
+
+    def refresh(self):
+        """ Forget the cached scan, the next allocation scans the folder again. """
+        self._names = None
+        self._next_counter = {}
+
+    def _pattern(self, filename, extension):
+        parts = []
+        for literal, field, _, _ in string.Formatter().parse(self.filename_format):
+            parts.append(re.escape(literal))
+            if field == 'filename':
+                parts.append(re.escape(filename))
+            elif field == 'extension':
+                parts.append(re.escape(extension))
+            elif field == 'value':
+                parts.append(r'(\d+)')
+        return re.compile(''.join(parts) + '$')
+
+    def allocate(self, filename, extension, reserve=True):
+        """ Returns a path for filename.extension that no other file in the folder uses.
+
+        Args:
+            filename: The name of the file without extension
+            extension: The extension
+            reserve: Create the (empty) file so nothing else can take the name.
+
+        Returns:
+            string containing valid filepath.
+        """
+        if self._names is None:
+            with os.scandir(self.folder) as entries:
+                self._names = {entry.name for entry in entries}
+
+        key = (filename, extension)
+        counter = self._next_counter.get(key)
+
+        if counter is None:
+            counter = 1 + max((
+                int(m.group(1)) for m in map(self._pattern(filename, extension).match, self._names) if m
+            ), default=0)
+
+            name = f"{filename}.{extension}"
+            path = os.path.join(self.folder, name)
+            if name not in self._names and (not reserve or _reserve_file(path)):
+                self._names.add(name)
+                self._next_counter[key] = counter
+                return path
+
+        while True:
+            name = self.filename_format.format(filename=filename, value=counter, extension=extension)
+            counter += 1
+            path = os.path.join(self.folder, name)
+            if name in self._names:
+                continue
+            if not reserve or _reserve_file(path):
+                self._names.add(name)
+                self._next_counter[key] = counter
+                return path
+
+
+def unique_file_exists(folder, filename, extension, filename_format="{filename}_{value}.{extension}", reserve=False,
+                       **kwargs):
     """ Ensures the file path given does not exist, returns a path to a file that does not exist.
 
     Example of a matching filename: test_#.pdf where # is however many iterations
@@ -188,6 +1590,9 @@ def unique_file_exists(folder, filename, extension, filename_format="{filename}_
         filename: The name of the file without extension
         extension: The extension
         filename_format: If the file exists, this is the format for the new name.
+        reserve: Atomically create the (empty) file so no other process can take the name.
+            With the counter this uses UniqueFileAllocator, which scans the folder
+            once and continues past the highest counter instead of filling gaps.
 
         kwargs:
             use_counter: Whether or not to use the # in the generated filename when a file exists
@@ -205,8 +1610,16 @@ def unique_file_exists(folder, filename, extension, filename_format="{filename}_
             return counter
         return generator(length=length)
 
+    if reserve and kwargs.get('use_counter', True):
+        return UniqueFileAllocator(folder, filename_format).allocate(filename, extension)
+
+    def is_available(file_path):
+        if reserve:
+            return _reserve_file(file_path)
+        return not os.path.isfile(file_path)
+
     path = os.path.join(folder, f"{filename}.{extension}")
-    if not os.path.isfile(path):
+    if is_available(path):
         return path
 
     counter = 0
@@ -220,7 +1633,7 @@ def unique_file_exists(folder, filename, extension, filename_format="{filename}_
         )
 
         path = os.path.join(folder, new_filename)
-        if not os.path.isfile(path):
+        if is_available(path):
             return path
 
 
@@ -246,10 +1659,13 @@ def wait_for_downloaded_file(glob_path, read_mode="rb", checks=10, max_wait_in_s
     """
     for c in range(checks + 1):
 
-        time.sleep(max_wait_in_seconds)
-
         try:
-            if [open(file, read_mode) for file in glob.glob(glob_path)]:
+            files = glob.glob(glob_path)
+            for file in files:
+                # Opening fails while the browser still has a lock on it.
+                with open(file, read_mode):
+                    pass
+            if files:
                 return True
         except IOError:
 
@@ -257,15 +1673,250 @@ def wait_for_downloaded_file(glob_path, read_mode="rb", checks=10, max_wait_in_s
             if c == checks:
                 raise
 
+        if c < checks:
+            time.sleep(max_wait_in_seconds)
+
     return False
 
 
+PARTIAL_DOWNLOAD_SUFFIXES = ('.part', '.crdownload', '.download', '.partial', '.tmp')
+
+# inotify_add_watch mask: IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+_INOTIFY_MASK = 0x002 | 0x004 | 0x008 | 0x040 | 0x080 | 0x100 | 0x200
+
+
+class _DirectoryWatcher:
+    """ Blocks until something changes in a folder, or a timeout passes.
+
+    Uses inotify through ctypes on Linux, otherwise polls with an interval that
+    starts short and grows while nothing is happening.
+    """
+
+    def __init__(self, folder, use_inotify=None, min_interval=0.05, max_interval=1.0):
+        self.fd = None
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+
+        if use_inotify is None:
+            use_inotify = sys.platform.startswith('linux')
+        if use_inotify:
+            self.fd = self._inotify_watch(folder)
+
+    @staticmethod
+    def _inotify_watch(folder):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            return None
+
+        # IN_NONBLOCK | IN_CLOEXEC
+        fd = libc.inotify_init1(os.O_NONBLOCK | 0o2000000)
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, os.fsencode(folder), _INOTIFY_MASK) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def wait(self, timeout):
+        if self.fd is None:
+            time.sleep(min(timeout, self.interval))
+            self.interval = min(self.interval * 2, self.max_interval)
+            return
+
+        if select.select([self.fd], [], [], timeout)[0]:
+            # The events themselves don't matter, only that something changed.
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def changed(self):
+        self.interval = self.min_interval
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def wait_for_downloads(glob_path, timeout=60, stable_for=0.5, partial_suffixes=PARTIAL_DOWNLOAD_SUFFIXES,
+                       read_mode='rb', use_inotify=None):
+    """ Waits for browser downloads matching glob_path to finish and returns them.
+
+    The folder is watched with inotify on Linux so the check happens as soon
+    as a download finishes, elsewhere it is polled at short intervals that grow
+    while nothing changes. A file is finished once no partial download
+    (file.pdf.part, file.pdf.crdownload, ...) exists for it, its size has not
+    changed for stable_for seconds and it can be opened.
+
+    Examples:
+
+        >>> wait_for_downloads('/tmp/downloads/*.pdf', timeout=30)
+        ['/tmp/downloads/report.pdf']
+
+    Args:
+        glob_path: Path to check... C:/Apps/*.pdf
+        timeout: Seconds to wait before giving up
+        stable_for: Seconds a files size must stay the same
+        partial_suffixes: Suffixes browsers add to downloads in progress
+        read_mode: Mode used to test the file can be opened
+        use_inotify: Force inotify on or off, default is on for Linux
+
+    Returns:
+        sorted list of finished paths, empty if nothing finished in time. If some
+        finished but others were still in progress at the timeout, the finished ones.
+    """
+    deadline = time.monotonic() + timeout
+    watcher = _DirectoryWatcher(os.path.dirname(glob_path) or '.', use_inotify=use_inotify)
+    sizes = {}
+
+    try:
+        while True:
+            now = time.monotonic()
+            finished, pending = [], False
+
+            paths = glob.glob(glob_path)
+            for suffix in partial_suffixes:
+                if glob.glob(glob_path + suffix):
+                    pending = True
+
+            for path in paths:
+                if path.endswith(partial_suffixes):
+                    continue
+                if any(os.path.exists(path + suffix) for suffix in partial_suffixes):
+                    pending = True
+                    continue
+
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    pending = True
+                    continue
+
+                if sizes.get(path, (None,))[0] != size:
+                    sizes[path] = (size, now)
+                    watcher.changed()
+                if now - sizes[path][1] < stable_for:
+                    pending = True
+                    continue
+
+                try:
+                    with open(path, read_mode):
+                        pass
+                except OSError:
+                    pending = True
+                    continue
+
+                finished.append(path)
+
+            if (finished and not pending) or now >= deadline:
+                return sorted(finished)
+
+            wait = deadline - now
+            if pending:
+                wait = min(wait, stable_for)
+            watcher.wait(max(wait, 0))
+    finally:
+        watcher.close()
+
+
 def get_mime_types_as_str(joiner=','):
     """ Returns comma separated list of mime types for use in browser downloads.
 
     List from https://www.freeformatter.com/mime-types-list.html
     """
-    return joiner.join(MIME_TYPES_LIST)
+    return get_mime_registry().joined(joiner)
+
+
+_MIME_TYPE_RE = re.compile(r'[\w.+-]+/[\w.+-]+')
+
+
+class MimeTypeRegistry:
+    """ Indexed, de-duplicated view over a list of mime types.
+
+    Entries are cleaned up on the way in: anything after the first comma is
+    dropped, the rest is stripped and lowercased, and entries that still
+    aren't a single type/subtype (for example ones with inner whitespace or
+    ;parameters) are skipped, so the joined strings are always valid for
+    browser preferences.
+
+    Examples:
+
+        >>> registry = get_mime_registry()
+        >>> 'application/zip' in registry
+        True
+        >>> registry.by_type('audio')[:2]
+        ('audio/adpcm', 'audio/basic')
+        >>> registry.by_extension('.xlsx')
+        ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',)
+        >>> registry.joined(';')
+        'application/andrew-inset;application/applixware;...'
+
+    Args:
+        mime_types: iterable of mime type strings
+    """
+
+    def __init__(self, mime_types):
+        cleaned = {}
+        for mime_type in mime_types:
+            mime_type = mime_type.split(',', 1)[0].strip().lower()
+            if _MIME_TYPE_RE.fullmatch(mime_type):
+                cleaned.setdefault(mime_type, None)
+
+        self.mime_types = tuple(cleaned)
+        self._members = frozenset(self.mime_types)
+        self._joined = {}
+        self._by_extension = None
+
+        by_type = collections.defaultdict(list)
+        for mime_type in self.mime_types:
+            by_type[mime_type.split('/', 1)[0]].append(mime_type)
+        self._by_type = {top_level: tuple(values) for top_level, values in by_type.items()}
+
+    def __contains__(self, mime_type):
+        return mime_type in self._members
+
+    def __iter__(self):
+        return iter(self.mime_types)
+
+    def __len__(self):
+        return len(self.mime_types)
+
+    def joined(self, joiner=','):
+        """ All mime types joined by joiner, built once per joiner. """
+        try:
+            return self._joined[joiner]
+        except KeyError:
+            return self._joined.setdefault(joiner, joiner.join(self.mime_types))
+
+    def by_type(self, top_level):
+        """ Mime types of a top level type such as 'image', in registry order. """
+        return self._by_type.get(top_level.lower(), ())
+
+    def by_extension(self, extension):
+        """ Registry mime types used for a file extension according to the mimetypes module. """
+        if self._by_extension is None:
+            by_extension = collections.defaultdict(list)
+            if not mimetypes.inited:
+                mimetypes.init()
+            for types_map in (mimetypes.types_map, mimetypes.common_types):
+                for ext, mime_type in types_map.items():
+                    if mime_type in self._members and mime_type not in by_extension[ext]:
+                        by_extension[ext].append(mime_type)
+            self._by_extension = {ext: tuple(values) for ext, values in by_extension.items()}
+
+        extension = extension.lower()
+        if not extension.startswith('.'):
+            extension = f'.{extension}'
+        return self._by_extension.get(extension, ())
+
+
+@functools.lru_cache(maxsize=None)
+def get_mime_registry():
+    """ The MimeTypeRegistry for MIME_TYPES_LIST, built on first use. """
+    return MimeTypeRegistry(MIME_TYPES_LIST)
 
 
 MIME_TYPES_LIST = [
@@ -274,7 +1925,7 @@ MIME_TYPES_LIST = [
     "application/atom+xml",
     "application/atomcat+xml",
     "application/atomsvc+xml",
-    "application/ccxml+xml,",
+    "application/ccxml+xml",
     "application/cdmi-capability",
     "application/cdmi-container",
     "application/cdmi-domain",
@@ -924,7 +2575,7 @@ MIME_TYPES_LIST = [
     "text/x-asm",
     "text/x-c",
     "text/x-fortran",
-    "text/x-java-source,java",
+    "text/x-java-source",
     "text/x-pascal",
     "text/x-setext",
     "text/x-uuencode",
@@ -17,6 +17,7 @@ setup(
         'MySQL': ['mysql-connector-python'],
         'tools': ['psutil'],
         'images': ['pillow'],
+        'crontabs': ['numpy'],
     },
     zip_safe=False
 )
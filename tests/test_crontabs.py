@@ -1,3 +1,5 @@
+import concurrent.futures
+import datetime
 import unittest
 
 from iarp_utils.crontabs import *
@@ -269,3 +271,352 @@ class CrontabParserTests(unittest.TestCase):
         self.assertEqual('50 16 * * *', output[5])
         self.assertEqual('0 17 * * *', output[6])
         self.assertEqual('10 17 * * *', output[7])
+
+
+class CompiledCrontabTests(unittest.TestCase):
+
+    def test_compile_crontab_is_cached(self):
+        self.assertIs(compile_crontab('*/10 * * * *'), compile_crontab('*/10 * * * *'))
+        self.assertIsNot(compile_crontab('*/10 * * * *'), compile_crontab('*/20 * * * *'))
+
+    def test_matches_agrees_with_parse(self):
+        crontab = '*/15 8-17 * * 1-5'
+        minutes, hours, days_of_month, months_of_year, day_of_week = parse(crontab)
+        compiled = compile_crontab(crontab)
+
+        now = datetime.datetime(2023, 6, 16, 0, 0)
+        for _ in range(60 * 24 * 3):
+            expected = (
+                now.minute in minutes and now.hour in hours and now.day in days_of_month
+                and isoweekday_sunday_zero(now.isoweekday()) in day_of_week and now.month in months_of_year
+            )
+            self.assertEqual(expected, compiled.matches(now), now)
+            now += datetime.timedelta(minutes=1)
+
+    def test_is_active_now(self):
+        self.assertTrue(is_active_now('30 8 * * 1-5', datetime.datetime(2023, 6, 19, 8, 30, 45)))
+        self.assertIsNone(is_active_now('30 8 * * 1-5', datetime.datetime(2023, 6, 18, 8, 30)))
+
+    def test_next_after(self):
+        compiled = compile_crontab('30 8 * * 1-5')
+        self.assertEqual(datetime.datetime(2023, 6, 19, 8, 30), compiled.next_after(datetime.datetime(2023, 6, 16, 9)))
+        self.assertEqual(datetime.datetime(2023, 6, 20, 8, 30),
+                         compiled.next_after(datetime.datetime(2023, 6, 19, 8, 30)))
+        self.assertEqual(datetime.datetime(2023, 6, 19, 8, 30),
+                         compiled.next_after(datetime.datetime(2023, 6, 19, 8, 29, 59)))
+
+    def test_next_after_rolls_over_years(self):
+        compiled = compile_crontab('0 0 29 2 *')
+        self.assertEqual(datetime.datetime(2024, 2, 29), compiled.next_after(datetime.datetime(2021, 3, 1)))
+
+        compiled = compile_crontab('59 23 31 12 *')
+        self.assertEqual(datetime.datetime(2023, 12, 31, 23, 59), compiled.next_after(datetime.datetime(2023, 1, 1)))
+
+    def test_previous_before(self):
+        compiled = compile_crontab('30 8 * * 1-5')
+        self.assertEqual(datetime.datetime(2023, 6, 16, 8, 30),
+                         compiled.previous_before(datetime.datetime(2023, 6, 19, 8, 30)))
+        self.assertEqual(datetime.datetime(2023, 6, 19, 8, 30),
+                         compiled.previous_before(datetime.datetime(2023, 6, 19, 8, 30, 1)))
+
+        compiled = compile_crontab('0 0 29 2 *')
+        self.assertEqual(datetime.datetime(2020, 2, 29), compiled.previous_before(datetime.datetime(2024, 2, 28)))
+
+    def test_never_matching_crontab_returns_none(self):
+        compiled = compile_crontab('0 0 31 2 *')
+        self.assertIsNone(compiled.next_after(datetime.datetime(2023, 1, 1)))
+        self.assertIsNone(compiled.previous_before(datetime.datetime(2023, 1, 1)))
+
+    def test_next_after_keeps_tzinfo(self):
+        now = datetime.datetime(2023, 6, 19, 8, 0, tzinfo=datetime.timezone.utc)
+        self.assertEqual(datetime.timezone.utc, compile_crontab('*/10 * * * *').next_after(now).tzinfo)
+
+    def test_calculate_schedule(self):
+        output = calculate_schedule('0 8,16 * * *', now=datetime.datetime(2023, 6, 19, 12, 34))
+        self.assertEqual([datetime.datetime(2023, 6, 19, 8), datetime.datetime(2023, 6, 19, 16)], output)
+
+        output = calculate_schedule('0 8 1,15 * *', check_month=True, now=datetime.datetime(2023, 6, 19))
+        self.assertEqual([datetime.datetime(2023, 6, 1, 8), datetime.datetime(2023, 6, 15, 8)], output)
+
+    def test_calculate_schedule_only_returns_period_steps(self):
+        output = calculate_schedule('5,10 8 * * *', now=datetime.datetime(2023, 6, 19))
+        self.assertEqual([datetime.datetime(2023, 6, 19, 8, 10)], output)
+
+        output = calculate_schedule('5,10 8 * * *', period=5, now=datetime.datetime(2023, 6, 19))
+        self.assertEqual([datetime.datetime(2023, 6, 19, 8, 5), datetime.datetime(2023, 6, 19, 8, 10)], output)
+
+
+class IterScheduleTests(unittest.TestCase):
+
+    def test_iter_schedule_is_lazy(self):
+        output = iter_schedule('* * * * *', datetime.datetime(2023, 1, 1), datetime.datetime(2123, 1, 1))
+        self.assertEqual(datetime.datetime(2023, 1, 1), next(output))
+        self.assertEqual(datetime.datetime(2023, 1, 1, 0, 1), next(output))
+
+    def test_iter_schedule_window_is_half_open(self):
+        output = list(iter_schedule('0 * * * *', datetime.datetime(2023, 1, 1, 1), datetime.datetime(2023, 1, 1, 4)))
+        self.assertEqual([
+            datetime.datetime(2023, 1, 1, 1),
+            datetime.datetime(2023, 1, 1, 2),
+            datetime.datetime(2023, 1, 1, 3),
+        ], output)
+
+    def test_iter_schedule_rounds_start_up(self):
+        start = datetime.datetime(2023, 1, 1, 1, 0, 1)
+        output = list(iter_schedule('0 * * * *', start, datetime.datetime(2023, 1, 1, 3)))
+        self.assertEqual([datetime.datetime(2023, 1, 1, 2)], output)
+
+    def test_iter_schedule_year_long(self):
+        output = list(iter_schedule('0 0 29 2 *', datetime.datetime(2020, 1, 1), datetime.datetime(2030, 1, 1)))
+        self.assertEqual([
+            datetime.datetime(2020, 2, 29),
+            datetime.datetime(2024, 2, 29),
+            datetime.datetime(2028, 2, 29),
+        ], output)
+
+        output = list(iter_schedule('30 9 * * 1-5', datetime.datetime(2023, 1, 1), datetime.datetime(2024, 1, 1)))
+        self.assertEqual(260, len(output))
+
+    def test_iter_schedule_agrees_with_is_active_now(self):
+        crontab = '*/20 6-8 1-10 * 1,3'
+        start = datetime.datetime(2023, 1, 1)
+        end = datetime.datetime(2023, 3, 1)
+
+        expected = []
+        now = start
+        while now < end:
+            if is_active_now(crontab, now):
+                expected.append(now)
+            now += datetime.timedelta(minutes=1)
+
+        self.assertEqual(expected, list(iter_schedule(crontab, start, end)))
+
+
+class CrontabIndexTests(unittest.TestCase):
+
+    def test_active_at(self):
+        index = CrontabIndex([('backup', '0 2 * * *'), ('report', '30 8 * * 1-5'), ('cleanup', '0 2 * * *')])
+        self.assertEqual(3, len(index))
+        self.assertEqual({'backup', 'cleanup'}, index.active_at(datetime.datetime(2023, 6, 19, 2, 0)))
+        self.assertEqual({'report'}, index.active_at(datetime.datetime(2023, 6, 19, 8, 30)))
+        self.assertEqual(set(), index.active_at(datetime.datetime(2023, 6, 18, 8, 30)))
+
+    def test_accepts_dict(self):
+        index = CrontabIndex({'backup': '0 2 * * *'})
+        self.assertIn('backup', index)
+        self.assertEqual('0 2 * * *', index.get('backup'))
+
+    def test_duplicate_crontabs_stored_once(self):
+        index = CrontabIndex((f'job{x}', '0 2 * * *') for x in range(100))
+        self.assertEqual({'0 2 * * *'}, index.active_crontabs_at(datetime.datetime(2023, 6, 19, 2, 0)))
+        self.assertEqual(100, len(index.active_at(datetime.datetime(2023, 6, 19, 2, 0))))
+
+    def test_add_replaces_and_remove(self):
+        index = CrontabIndex()
+        index.add('job', '0 2 * * *')
+        index.add('job', '0 3 * * *')
+        self.assertEqual(set(), index.active_at(datetime.datetime(2023, 6, 19, 2, 0)))
+        self.assertEqual({'job'}, index.active_at(datetime.datetime(2023, 6, 19, 3, 0)))
+
+        index.remove('job')
+        self.assertNotIn('job', index)
+        self.assertEqual(set(), index.active_at(datetime.datetime(2023, 6, 19, 3, 0)))
+        self.assertTrue(all(not field for field in index._fields))
+
+        with self.assertRaises(KeyError):
+            index.remove('job')
+
+    def test_add_invalid_crontab_keeps_existing(self):
+        index = CrontabIndex({'job': '0 2 * * *'})
+        with self.assertRaises(ValueError):
+            index.add('job', '0 25 * * *')
+        self.assertEqual('0 2 * * *', index.get('job'))
+        self.assertEqual({'job'}, index.active_at(datetime.datetime(2023, 6, 19, 2, 0)))
+
+    def test_agrees_with_is_active_now(self):
+        crontabs = generate_selection_daily_crontabs(length=30) + generate_selection_monthly_crontabs(length=30)
+        crontabs += [generate_weekly() for _ in range(30)] + [generate_every_other_day() for _ in range(30)]
+        index = CrontabIndex(enumerate(crontabs))
+
+        now = datetime.datetime(2023, 6, 1)
+        while now < datetime.datetime(2023, 6, 15):
+            expected = {key for key, crontab in enumerate(crontabs) if is_active_now(crontab, now)}
+            self.assertEqual(expected, index.active_at(now), now)
+            now += datetime.timedelta(minutes=10)
+
+
+class CrontabSlotAllocatorTests(unittest.TestCase):
+
+    def test_allocate_avoids_existing_slots(self):
+        existing = generate_selection_daily_crontabs(length=6, hour=8)
+        allocator = CrontabSlotAllocator(existing=existing, capacity=1)
+        output = allocator.allocate('daily', count=10)
+
+        self.assertEqual(10, len(set(output)))
+        self.assertFalse(set(output) & set(existing))
+        self.assertEqual(1, allocator.peak())
+
+    def test_allocate_spreads_load_evenly(self):
+        allocator = CrontabSlotAllocator(minutes=[0, 30], hours=[8, 9])
+        allocator.allocate('weekly', count=7 * 2 * 2 * 2)
+        self.assertEqual(2, allocator.peak())
+        self.assertEqual({2}, set(allocator.histogram().values()))
+
+    def test_allocate_raises_when_full(self):
+        allocator = CrontabSlotAllocator(capacity=1, minutes=[0], hours=[8])
+        self.assertEqual(['0 8 * * *'], allocator.allocate('daily'))
+        with self.assertRaisesRegex(ValueError, 'capacity'):
+            allocator.allocate('weekly')
+
+    def test_allocate_unknown_kind(self):
+        with self.assertRaisesRegex(ValueError, 'Unknown crontab kind'):
+            CrontabSlotAllocator().allocate('hourly')
+
+    def test_allocate_kinds_produce_valid_crontabs(self):
+        allocator = CrontabSlotAllocator()
+        for kind in CrontabSlotAllocator.KINDS:
+            for crontab in allocator.allocate(kind, count=3):
+                parse(crontab)
+                self.assertTrue(validate_crontab_values(minute=int(crontab.split(' ')[0])))
+
+    def test_allocate_balances_months(self):
+        allocator = CrontabSlotAllocator(existing=['0 8 1 1 *', '0 8 1 2 *'])
+        self.assertEqual('3', allocator.allocate('yearly')[0].split(' ')[3])
+        self.assertEqual('4,10', allocator.allocate('biyearly')[0].split(' ')[3])
+
+    def test_histogram(self):
+        allocator = CrontabSlotAllocator(existing=['0 8 * * 1', '0 8 * * 1-5'])
+        histogram = allocator.histogram()
+        self.assertEqual(2, histogram[datetime.datetime(2021, 2, 1, 8)])
+        self.assertEqual(1, histogram[datetime.datetime(2021, 2, 2, 8)])
+        self.assertEqual(4 * 2 + 4 * 4, sum(histogram.values()))
+        self.assertEqual(2, allocator.peak())
+
+
+class OccupancyMatrixTests(unittest.TestCase):
+
+    crontabs = [
+        '0 8 * * *', '0 8 * * 1-5', '*/15 9 * * *', '30 12 1,15 * *', '0 0 29 2 *', '*/7 3-5 1-7 * mon',
+    ] + generate_selection_daily_crontabs(length=10)
+
+    def expected(self, start, days):
+        expected = [[0] * 1440 for _ in range(days)]
+        for crontab in self.crontabs:
+            for timestamp in iter_schedule(crontab, start, start + datetime.timedelta(days=days)):
+                expected[(timestamp - start).days][timestamp.hour * 60 + timestamp.minute] += 1
+        return expected
+
+    def test_occupancy_matrix_python(self):
+        start = datetime.datetime(2024, 2, 1)
+        output = occupancy_matrix(self.crontabs, start, days=45, use_numpy=False)
+        self.assertEqual(self.expected(start, 45), [list(row) for row in output])
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_occupancy_matrix_numpy(self):
+        start = datetime.datetime(2024, 2, 1)
+        output = occupancy_matrix(self.crontabs, start, days=45, use_numpy=True)
+        self.assertEqual((45, 1440), output.shape)
+        self.assertEqual(self.expected(start, 45), output.tolist())
+
+    def test_occupancy_matrix_buckets(self):
+        output = occupancy_matrix(['0 8 * * *', '0 8 * * 1-5', '30 8 * * *'], datetime.date(2021, 2, 1),
+                                  days=7, bucket=60, use_numpy=False)
+        self.assertEqual(24, len(output[0]))
+        self.assertEqual(3, output[0][8])
+        self.assertEqual(2, output[6][8])
+        self.assertEqual(0, output[0][9])
+
+    def test_occupancy_matrix_counts_duplicates(self):
+        output = occupancy_matrix(['0 8 * * *'] * 3, datetime.date(2021, 2, 1), days=1, use_numpy=False)
+        self.assertEqual(3, output[0][8 * 60])
+
+    def test_occupancy_matrix_invalid_bucket(self):
+        with self.assertRaisesRegex(ValueError, 'bucket'):
+            occupancy_matrix(['0 8 * * *'], datetime.date(2021, 2, 1), days=1, bucket=7)
+
+
+class CronSchedulerTests(unittest.TestCase):
+
+    def test_register_as_decorator(self):
+        scheduler = CronScheduler(clock=lambda: datetime.datetime(2023, 6, 19, 10, 0, 30))
+
+        @scheduler.register('*/10 * * * *')
+        def job():
+            pass
+
+        self.assertIn('job', scheduler.jobs)
+        self.assertEqual(datetime.datetime(2023, 6, 19, 10, 10), scheduler.jobs['job'].next_run)
+
+        scheduler.unregister('job')
+        self.assertNotIn('job', scheduler.jobs)
+
+    def test_due_jobs_reports_missed_and_late(self):
+        missed, late = [], []
+        scheduler = CronScheduler(
+            clock=lambda: datetime.datetime(2023, 6, 19, 10, 0, 30),
+            on_missed=lambda job, fire_time: missed.append(fire_time),
+            on_late=lambda job, fire_time, seconds: late.append((fire_time, seconds)),
+        )
+        job = scheduler.register('*/10 * * * *', print, name='job')
+
+        self.assertEqual([], scheduler.due_jobs(datetime.datetime(2023, 6, 19, 10, 5)))
+
+        with self.assertLogs('iarp_utils.crontabs', 'WARNING'):
+            due = scheduler.due_jobs(datetime.datetime(2023, 6, 19, 10, 35))
+        self.assertEqual([(job, datetime.datetime(2023, 6, 19, 10, 30))], due)
+        self.assertEqual([datetime.datetime(2023, 6, 19, 10, 10), datetime.datetime(2023, 6, 19, 10, 20)], missed)
+        self.assertEqual([(datetime.datetime(2023, 6, 19, 10, 30), 300)], late)
+        self.assertEqual((2, 1), (job.missed, job.late))
+        self.assertEqual(datetime.datetime(2023, 6, 19, 10, 40), job.next_run)
+
+    def test_due_jobs_skips_job_still_running(self):
+        scheduler = CronScheduler(clock=lambda: datetime.datetime(2023, 6, 19, 10, 0, 30))
+        job = scheduler.register('*/10 * * * *', print)
+        job.running = concurrent.futures.Future()
+
+        with self.assertLogs('iarp_utils.crontabs', 'WARNING'):
+            self.assertEqual([], scheduler.due_jobs(datetime.datetime(2023, 6, 19, 10, 10)))
+        self.assertEqual(1, job.missed)
+
+    def test_run_fires_at_the_next_minute(self):
+        # Shift the clock so the next minute starts in a fraction of a second.
+        real_now = datetime.datetime.now()
+        offset = real_now.replace(second=59, microsecond=800000) - real_now
+
+        def clock():
+            return datetime.datetime.now() + offset
+
+        calls = []
+
+        async def coroutine_job():
+            calls.append('coroutine')
+
+        scheduler = CronScheduler(max_workers=2, clock=clock)
+        scheduler.register('* * * * *', calls.append, 'thread')
+        scheduler.register('* * * * *', coroutine_job)
+
+        self.assertTrue(scheduler.start(until=clock() + datetime.timedelta(seconds=0.6)))
+        self.assertEqual(['coroutine', 'thread'], sorted(calls))
+        self.assertEqual(1, scheduler.jobs['append'].runs)
+        self.assertEqual(0, scheduler.jobs['append'].missed)
+
+    def test_run_counts_failures(self):
+        real_now = datetime.datetime.now()
+        offset = real_now.replace(second=59, microsecond=800000) - real_now
+
+        def clock():
+            return datetime.datetime.now() + offset
+
+        scheduler = CronScheduler(clock=clock)
+        job = scheduler.register('* * * * *', int, 'not a number')
+
+        with self.assertLogs('iarp_utils.crontabs', 'ERROR'):
+            scheduler.start(until=clock() + datetime.timedelta(seconds=0.6))
+        self.assertEqual((1, 1), (job.runs, job.failed))
+
+    def test_run_respects_pid_file(self):
+        scheduler = CronScheduler(pid_file_name='cron_scheduler_test')
+        with PIDFile('cron_scheduler_test') as good:
+            self.assertTrue(good)
+            with self.assertLogs('iarp_utils.crontabs', 'WARNING'):
+                self.assertFalse(scheduler.start(until=datetime.datetime.now()))
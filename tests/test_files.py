@@ -1,9 +1,31 @@
+import collections
+import concurrent.futures
 import mock
 import hashlib
+import http.server
+import io
+import json
 import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import time
 import unittest
+import zipfile
+import zlib
 
-from iarp_utils.files import unique_file_exists, get_mime_types_as_str, MIME_TYPES_LIST, generate_file_hash
+import requests
+
+from iarp_utils.files import (
+    unique_file_exists, get_mime_types_as_str, MIME_TYPES_LIST, generate_file_hash, generate_file_hashes, hash_files,
+    FileHashCache, download_file_ranged, download_many, download_file,
+    extract_members, extract_zip_single_file, FileLock, ZipFileWithPermissions,
+    wait_for_downloads, wait_for_downloaded_file, UniqueFileAllocator,
+    MimeTypeRegistry, get_mime_registry, find_duplicates, deduplicate_files,
+    generate_file_hashes_mmap, files_equal, create_archive,
+)
 from tests import BASE_DIR
 
 
@@ -74,3 +96,926 @@ class FilesTests(unittest.TestCase):
             with open('gen_hash_test_file.txt') as fo:
                 result = generate_file_hash(fo, func=hashlib.sha1)
             self.assertEqual('7e240de74fb1ed08fa08d38063f6a6a91462a815', result)
+
+
+class FileHashesTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.paths = []
+        for x in range(5):
+            path = os.path.join(self.tmp.name, f'{x}.bin')
+            with open(path, 'wb') as fo:
+                fo.write(os.urandom(1000 * x + 7))
+            self.paths.append(path)
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def expected(self, path, name):
+        with open(path, 'rb') as fo:
+            return hashlib.new(name, fo.read()).hexdigest()
+
+    def test_generate_file_hashes_from_path(self):
+        output = generate_file_hashes(self.paths[3], chunk_size=1024)
+        self.assertEqual({'md5', 'sha256'}, set(output))
+        self.assertEqual(self.expected(self.paths[3], 'md5'), output['md5'])
+        self.assertEqual(self.expected(self.paths[3], 'sha256'), output['sha256'])
+
+    def test_generate_file_hashes_from_opened_file(self):
+        with open(self.paths[4], 'rb') as fo:
+            fo.read(10)
+            output = generate_file_hashes(fo, algorithms=[hashlib.sha1, 'md5'])
+            self.assertEqual(0, fo.tell())
+        self.assertEqual(self.expected(self.paths[4], 'sha1'), output['sha1'])
+        self.assertEqual(self.expected(self.paths[4], 'md5'), output['md5'])
+
+    def test_generate_file_hashes_matches_generate_file_hash(self):
+        with open(self.paths[2], 'rb') as fo:
+            self.assertEqual(generate_file_hash(fo), generate_file_hashes(fo, algorithms=['md5'])['md5'])
+
+    def test_generate_file_hashes_empty_file(self):
+        path = os.path.join(self.tmp.name, 'empty.bin')
+        open(path, 'wb').close()
+        output = generate_file_hashes(path, algorithms=['md5'])
+        self.assertEqual(hashlib.md5().hexdigest(), output['md5'])
+
+    def test_hash_files(self):
+        output = hash_files(self.paths, algorithms=['sha256'], max_workers=3, chunk_size=512)
+        self.assertEqual(self.paths, list(output))
+        for path in self.paths:
+            self.assertEqual({'sha256': self.expected(path, 'sha256')}, output[path])
+
+
+class FileHashCacheTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmp.name, 'tree')
+        os.makedirs(os.path.join(self.root, 'sub'))
+        for name in ['a.txt', 'b.txt', os.path.join('sub', 'c.txt')]:
+            with open(os.path.join(self.root, name), 'w') as fo:
+                fo.write(name)
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_hash_file_hits_cache_when_unchanged(self):
+        path = os.path.join(self.root, 'a.txt')
+        with FileHashCache(os.path.join(self.tmp.name, 'cache.sqlite3'), algorithms=['md5']) as cache:
+            first = cache.hash_file(path)
+            self.assertEqual({'md5': hashlib.md5(b'a.txt').hexdigest()}, first)
+            self.assertEqual(first, cache.hash_file(path))
+            self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+            with open(path, 'w') as fo:
+                fo.write('changed contents')
+            self.assertEqual({'md5': hashlib.md5(b'changed contents').hexdigest()}, cache.hash_file(path))
+            self.assertEqual((1, 2), (cache.hits, cache.misses))
+
+    def test_cache_persists_between_instances(self):
+        cache_file = os.path.join(self.tmp.name, 'cache.sqlite3')
+        with FileHashCache(cache_file) as cache:
+            cache.hash_file(os.path.join(self.root, 'a.txt'))
+        with FileHashCache(cache_file) as cache:
+            cache.hash_file(os.path.join(self.root, 'a.txt'))
+            self.assertEqual((1, 0), (cache.hits, cache.misses))
+
+        # Asking for an algorithm that was never stored is a miss.
+        with FileHashCache(cache_file, algorithms=['sha1']) as cache:
+            cache.hash_file(os.path.join(self.root, 'a.txt'))
+            self.assertEqual((0, 1), (cache.hits, cache.misses))
+
+    def test_hash_tree(self):
+        with FileHashCache.for_tree(self.root, algorithms=['sha256']) as cache:
+            manifest = cache.hash_tree(self.root)
+            self.assertEqual(['a.txt', 'b.txt', os.path.join('sub', 'c.txt')], list(manifest))
+            self.assertEqual(hashlib.sha256(b'b.txt').hexdigest(), manifest['b.txt']['sha256'])
+            self.assertEqual((0, 3), (cache.hits, cache.misses))
+
+            self.assertEqual(manifest, cache.hash_tree(self.root))
+            self.assertEqual((3, 3), (cache.hits, cache.misses))
+
+    def test_hash_tree_only_skips_cache_files(self):
+        for name in ['cache.csv', 'cache-journal', 'cache-wal']:
+            with open(os.path.join(self.root, name), 'w') as fo:
+                fo.write(name)
+        with FileHashCache(os.path.join(self.root, 'cache'), algorithms=['md5']) as cache:
+            manifest = cache.hash_tree(self.root)
+        self.assertEqual(['a.txt', 'b.txt', 'cache.csv', os.path.join('sub', 'c.txt')], list(manifest))
+
+    def test_algorithm_names_normalised(self):
+        cache_file = os.path.join(self.tmp.name, 'cache.sqlite3')
+        path = os.path.join(self.root, 'a.txt')
+        with FileHashCache(cache_file, algorithms=[hashlib.md5, 'SHA256']) as cache:
+            self.assertEqual(('md5', 'sha256'), cache.algorithms)
+            cache.hash_file(path)
+            self.assertEqual({'md5', 'sha256'}, set(cache.hash_file(path)))
+            self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    """ Serves RangeRequestHandler.data at every path, supporting Range requests. """
+
+    data = b''
+    ranges = True
+    served = []
+    # Shifts the range sent back, or sends none of it with empty_ranges.
+    range_offset = 0
+    empty_ranges = False
+
+    def log_message(self, *args):
+        pass
+
+    def send_common_headers(self, length):
+        self.send_header('Content-Length', str(length))
+        self.send_header('ETag', '"abc"')
+        if self.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_common_headers(len(self.data))
+
+    def do_GET(self):
+        header = self.headers.get('Range')
+        if header and self.ranges:
+            start, end = (int(x) + self.range_offset for x in header.split('=')[1].split('-'))
+            body = b'' if self.empty_ranges else self.data[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(self.data)}')
+        else:
+            body = self.data
+            self.send_response(200)
+        # Recorded before the body is sent, the client may finish reading before this thread runs again.
+        self.served.append(len(body))
+        self.send_common_headers(len(body))
+        self.wfile.write(body)
+
+
+class DownloadFileRangedTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'download.bin')
+
+        RangeRequestHandler.data = os.urandom(100000)
+        RangeRequestHandler.ranges = True
+        RangeRequestHandler.served = []
+        RangeRequestHandler.range_offset = 0
+        RangeRequestHandler.empty_ranges = False
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/download.bin'
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def read(self):
+        with open(self.path, 'rb') as fo:
+            return fo.read()
+
+    def test_download_in_segments(self):
+        calls = []
+        expected_hash = hashlib.sha256(RangeRequestHandler.data).hexdigest()
+        download_file_ranged(self.url, self.path, segments=4, expected_hash=expected_hash,
+                             chunk_size=4096, progress=lambda done, total: calls.append((done, total)))
+
+        self.assertEqual(RangeRequestHandler.data, self.read())
+        self.assertEqual(4, len(RangeRequestHandler.served))
+        self.assertEqual((100000, 100000), calls[-1])
+        self.assertFalse(os.path.exists(f'{self.path}.download'))
+
+    def test_download_rejects_wrong_content_range(self):
+        RangeRequestHandler.range_offset = 10
+        with self.assertRaisesRegex(ValueError, 'Content-Range'):
+            download_file_ranged(self.url, self.path, segments=2)
+
+    def test_download_empty_ranges_are_failed_attempts(self):
+        RangeRequestHandler.empty_ranges = True
+        with self.assertRaisesRegex(ValueError, 'sent no data'):
+            download_file_ranged(self.url, self.path, segments=1, max_retries=2)
+        self.assertEqual([0, 0, 0], RangeRequestHandler.served)
+
+    def test_download_closes_own_session(self):
+        with mock.patch('requests.Session.close', autospec=True) as close:
+            download_file_ranged(self.url, self.path, segments=2)
+        close.assert_called_once()
+
+        session = requests.Session()
+        with mock.patch.object(session, 'close') as close:
+            download_file_ranged(self.url, self.path, segments=2, session=session)
+        close.assert_not_called()
+        session.close()
+
+    def test_download_resumes_from_state_file(self):
+        data = RangeRequestHandler.data
+        with open(self.path, 'wb') as fo:
+            fo.write(data[:30000] + bytes(70000))
+        with open(f'{self.path}.download', 'w') as fo:
+            json.dump({
+                'url': self.url, 'size': 100000, 'validator': '"abc"',
+                'segments': [[0, 49999, 30000], [50000, 99999, 50000]],
+            }, fo)
+
+        download_file_ranged(self.url, self.path, segments=2)
+        self.assertEqual(data, self.read())
+        self.assertEqual(70000, sum(RangeRequestHandler.served))
+
+    def test_download_ignores_state_for_other_file(self):
+        with open(self.path, 'wb') as fo:
+            fo.write(bytes(100000))
+        with open(f'{self.path}.download', 'w') as fo:
+            json.dump({'url': self.url, 'size': 100000, 'validator': '"old"', 'segments': [[0, 99999, 99000]]}, fo)
+
+        download_file_ranged(self.url, self.path, segments=2)
+        self.assertEqual(RangeRequestHandler.data, self.read())
+
+    def test_download_without_range_support(self):
+        RangeRequestHandler.ranges = False
+        download_file_ranged(self.url, self.path, segments=4,
+                             expected_hash=hashlib.md5(RangeRequestHandler.data).hexdigest(), hash_algorithm='md5')
+        self.assertEqual(RangeRequestHandler.data, self.read())
+        self.assertEqual([100000], RangeRequestHandler.served)
+
+    def test_download_hash_mismatch(self):
+        with self.assertRaisesRegex(ValueError, 'does not match'):
+            download_file_ranged(self.url, self.path, expected_hash='0' * 64)
+        self.assertFalse(os.path.exists(self.path))
+
+
+class BatchRequestHandler(http.server.BaseHTTPRequestHandler):
+    """ /ok/<name> returns name, /flaky fails once before working, /missing is a 404. """
+
+    protocol_version = 'HTTP/1.1'
+    lock = threading.Lock()
+    hits = collections.Counter()
+    active = 0
+    max_active = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.hits[self.path] += 1
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+            hits = cls.hits[self.path]
+        try:
+            time.sleep(0.02)
+            if self.path == '/missing' or (self.path == '/flaky' and hits == 1):
+                status, body = (404 if self.path == '/missing' else 500), b'error'
+            else:
+                status, body = 200, self.path.encode('utf8')
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with cls.lock:
+                cls.active -= 1
+
+
+class DownloadManyTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        BatchRequestHandler.hits = collections.Counter()
+        BatchRequestHandler.max_active = 0
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), BatchRequestHandler)
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def test_download_many(self):
+        urls_to_paths = {f'{self.base_url}/ok/{x}': os.path.join(self.tmp.name, f'{x}.txt') for x in range(20)}
+        results = download_many(urls_to_paths, max_workers=8, max_per_host=3)
+
+        self.assertEqual(set(urls_to_paths.values()), set(results))
+        for url, path in urls_to_paths.items():
+            result = results[path]
+            self.assertTrue(result.success)
+            self.assertEqual((url, 200, 1), (result.url, result.status_code, result.attempts))
+            with open(path, 'rb') as fo:
+                self.assertEqual(url.replace(self.base_url, '').encode('utf8'), fo.read())
+            self.assertEqual(len(url) - len(self.base_url), result.size)
+        self.assertLessEqual(BatchRequestHandler.max_active, 3)
+
+    def test_download_many_retries_server_errors(self):
+        path = os.path.join(self.tmp.name, 'flaky.txt')
+        result = download_many([(f'{self.base_url}/flaky', path)], backoff=0.01)[path]
+        self.assertTrue(result.success)
+        self.assertEqual(2, result.attempts)
+
+    def test_download_many_does_not_retry_client_errors(self):
+        path = os.path.join(self.tmp.name, 'missing.txt')
+        result = download_many([(f'{self.base_url}/missing', path)], backoff=0.01)[path]
+        self.assertFalse(result.success)
+        self.assertEqual((404, 1, 'HTTP 404'), (result.status_code, result.attempts, result.error))
+        self.assertFalse(os.path.exists(path))
+
+    def test_download_many_reports_connection_errors(self):
+        path = os.path.join(self.tmp.name, 'refused.txt')
+        result = download_many([('http://127.0.0.1:1/refused', path)], max_retries=1, backoff=0.01)[path]
+        self.assertFalse(result.success)
+        self.assertEqual(2, result.attempts)
+        self.assertIn('ConnectionError', result.error)
+
+    def test_download_file_with_session(self):
+        path = os.path.join(self.tmp.name, 'session.txt')
+        with requests.Session() as session:
+            download_file(f'{self.base_url}/ok/session', path, session=session)
+        with open(path, 'rb') as fo:
+            self.assertEqual(b'/ok/session', fo.read())
+
+
+class ExtractMembersTests(unittest.TestCase):
+
+    names = ['bin/driver', 'docs/readme.txt', 'docs/license.txt', 'data/a.csv', 'data/b.csv', 'data/nested/c.csv']
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.destination = os.path.join(self.tmp.name, 'out')
+
+        self.zip_path = os.path.join(self.tmp.name, 'archive.zip')
+        with zipfile.ZipFile(self.zip_path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+            for name in self.names:
+                info = zipfile.ZipInfo(name)
+                info.external_attr = (0o755 if name.startswith('bin/') else 0o644) << 16
+                info.compress_type = zipfile.ZIP_DEFLATED
+                zf.writestr(info, name * 100)
+
+        self.tar_path = os.path.join(self.tmp.name, 'archive.tar.gz')
+        with tarfile.open(self.tar_path, 'w:gz') as tf:
+            for name in self.names:
+                data = (name * 100).encode('utf8')
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mode = 0o755 if name.startswith('bin/') else 0o644
+                tf.addfile(info, io.BytesIO(data))
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def read(self, name):
+        with open(os.path.join(self.destination, name)) as fo:
+            return fo.read()
+
+    def check_csvs(self, extracted):
+        expected = [os.path.join(self.destination, *name.split('/')) for name in self.names if name.endswith('.csv')]
+        self.assertEqual(expected, [os.path.normpath(path) for path in extracted])
+        self.assertEqual('data/a.csv' * 100, self.read('data/a.csv'))
+        self.assertFalse(os.path.exists(os.path.join(self.destination, 'docs')))
+
+    def test_extract_members_zip_glob(self):
+        self.check_csvs(extract_members(self.zip_path, '*.csv', self.destination))
+
+    def test_extract_members_zip_threads(self):
+        self.check_csvs(extract_members(self.zip_path, ['data/*'], self.destination, threads=3))
+
+    def test_extract_members_tar_predicate(self):
+        self.check_csvs(extract_members(self.tar_path, lambda name: name.endswith('.csv'), self.destination))
+
+    @unittest.skipIf(os.name == 'nt', 'Unix permissions only')
+    def test_extract_members_keeps_permissions(self):
+        for archive in [self.zip_path, self.tar_path]:
+            extract_members(archive, None, self.destination)
+            self.assertTrue(os.access(os.path.join(self.destination, 'bin', 'driver'), os.X_OK))
+            self.assertFalse(os.access(os.path.join(self.destination, 'docs', 'readme.txt'), os.X_OK))
+            shutil.rmtree(self.destination)
+
+
+class FileLockTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'archive.zip')
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_lock_is_reentrant(self):
+        with FileLock(self.path, timeout=1) as lock:
+            with FileLock(self.path, timeout=0.01) as inner:
+                # Already held by this thread, nothing to try.
+                self.assertEqual(0, inner.attempts)
+            self.assertEqual(1, lock.attempts)
+
+    def test_lock_times_out_while_held_by_another_thread(self):
+        acquired, release = threading.Event(), threading.Event()
+
+        def hold():
+            with FileLock(self.path):
+                acquired.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        acquired.wait(5)
+        try:
+            lock = FileLock(self.path, timeout=0.05)
+            with self.assertRaises(TimeoutError):
+                lock.acquire()
+            self.assertGreater(lock.attempts, 2)
+            self.assertGreaterEqual(lock.wait_time, 0.05)
+        finally:
+            release.set()
+            thread.join()
+
+        with FileLock(self.path, timeout=1) as lock:
+            self.assertEqual(1, lock.attempts)
+
+    def test_lock_waits_for_release(self):
+        acquired = threading.Event()
+
+        def hold():
+            with FileLock(self.path):
+                acquired.set()
+                time.sleep(0.05)
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        acquired.wait(5)
+        with FileLock(self.path, timeout=5) as lock:
+            self.assertGreater(lock.wait_time, 0.01)
+        thread.join()
+
+    def test_lock_file_is_not_left_next_to_path(self):
+        lock_dir = os.path.join(self.tmp.name, 'locks')
+        with FileLock(self.path, timeout=1, lock_dir=lock_dir) as lock:
+            self.assertEqual(lock_dir, os.path.dirname(lock.lock_file))
+            self.assertTrue(os.path.isfile(lock.lock_file))
+        self.assertEqual(['locks'], os.listdir(self.tmp.name))
+
+    @unittest.skipIf(sys.platform == 'win32', 'Unix permissions')
+    def test_default_lock_dir_is_shared_between_users(self):
+        umask = os.umask(0o077)
+        try:
+            with mock.patch('tempfile.gettempdir', return_value=self.tmp.name):
+                with FileLock(self.path, timeout=1) as lock:
+                    self.assertEqual(0o1777, os.stat(lock.lock_dir).st_mode & 0o7777)
+                    self.assertEqual(0o666, os.stat(lock.lock_file).st_mode & 0o777)
+        finally:
+            os.umask(umask)
+
+    def test_lock_requires_fcntl_or_msvcrt(self):
+        with mock.patch('iarp_utils.files.fcntl', None), mock.patch('iarp_utils.files.msvcrt', None):
+            with self.assertRaises(NotImplementedError):
+                FileLock(self.path)
+
+
+class ExtractSingleFileTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.zip_path = os.path.join(self.tmp.name, 'archive.zip')
+        with zipfile.ZipFile(self.zip_path, 'w') as zf:
+            zf.writestr('driver', 'contents')
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_extract_zip_single_file(self):
+        stats = extract_zip_single_file(self.zip_path, 'driver', self.tmp.name)
+        self.assertEqual({'extracted': True, 'attempts': 1, 'retry_wait': 0.0}, {
+            k: v for k, v in stats.items() if k != 'lock_wait'
+        })
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp.name, 'driver')))
+        self.assertFalse(os.path.exists(self.zip_path))
+        self.assertEqual(['driver'], os.listdir(self.tmp.name))
+
+    def test_extract_retries_with_short_backoff(self):
+        original = ZipFileWithPermissions.extract
+        failures = [PermissionError, PermissionError]
+
+        def flaky_extract(*args, **kwargs):
+            if failures:
+                raise failures.pop()
+            return original(*args, **kwargs)
+
+        with mock.patch.object(ZipFileWithPermissions, 'extract', flaky_extract):
+            stats = extract_zip_single_file(self.zip_path, 'driver', self.tmp.name, delete_zip_on_finish=False)
+
+        self.assertTrue(stats['extracted'])
+        self.assertEqual(3, stats['attempts'])
+        self.assertAlmostEqual(0.03, stats['retry_wait'])
+
+    def test_extract_gives_up_at_deadline(self):
+        with mock.patch.object(ZipFileWithPermissions, 'extract', side_effect=PermissionError):
+            started = time.monotonic()
+            stats = extract_zip_single_file(self.zip_path, 'driver', self.tmp.name, delete_zip_on_finish=False,
+                                            max_attempts=100, timeout=0.2)
+        self.assertFalse(stats['extracted'])
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertLess(stats['attempts'], 100)
+
+
+class WaitForDownloadsTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.glob_path = os.path.join(self.tmp.name, '*.pdf')
+        self.path = os.path.join(self.tmp.name, 'report.pdf')
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def simulate_download(self, delay=0.1):
+        # Firefox style, an empty placeholder plus a .part file renamed over it when finished.
+        def download():
+            open(self.path, 'wb').close()
+            with open(self.path + '.part', 'wb') as fo:
+                fo.write(b'partial')
+            time.sleep(delay)
+            with open(self.path + '.part', 'ab') as fo:
+                fo.write(b' finished')
+            os.replace(self.path + '.part', self.path)
+
+        thread = threading.Thread(target=download)
+        thread.start()
+        self.addCleanup(thread.join)
+
+    def check_waits_for_download(self, use_inotify):
+        self.simulate_download()
+        started = time.monotonic()
+        output = wait_for_downloads(self.glob_path, timeout=5, stable_for=0.1, use_inotify=use_inotify)
+
+        self.assertEqual([self.path], output)
+        self.assertLess(time.monotonic() - started, 2)
+        with open(self.path, 'rb') as fo:
+            self.assertEqual(b'partial finished', fo.read())
+
+    def test_wait_for_downloads_polling(self):
+        self.check_waits_for_download(use_inotify=False)
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is Linux only')
+    def test_wait_for_downloads_inotify(self):
+        self.check_waits_for_download(use_inotify=True)
+
+    def test_wait_for_downloads_times_out(self):
+        with open(self.path + '.crdownload', 'wb') as fo:
+            fo.write(b'never finishes')
+        self.assertEqual([], wait_for_downloads(self.glob_path, timeout=0.2, stable_for=0.05))
+
+    def test_wait_for_downloaded_file_checks_before_sleeping(self):
+        with open(self.path, 'wb') as fo:
+            fo.write(b'done')
+        with mock.patch('iarp_utils.files.time.sleep') as sleep:
+            self.assertTrue(wait_for_downloaded_file(self.glob_path))
+        sleep.assert_not_called()
+
+
+class UniqueFileAllocatorTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = self.tmp.name
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def touch(self, *names):
+        for name in names:
+            open(os.path.join(self.folder, name), 'w').close()
+
+    def test_allocate_base_name_first(self):
+        allocator = UniqueFileAllocator(self.folder)
+        path = allocator.allocate('report', 'pdf')
+        self.assertEqual(os.path.join(self.folder, 'report.pdf'), path)
+        self.assertTrue(os.path.isfile(path))
+        self.assertEqual(os.path.join(self.folder, 'report_1.pdf'), allocator.allocate('report', 'pdf'))
+
+    def test_allocate_continues_past_highest_counter(self):
+        self.touch('report.pdf', 'report_1.pdf', 'report_7.pdf', 'report_x.pdf', 'report_99.txt', 'other_50.pdf')
+        allocator = UniqueFileAllocator(self.folder)
+
+        with mock.patch('iarp_utils.files.os.path.isfile') as isfile:
+            self.assertEqual(os.path.join(self.folder, 'report_8.pdf'), allocator.allocate('report', 'pdf'))
+            self.assertEqual(os.path.join(self.folder, 'report_9.pdf'), allocator.allocate('report', 'pdf'))
+        isfile.assert_not_called()
+
+    def test_format_without_value_is_rejected(self):
+        with self.assertRaises(ValueError):
+            UniqueFileAllocator(self.folder, filename_format='{filename}.{extension}')
+
+    def test_allocate_custom_format(self):
+        self.touch('report.pdf', 'report (3).pdf')
+        allocator = UniqueFileAllocator(self.folder, filename_format='{filename} ({value}).{extension}')
+        self.assertEqual(os.path.join(self.folder, 'report (4).pdf'), allocator.allocate('report', 'pdf'))
+
+    def test_allocate_skips_names_taken_after_scan(self):
+        self.touch('report.pdf')
+        allocator = UniqueFileAllocator(self.folder)
+        self.assertEqual(os.path.join(self.folder, 'report_1.pdf'), allocator.allocate('report', 'pdf'))
+
+        # Another process takes the next name after our scan.
+        self.touch('report_2.pdf')
+        self.assertEqual(os.path.join(self.folder, 'report_3.pdf'), allocator.allocate('report', 'pdf'))
+
+    def test_allocate_without_reserving(self):
+        path = UniqueFileAllocator(self.folder).allocate('report', 'pdf', reserve=False)
+        self.assertEqual(os.path.join(self.folder, 'report.pdf'), path)
+        self.assertFalse(os.path.exists(path))
+
+    def test_allocate_is_unique_across_threads(self):
+        self.touch('report.pdf')
+
+        def allocate(_):
+            return UniqueFileAllocator(self.folder).allocate('report', 'pdf')
+
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            paths = list(executor.map(allocate, range(40)))
+        self.assertEqual(40, len(set(paths)))
+
+    def test_unique_file_exists_reserve(self):
+        self.touch('report.pdf', 'report_4.pdf')
+        path = unique_file_exists(self.folder, 'report', 'pdf', reserve=True)
+        self.assertEqual(os.path.join(self.folder, 'report_5.pdf'), path)
+        self.assertTrue(os.path.isfile(path))
+
+        path = unique_file_exists(self.folder, 'report', 'pdf', reserve=True, use_counter=False)
+        self.assertTrue(os.path.isfile(path))
+        self.assertNotIn(path, [os.path.join(self.folder, 'report.pdf'), os.path.join(self.folder, 'report_4.pdf')])
+
+
+class MimeTypeRegistryTests(unittest.TestCase):
+
+    def test_registry_is_cached(self):
+        self.assertIs(get_mime_registry(), get_mime_registry())
+        self.assertIs(get_mime_types_as_str(';'), get_mime_types_as_str(';'))
+
+    def test_registry_cleans_entries(self):
+        registry = MimeTypeRegistry(['text/css', 'application/ccxml+xml,', 'text/x-java-source,java', 'TEXT/CSS',
+                                     'not a mime type', ''])
+        self.assertEqual(('text/css', 'application/ccxml+xml', 'text/x-java-source'), registry.mime_types)
+        self.assertEqual('text/css,application/ccxml+xml,text/x-java-source', registry.joined())
+
+    def test_mime_types_str_has_no_empty_entries(self):
+        self.assertNotIn('', get_mime_types_as_str().split(','))
+        self.assertEqual(len(MIME_TYPES_LIST), len(get_mime_types_as_str().split(',')))
+
+    def test_registry_membership(self):
+        registry = get_mime_registry()
+        self.assertIn('application/zip', registry)
+        self.assertNotIn('application/not-a-real-type', registry)
+        self.assertEqual(len(MIME_TYPES_LIST), len(registry))
+
+    def test_registry_by_type(self):
+        images = get_mime_registry().by_type('image')
+        self.assertIn('image/png', images)
+        self.assertTrue(all(mime_type.startswith('image/') for mime_type in images))
+        self.assertEqual((), get_mime_registry().by_type('nothing'))
+
+    def test_registry_by_extension(self):
+        registry = get_mime_registry()
+        self.assertIn('application/pdf', registry.by_extension('.pdf'))
+        self.assertEqual(registry.by_extension('.pdf'), registry.by_extension('PDF'))
+        self.assertEqual((), registry.by_extension('.not-an-extension'))
+
+
+class FindDuplicatesTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.big = os.urandom(20000)
+        self.files = {
+            'a/big.bin': self.big,
+            'b/big copy.bin': self.big,
+            'b/deep/big again.bin': self.big,
+            # Same size, same first and last bytes, different middle.
+            'a/big-lookalike.bin': self.big[:10000] + bytes(1) + self.big[10001:],
+            'a/small.txt': b'hello',
+            'b/small.txt': b'hello',
+            'b/other.txt': b'world',
+            'b/empty.txt': b'',
+            'c/empty.txt': b'',
+        }
+        for name, data in self.files.items():
+            os.makedirs(os.path.dirname(self.path(name)), exist_ok=True)
+            with open(self.path(name), 'wb') as fo:
+                fo.write(data)
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmp.name, *name.split('/'))
+
+    def groups(self, **kwargs):
+        return sorted(find_duplicates([self.path('a'), self.path('b'), self.path('c')], max_workers=4, **kwargs))
+
+    def test_find_duplicates(self):
+        groups = self.groups(partial_size=1024)
+        self.assertEqual(2, len(groups))
+
+        small, big = groups
+        self.assertEqual((self.path('a/small.txt'), self.path('b/small.txt')), small.paths)
+        self.assertEqual(hashlib.sha256(b'hello').hexdigest(), small.digest)
+        self.assertEqual(5, small.size)
+
+        self.assertEqual(
+            tuple(sorted([self.path('a/big.bin'), self.path('b/big copy.bin'), self.path('b/deep/big again.bin')])),
+            big.paths
+        )
+        self.assertEqual(hashlib.sha256(self.big).hexdigest(), big.digest)
+
+    def test_find_duplicates_partial_hash_covers_small_files(self):
+        groups = self.groups(partial_size=65536, algorithm='md5')
+        self.assertEqual(hashlib.md5(self.big).hexdigest(), groups[1].digest)
+        self.assertEqual(3, len(groups[1].paths))
+
+    def test_find_duplicates_min_size(self):
+        self.assertEqual(1, len(self.groups(min_size=10)))
+        self.assertEqual(3, len(self.groups(min_size=0)))
+
+    def test_find_duplicates_skips_hardlinks(self):
+        os.link(self.path('a/small.txt'), self.path('c/small-link.txt'))
+        small = self.groups()[0]
+        self.assertEqual(2, len(small.paths))
+
+    def test_find_duplicates_streams_groups(self):
+        groups = find_duplicates(self.tmp.name)
+        self.assertIsInstance(next(groups), tuple)
+        groups.close()
+
+    def test_deduplicate_files_dry_run(self):
+        report = deduplicate_files(self.groups(), action='delete')
+        self.assertEqual(3, len(report))
+        self.assertTrue(all(item.error is None for item in report))
+        self.assertEqual(len(self.big) * 2 + 5, sum(item.size for item in report))
+        for name in self.files:
+            self.assertTrue(os.path.exists(self.path(name)))
+
+    def test_deduplicate_files_delete(self):
+        report = deduplicate_files(self.groups(), action='delete', dry_run=False)
+        self.assertEqual(3, len(report))
+        self.assertTrue(os.path.exists(self.path('a/small.txt')))
+        self.assertFalse(os.path.exists(self.path('b/small.txt')))
+        self.assertTrue(os.path.exists(self.path('a/big.bin')))
+        self.assertFalse(os.path.exists(self.path('b/big copy.bin')))
+
+    def test_deduplicate_files_hardlink(self):
+        report = deduplicate_files(self.groups(), dry_run=False, keep=lambda paths: paths[-1])
+        self.assertTrue(all(item.error is None for item in report))
+        kept = os.stat(self.path('b/small.txt'))
+        self.assertEqual(kept.st_ino, os.stat(self.path('a/small.txt')).st_ino)
+        self.assertEqual(2, kept.st_nlink)
+        with open(self.path('b/big copy.bin'), 'rb') as fo:
+            self.assertEqual(self.big, fo.read())
+        self.assertEqual(sorted(os.listdir(self.path('a'))), ['big-lookalike.bin', 'big.bin', 'small.txt'])
+
+    def test_deduplicate_files_skips_changed_files(self):
+        groups = self.groups()
+        with open(self.path('b/small.txt'), 'ab') as fo:
+            fo.write(b'!')
+        report = deduplicate_files(groups, action='delete', dry_run=False)
+        errors = {item.path: item.error for item in report}
+        self.assertEqual('file changed since it was found', errors[self.path('b/small.txt')])
+        self.assertTrue(os.path.exists(self.path('b/small.txt')))
+
+    def test_deduplicate_files_invalid_action(self):
+        with self.assertRaises(ValueError):
+            deduplicate_files([], action='move')
+
+
+class MmapFilesTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data = os.urandom(100000)
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'wb') as fo:
+            fo.write(data)
+        return path
+
+    def test_generate_file_hashes_mmap(self):
+        path = self.write('data.bin', self.data)
+        output = generate_file_hashes_mmap(path, algorithms=['md5', hashlib.sha1], window_size=4099)
+        self.assertEqual(hashlib.md5(self.data).hexdigest(), output['md5'])
+        self.assertEqual(hashlib.sha1(self.data).hexdigest(), output['sha1'])
+        self.assertEqual(generate_file_hashes(path), generate_file_hashes_mmap(path))
+
+    def test_generate_file_hashes_mmap_empty_file(self):
+        path = self.write('empty.bin', b'')
+        self.assertEqual({'md5': hashlib.md5().hexdigest()}, generate_file_hashes_mmap(path, algorithms=['md5']))
+
+    def test_files_equal(self):
+        a = self.write('a.bin', self.data)
+        b = self.write('b.bin', self.data)
+        self.assertTrue(files_equal(a, b, window_size=4096))
+        self.assertTrue(files_equal(a, a))
+
+    def test_files_equal_different_size(self):
+        a = self.write('a.bin', self.data)
+        b = self.write('b.bin', self.data[:-1])
+        self.assertFalse(files_equal(a, b))
+
+    def test_files_equal_different_contents(self):
+        a = self.write('a.bin', self.data)
+        for position in (0, 4095, 4096, len(self.data) - 1):
+            changed = bytearray(self.data)
+            changed[position] ^= 0xFF
+            b = self.write('b.bin', changed)
+            self.assertFalse(files_equal(a, b, window_size=4096), position)
+
+    def test_files_equal_empty_files(self):
+        self.assertTrue(files_equal(self.write('a.bin', b''), self.write('b.bin', b'')))
+
+
+class CreateArchiveTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tmp.name, 'logs')
+        self.data = {
+            'app.log': b'line\n' * 20000,
+            'empty.log': b'',
+            os.path.join('old', 'random.bin'): os.urandom(50000),
+            os.path.join('old', 'run.sh'): b'#!/bin/sh\necho hi\n',
+        }
+        os.makedirs(os.path.join(self.source, 'old'))
+        for name, data in self.data.items():
+            with open(os.path.join(self.source, name), 'wb') as fo:
+                fo.write(data)
+        os.chmod(os.path.join(self.source, 'old', 'run.sh'), 0o750)
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def dest(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def assertExtracted(self, folder):
+        for name, data in self.data.items():
+            with open(os.path.join(folder, 'logs', name), 'rb') as fo:
+                self.assertEqual(data, fo.read(), name)
+        self.assertEqual(0o750, os.stat(os.path.join(folder, 'logs', 'old', 'run.sh')).st_mode & 0o777)
+
+    def test_create_archive_zip(self):
+        dest = self.dest('logs.zip')
+        self.assertEqual(dest, create_archive(self.source, dest))
+
+        with ZipFileWithPermissions(dest) as open_file:
+            self.assertIsNone(open_file.testzip())
+            self.assertEqual(
+                ['logs/', 'logs/old/', 'logs/app.log', 'logs/empty.log', 'logs/old/random.bin', 'logs/old/run.sh'],
+                open_file.namelist()
+            )
+            self.assertLess(open_file.getinfo('logs/app.log').compress_size, len(self.data['app.log']) / 10)
+            open_file.extractall(self.dest('extracted'))
+
+        self.assertExtracted(self.dest('extracted'))
+
+    def test_create_archive_tar_formats(self):
+        for archive_format, extension in [('tar', 'tar'), ('gztar', 'tar.gz'), ('bztar', 'tar.bz2'),
+                                          ('xztar', 'tar.xz')]:
+            with self.subTest(archive_format):
+                dest = self.dest(f'logs.{extension}')
+                create_archive([self.source], dest, format=archive_format)
+                extracted = self.dest(f'extracted-{archive_format}')
+                self.assertEqual(5, len(extract_members(dest, None, extracted)) - 1)
+                self.assertExtracted(extracted)
+
+    def test_create_archive_gztar_compresses_blocks_in_parallel(self):
+        dest = self.dest('logs.tar.gz')
+        with mock.patch('iarp_utils.files.zlib.compressobj', wraps=zlib.compressobj) as compressobj:
+            create_archive(self.source, dest, format='gztar', max_workers=3, block_size=4096)
+        # The tar stream is well over 100KB, so it is deflated as many separate blocks.
+        self.assertGreater(compressobj.call_count, 20)
+
+        with tarfile.open(dest, 'r|gz') as open_file:
+            open_file.extractall(self.dest('extracted'))
+        self.assertExtracted(self.dest('extracted'))
+
+    def test_create_archive_arcnames(self):
+        dest = self.dest('renamed.zip')
+        create_archive({os.path.join(self.source, 'app.log'): 'backup/today.log'}, dest)
+        with zipfile.ZipFile(dest) as open_file:
+            self.assertEqual(['backup/today.log'], open_file.namelist())
+            self.assertEqual(self.data['app.log'], open_file.read('backup/today.log'))
+
+    def test_create_archive_unknown_format(self):
+        with self.assertRaises(ValueError):
+            create_archive(self.source, self.dest('logs.rar'), format='rar')
+
+    def test_create_archive_removes_dest_on_failure(self):
+        dest = self.dest('missing.zip')
+        with self.assertRaises(FileNotFoundError):
+            create_archive([self.source, self.dest('does-not-exist')], dest)
+        self.assertFalse(os.path.exists(dest))
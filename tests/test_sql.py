@@ -1,6 +1,16 @@
+import concurrent.futures
+import datetime
+import decimal
+import mock
+import os
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
 import warnings
-from iarp_utils.SQLConnectors import BaseDatabaseConnector, SQLITE
+from iarp_utils import SQLConnectors
+from iarp_utils.SQLConnectors import BaseDatabaseConnector, SQLITE, MSSQL, MySQL, ConnectionPool
 from iarp_utils.exceptions import ImproperlyConfigured
 
 
@@ -57,3 +67,557 @@ class SQLITETests(unittest.TestCase):
         self.assertIsNone(self.cursor.fetchone())
 
         self.connection.truncate_table(table)
+
+    def test_insert_item_batches(self):
+        table = 'test_table'
+        self.cursor.execute(f"CREATE TABLE {table} (id INTEGER, name TEXT, extra TEXT)")
+
+        rows = ({'id': x, 'name': f'name {x}'} if x % 3 else {'id': x, 'name': f'name {x}', 'extra': 'yes'}
+                for x in range(25))
+
+        with mock.patch.object(self.connection, '_insert_many', wraps=self.connection._insert_many) as insert_many:
+            self.assertEqual(25, self.connection.insert_item(table, rows, batch_size=4))
+
+        # 16 rows without extra in batches of 4, 9 rows with extra in 4, 4 and 1.
+        self.assertEqual([4, 4, 4, 4, 4, 4, 1], [len(call.args[2]) for call in insert_many.call_args_list])
+
+        self.cursor.execute(f'SELECT COUNT(*), COUNT(extra) FROM {table}')
+        self.assertEqual((25, 9), self.cursor.fetchone())
+        self.cursor.execute(f'SELECT name FROM {table} WHERE id = 7')
+        self.assertEqual('name 7', self.cursor.fetchone()[0])
+
+    def test_insert_item_empty(self):
+        self.cursor.execute("CREATE TABLE test_table (blah TEXT)")
+        self.assertEqual(0, self.connection.insert_item('test_table', []))
+
+    def create_numbers_table(self, count):
+        self.cursor.execute("CREATE TABLE numbers (id INTEGER, name TEXT)")
+        self.connection.insert_item('numbers', ({'id': x, 'name': 'old'} for x in range(count)))
+
+    def trace_in_list_sizes(self):
+        sizes = []
+        self.connection.connection.set_trace_callback(
+            lambda statement: sizes.append(statement.split(' IN (')[1].count(',') + 1) if ' IN (' in statement else 0
+        )
+        return sizes
+
+    def test_delete_item_batches_record_ids(self):
+        self.create_numbers_table(3000)
+
+        sizes = self.trace_in_list_sizes()
+        deleted = self.connection.delete_item('numbers', 'id', list(range(0, 2500)) + [5, 6, 99999])
+        self.assertEqual(2500, deleted)
+        self.assertEqual([999, 999, 503], sizes)
+
+        self.cursor.execute('SELECT COUNT(*), MIN(id) FROM numbers')
+        self.assertEqual((500, 2500), self.cursor.fetchone())
+
+    def test_update_item_batches_record_ids(self):
+        self.create_numbers_table(3000)
+
+        sizes = self.trace_in_list_sizes()
+        updated = self.connection.update_item('numbers', 'id', list(range(1000, 3000)), {'name': 'new'})
+        self.assertEqual(2000, updated)
+        # One parameter of each statement goes to name.
+        self.assertEqual([998, 998, 4], sizes)
+
+        self.cursor.execute("SELECT COUNT(*) FROM numbers WHERE name = 'new'")
+        self.assertEqual(2000, self.cursor.fetchone()[0])
+
+    def test_update_item_too_many_values(self):
+        self.create_numbers_table(10)
+        self.connection.max_query_params = 2
+
+        with self.assertRaises(ValueError):
+            self.connection.update_item('numbers', 'id', [1], {'name': 'new', 'id': 1})
+
+        self.cursor.execute("SELECT COUNT(*) FROM numbers WHERE name = 'new'")
+        self.assertEqual(0, self.cursor.fetchone()[0])
+
+    def test_delete_item_atomic_rolls_back(self):
+        self.create_numbers_table(2000)
+        self.cursor.execute(
+            "CREATE TRIGGER stop_delete BEFORE DELETE ON numbers WHEN old.id = 1500 "
+            "BEGIN SELECT RAISE(ABORT, 'stop'); END"
+        )
+
+        with self.assertRaises(sqlite3.DatabaseError):
+            self.connection.delete_item('numbers', 'id', list(range(2000)), atomic=True)
+
+        self.assertFalse(self.connection.connection.in_transaction)
+        self.cursor.execute('SELECT COUNT(*) FROM numbers')
+        self.assertEqual(2000, self.cursor.fetchone()[0])
+
+    def test_transaction_commits_and_joins(self):
+        self.cursor.execute("CREATE TABLE test_table (blah TEXT)")
+        with self.connection.transaction():
+            self.connection.insert_item('test_table', {'blah': 'a'})
+            with self.connection.transaction():
+                self.connection.insert_item('test_table', {'blah': 'b'})
+            self.assertTrue(self.connection.connection.in_transaction)
+        self.assertFalse(self.connection.connection.in_transaction)
+
+        with self.assertRaises(ValueError):
+            with self.connection.transaction():
+                self.connection.insert_item('test_table', {'blah': 'c'})
+                raise ValueError()
+
+        self.cursor.execute('SELECT blah FROM test_table ORDER BY blah')
+        self.assertEqual([('a',), ('b',)], self.cursor.fetchall())
+
+    def test_iter_query(self):
+        self.create_numbers_table(2500)
+
+        query_cursors = []
+
+        def query_cursor():
+            cursor = mock.Mock(wraps=self.connection.connection.cursor())
+            query_cursors.append(cursor)
+            return cursor
+
+        with mock.patch.object(self.connection, '_query_cursor', query_cursor):
+            rows = self.connection.iter_query('SELECT id FROM numbers WHERE id >= ? ORDER BY id', [500],
+                                              batch_size=600)
+            self.assertEqual([(500,), (501,)], [next(rows), next(rows)])
+            self.assertEqual(2000, len(list(rows)) + 2)
+
+        cursor = query_cursors[0]
+        self.assertEqual([600] * 5, [call.args[0] for call in cursor.fetchmany.call_args_list])
+        cursor.close.assert_called_once_with()
+
+    def test_iter_query_as_dict(self):
+        self.create_numbers_table(3)
+        self.assertEqual(
+            [{'id': 0, 'name': 'old'}, {'id': 1, 'name': 'old'}, {'id': 2, 'name': 'old'}],
+            list(self.connection.iter_query('SELECT id, name FROM numbers ORDER BY id', as_dict=True))
+        )
+
+    def test_iter_query_leaves_cursor_alone(self):
+        self.create_numbers_table(10)
+        rows = self.connection.iter_query('SELECT id FROM numbers', batch_size=2)
+        next(rows)
+        self.connection.delete_item('numbers', 'id', 9)
+        self.assertEqual(1, self.connection.cursor.rowcount)
+        rows.close()
+
+    def test_sql_cache(self):
+        self.create_numbers_table(0)
+        self.connection.sql_cache_clear()
+
+        for x in range(5):
+            self.connection.insert_item('numbers', {'id': x, 'name': 'a'})
+            self.connection.update_item('numbers', 'id', x, {'name': 'b'})
+        self.connection.delete_item('numbers', 'id', [0, 1])
+        self.connection.delete_item('numbers', 'id', [2, 3])
+
+        self.assertEqual(SQLConnectors.SQLCacheInfo(hits=9, misses=3, maxsize=256, currsize=3),
+                         self.connection.sql_cache_info())
+        self.cursor.execute('SELECT id, name FROM numbers')
+        self.assertEqual([(4, 'b')], self.cursor.fetchall())
+
+    def test_sql_cache_is_bounded(self):
+        self.create_numbers_table(0)
+        self.connection.sql_cache_size = 2
+        self.connection.sql_cache_clear()
+
+        self.connection.insert_item('numbers', {'id': 1})
+        self.connection.insert_item('numbers', {'name': 'a'})
+        self.connection.insert_item('numbers', {'id': 1})
+        self.connection.insert_item('numbers', {'id': 2, 'name': 'b'})
+        self.assertEqual([('insert', 'numbers', ('id',)), ('insert', 'numbers', ('id', 'name'))],
+                         list(self.connection._sql_cache))
+
+        self.connection.insert_item('numbers', {'name': 'a'})
+        self.assertEqual((1, 4, 2, 2), tuple(self.connection.sql_cache_info()))
+
+    def test_sqlite_statement_cache_size(self):
+        with mock.patch('sqlite3.connect') as connect:
+            SQLITE().connect(database=':memory:')
+        connect.assert_called_once_with(':memory:', cached_statements=SQLITE.sql_cache_size)
+
+    def test_upsert_items(self):
+        self.cursor.execute("CREATE TABLE stock (store INTEGER, sku TEXT, quantity INTEGER, note TEXT, "
+                            "PRIMARY KEY (store, sku))")
+        self.connection.insert_item('stock', [
+            {'store': 1, 'sku': 'a', 'quantity': 5, 'note': 'kept'},
+            {'store': 2, 'sku': 'a', 'quantity': 7, 'note': 'kept'},
+        ])
+
+        rows = [{'store': store, 'sku': 'a', 'quantity': store * 100} for store in range(1, 6)]
+        rows.append({'sku': 'b', 'store': 1, 'quantity': 1, 'note': 'new'})
+        with mock.patch.object(self.connection, '_upsert_many', wraps=self.connection._upsert_many) as upsert_many:
+            self.assertEqual(6, self.connection.upsert_items('stock', ['store', 'sku'], iter(rows), batch_size=2))
+        self.assertEqual([2, 2, 1, 1], [len(call.args[3]) for call in upsert_many.call_args_list])
+
+        self.cursor.execute('SELECT store, sku, quantity, note FROM stock ORDER BY sku, store')
+        self.assertEqual([
+            (1, 'a', 100, 'kept'), (2, 'a', 200, 'kept'), (3, 'a', 300, None), (4, 'a', 400, None),
+            (5, 'a', 500, None), (1, 'b', 1, 'new'),
+        ], self.cursor.fetchall())
+
+    def test_upsert_items_only_key_columns(self):
+        self.create_numbers_table(0)
+        self.cursor.execute('CREATE UNIQUE INDEX numbers_id ON numbers (id)')
+        self.connection.insert_item('numbers', {'id': 1, 'name': 'a'})
+
+        self.assertEqual(2, self.connection.upsert_items('numbers', 'id', [{'id': 1}, {'id': 2}]))
+        self.cursor.execute('SELECT id, name FROM numbers ORDER BY id')
+        self.assertEqual([(1, 'a'), (2, None)], self.cursor.fetchall())
+
+    def test_upsert_items_requires_key_columns(self):
+        self.create_numbers_table(0)
+        with self.assertRaises(ValueError):
+            self.connection.upsert_items('numbers', 'id', {'name': 'a'})
+
+
+class SQLITEBulkLoadTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.connection = SQLITE()
+        self.connection.connect(database=os.path.join(self.tmp.name, 'db.sqlite3'))
+        self.cursor = self.connection.cursor
+        self.cursor.execute("CREATE TABLE numbers (id INTEGER PRIMARY KEY, name TEXT)")
+
+    def tearDown(self) -> None:
+        self.connection.close()
+        self.tmp.cleanup()
+
+    def pragmas(self):
+        return (self.cursor.execute('PRAGMA journal_mode').fetchone()[0],
+                self.cursor.execute('PRAGMA synchronous').fetchone()[0])
+
+    def test_bulk_load(self):
+        before = self.pragmas()
+        journal_modes = []
+
+        def rows():
+            for x in range(10000):
+                if x == 5000:
+                    journal_modes.append(self.connection.connection.execute('PRAGMA journal_mode').fetchone()[0])
+                yield x, f'name {x}'
+
+        self.assertEqual(10000, self.connection.bulk_load('numbers', rows(), ['id', 'name']))
+        self.assertEqual(['wal'], journal_modes)
+        self.assertEqual(before, self.pragmas())
+        self.assertFalse(self.connection.connection.in_transaction)
+        self.assertEqual((10000, 'name 9999'),
+                         self.cursor.execute('SELECT COUNT(*), MAX(name) FROM numbers').fetchone())
+
+    def test_bulk_load_warns_when_wal_is_kept(self):
+        self.connection.connection.execute('PRAGMA busy_timeout=10')
+        other = sqlite3.connect(os.path.join(self.tmp.name, 'db.sqlite3'))
+        self.addCleanup(other.close)
+
+        def rows():
+            # Reading while in WAL keeps the database open in WAL mode for this connection.
+            other.execute('SELECT COUNT(*) FROM numbers').fetchone()
+            yield 1, 'a'
+
+        with self.assertWarns(RuntimeWarning):
+            self.assertEqual(1, self.connection.bulk_load('numbers', rows(), ['id', 'name']))
+        self.assertEqual(('wal', 2), self.pragmas())
+
+    def test_bulk_load_dict_rows(self):
+        rows = ({'name': f'name {x}', 'id': x, 'ignored': True} for x in range(10))
+        self.assertEqual(10, self.connection.bulk_load('numbers', rows, ('id', 'name')))
+        self.assertEqual('name 3', self.cursor.execute('SELECT name FROM numbers WHERE id = 3').fetchone()[0])
+
+    def test_bulk_load_rolls_back(self):
+        rows = [(1, 'a'), (2, 'b'), (1, 'duplicate')]
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.connection.bulk_load('numbers', iter(rows), ['id', 'name'])
+        self.assertEqual(0, self.cursor.execute('SELECT COUNT(*) FROM numbers').fetchone()[0])
+        self.assertEqual(('delete', 2), self.pragmas())
+
+    def test_bulk_load_inside_transaction(self):
+        with self.connection.transaction():
+            self.connection.bulk_load('numbers', [(1, 'a')], ['id', 'name'])
+            self.assertTrue(self.connection.connection.in_transaction)
+        self.assertEqual(1, self.cursor.execute('SELECT COUNT(*) FROM numbers').fetchone()[0])
+
+    def test_base_bulk_load_batches(self):
+        with mock.patch.object(self.connection, '_insert_many', wraps=self.connection._insert_many) as insert_many:
+            loaded = BaseDatabaseConnector.bulk_load(self.connection, 'numbers', ((x, 'a') for x in range(25)),
+                                                     ['id', 'name'], batch_size=10)
+        self.assertEqual(25, loaded)
+        self.assertEqual([10, 10, 5], [len(call.args[2]) for call in insert_many.call_args_list])
+
+
+class DriverSpecificTests(unittest.TestCase):
+
+    def test_mysql_insert_item_uses_multi_row_values(self):
+        with mock.patch.object(SQLConnectors.mysql, 'connector', mock.Mock(), create=True):
+            connection = MySQL()
+        connection.cursor = mock.Mock(rowcount=3)
+
+        rows = [{'a': 1, 'b': 2}, {'a': 3, 'b': 4}, {'a': 5, 'b': 6}]
+        self.assertEqual(3, connection.insert_item('t', rows))
+        connection.cursor.execute.assert_called_once_with(
+            'INSERT INTO t (a,b) VALUES (%s,%s),(%s,%s),(%s,%s)', [1, 2, 3, 4, 5, 6]
+        )
+
+    def test_mysql_insert_item_respects_max_query_params(self):
+        with mock.patch.object(SQLConnectors.mysql, 'connector', mock.Mock(), create=True):
+            connection = MySQL()
+        connection.cursor = mock.Mock(rowcount=-1)
+        connection.max_query_params = 5
+
+        rows = [{'a': x, 'b': x} for x in range(5)]
+        self.assertEqual(5, connection.insert_item('t', rows))
+        self.assertEqual([
+            mock.call('INSERT INTO t (a,b) VALUES (%s,%s),(%s,%s)', [0, 0, 1, 1]),
+            mock.call('INSERT INTO t (a,b) VALUES (%s,%s),(%s,%s)', [2, 2, 3, 3]),
+            mock.call('INSERT INTO t (a,b) VALUES (%s,%s)', [4, 4]),
+        ], connection.cursor.execute.call_args_list)
+
+    def test_mssql_insert_item_uses_fast_executemany(self):
+        with mock.patch.object(SQLConnectors, 'pyodbc', mock.Mock()):
+            connection = MSSQL()
+        connection.cursor = mock.Mock(rowcount=-1, fast_executemany=False)
+        enabled = []
+        connection.cursor.executemany.side_effect = lambda *args: enabled.append(connection.cursor.fast_executemany)
+
+        self.assertEqual(2, connection.insert_item('t', [{'a': 1}, {'a': 2}]))
+        self.assertEqual([True], enabled)
+        self.assertFalse(connection.cursor.fast_executemany)
+        connection.cursor.executemany.assert_called_once_with('INSERT INTO t (a) VALUES (?)', [(1,), (2,)])
+
+    def test_mysql_iter_query_is_unbuffered(self):
+        with mock.patch.object(SQLConnectors.mysql, 'connector', mock.Mock(), create=True):
+            connection = MySQL()
+        connection.connection = mock.Mock(unread_result=True)
+        cursor = connection.connection.cursor.return_value
+        cursor.fetchmany.side_effect = [[(1,), (2,)], [(3,), (4,)], [(5,)], []]
+
+        rows = connection.iter_query('SELECT id FROM t', batch_size=2)
+        self.assertEqual((1,), next(rows))
+        rows.close()
+
+        connection.connection.cursor.assert_called_once_with(buffered=False)
+        # The unread rows are drained in batches rather than read all at once.
+        self.assertEqual([mock.call(2)] * 4, cursor.fetchmany.call_args_list)
+        connection.connection.get_rows.assert_not_called()
+        cursor.close.assert_called_once_with()
+
+    def test_mysql_prepared_statements(self):
+        with mock.patch.object(SQLConnectors.mysql, 'connector', mock.Mock(), create=True):
+            connection = MySQL()
+            connection.connect(prepared_statements=True)
+        connection.sql_cache_size = 2
+        cursor = connection.connection.cursor
+        cursor.return_value = mock.Mock(rowcount=1)
+
+        connection.delete_item('t', 'id', 1)
+        connection.delete_item('t', 'id', 2)
+        delete_cursor = cursor.return_value
+        cursor.assert_called_with(prepared=True)
+        self.assertEqual(
+            [mock.call('DELETE FROM t WHERE id IN (%s)', [1]), mock.call('DELETE FROM t WHERE id IN (%s)', [2])],
+            delete_cursor.execute.call_args_list
+        )
+
+        cursor.return_value = mock.Mock(rowcount=2)
+        connection.delete_item('t', 'id', [1, 2])
+        cursor.return_value = mock.Mock(rowcount=3)
+        connection.delete_item('t', 'id', [1, 2, 3])
+        self.assertEqual(4, cursor.call_count)
+        delete_cursor.close.assert_called_once_with()
+
+        connection.close()
+        cursor.return_value.close.assert_called_once_with()
+
+    def test_mysql_bulk_load_uses_load_data(self):
+        with mock.patch.object(SQLConnectors.mysql, 'connector', mock.Mock(), create=True):
+            connection = MySQL()
+        connection.cursor = mock.Mock(rowcount=3)
+
+        written = {}
+
+        def execute(query, params):
+            with open(params[0], encoding='utf-8') as fo:
+                written[query] = fo.read()
+
+        connection.cursor.execute.side_effect = execute
+        rows = iter([(1, 'plain', None), (2, 'has "quotes", commas\nand lines', True),
+                     (3, datetime.datetime(2021, 2, 3, 4, 5, 6), decimal.Decimal('1.50'))])
+
+        self.assertEqual(3, connection.bulk_load('t', rows, ['a', 'b', 'c']))
+        (query, contents), = written.items()
+        self.assertTrue(query.startswith('LOAD DATA LOCAL INFILE %s INTO TABLE t '))
+        self.assertTrue(query.endswith(' (a,b,c)'))
+        self.assertEqual(
+            '1,"plain",NULL\n2,"has ""quotes"", commas\nand lines",1\n3,"2021-02-03 04:05:06",1.50\n', contents
+        )
+        self.assertFalse(os.path.exists(connection.cursor.execute.call_args.args[1][0]))
+
+    def test_mysql_bulk_load_bytes(self):
+        with mock.patch.object(SQLConnectors.mysql, 'connector', mock.Mock(), create=True):
+            connection = MySQL()
+        connection.cursor = mock.Mock()
+
+        self.assertEqual('"caf\u00e9"', connection._load_data_field('café'.encode('utf-8')))
+
+        with mock.patch('os.remove', wraps=os.remove) as remove:
+            with self.assertRaises(ValueError):
+                connection.bulk_load('t', [(1, b'\xff\xfe')], ['a', 'b'])
+        (path,), _ = remove.call_args
+        self.assertFalse(os.path.exists(path))
+        connection.cursor.execute.assert_not_called()
+
+    def test_mysql_upsert_items(self):
+        with mock.patch.object(SQLConnectors.mysql, 'connector', mock.Mock(), create=True):
+            connection = MySQL()
+        connection.cursor = mock.Mock(rowcount=3)
+
+        self.assertEqual(2, connection.upsert_items('t', 'id', [{'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'}]))
+        connection.cursor.execute.assert_called_once_with(
+            'INSERT INTO t (id,name) VALUES (%s,%s),(%s,%s) ON DUPLICATE KEY UPDATE name=VALUES(name)', [1, 'a', 2, 'b']
+        )
+
+    def test_mysql_upsert_items_respects_max_query_params(self):
+        with mock.patch.object(SQLConnectors.mysql, 'connector', mock.Mock(), create=True):
+            connection = MySQL()
+        connection.cursor = mock.Mock(rowcount=3)
+        connection.max_query_params = 4
+
+        rows = [{'id': x, 'name': 'a'} for x in range(3)]
+        self.assertEqual(3, connection.upsert_items('t', 'id', rows))
+        self.assertEqual([
+            mock.call('INSERT INTO t (id,name) VALUES (%s,%s),(%s,%s) ON DUPLICATE KEY UPDATE name=VALUES(name)',
+                      [0, 'a', 1, 'a']),
+            mock.call('INSERT INTO t (id,name) VALUES (%s,%s) ON DUPLICATE KEY UPDATE name=VALUES(name)', [2, 'a']),
+        ], connection.cursor.execute.call_args_list)
+
+    def test_mssql_upsert_items_uses_merge(self):
+        with mock.patch.object(SQLConnectors, 'pyodbc', mock.Mock()):
+            connection = MSSQL()
+        connection.cursor = mock.Mock(rowcount=-1, fast_executemany=False)
+        enabled = []
+        connection.cursor.executemany.side_effect = lambda *args: enabled.append(connection.cursor.fast_executemany)
+
+        rows = [{'store': 1, 'sku': 'a', 'quantity': 5}, {'store': 1, 'sku': 'b', 'quantity': 6}]
+        self.assertEqual(2, connection.upsert_items('stock', ['store', 'sku'], rows))
+        self.assertEqual([True], enabled)
+        self.assertFalse(connection.cursor.fast_executemany)
+        connection.cursor.executemany.assert_called_once_with(
+            'MERGE INTO stock WITH (HOLDLOCK) AS target '
+            'USING (VALUES (?,?,?)) AS source (store,sku,quantity) '
+            'ON target.store = source.store AND target.sku = source.sku '
+            'WHEN MATCHED THEN UPDATE SET quantity = source.quantity '
+            'WHEN NOT MATCHED THEN INSERT (store,sku,quantity) VALUES (source.store,source.sku,source.quantity);',
+            [(1, 'a', 5), (1, 'b', 6)]
+        )
+
+
+class ConnectionPoolTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.pool = ConnectionPool(SQLITE, max_size=3, timeout=5, database=os.path.join(self.tmp.name, 'db.sqlite3'),
+                                   check_same_thread=False, isolation_level=None)
+        with self.pool.connection() as db:
+            db.cursor.execute("CREATE TABLE numbers (id INTEGER)")
+
+    def tearDown(self) -> None:
+        self.pool.close()
+        self.tmp.cleanup()
+
+    def test_connection_is_reused(self):
+        with self.pool.connection() as first:
+            pass
+        with self.pool.connection() as second:
+            self.assertIs(first, second)
+            self.assertTrue(second.ping())
+
+        stats = self.pool.stats()
+        self.assertEqual(1, stats['created'])
+        self.assertEqual(3, stats['checkouts'])
+        self.assertEqual(1, stats['idle'])
+        self.assertEqual(0, stats['in_use'])
+
+    def test_pool_is_bounded(self):
+        self.pool.timeout = 0.05
+        connectors = [self.pool.acquire() for _ in range(3)]
+        self.assertEqual(3, len(set(map(id, connectors))))
+
+        with self.assertRaises(TimeoutError):
+            self.pool.acquire()
+        self.assertEqual(1, self.pool.stats()['timeouts'])
+
+        self.pool.release(connectors[0])
+        self.assertIs(connectors[0], self.pool.acquire())
+
+    def test_waiting_for_a_connection(self):
+        connectors = [self.pool.acquire() for _ in range(3)]
+        threading.Timer(0.1, self.pool.release, args=(connectors[1],)).start()
+
+        self.assertIs(connectors[1], self.pool.acquire())
+        self.assertGreaterEqual(self.pool.stats()['max_wait_time'], 0.05)
+
+    def test_threads_share_the_pool(self):
+        in_use, peak = [], []
+        lock = threading.Lock()
+
+        def work(x):
+            with self.pool.connection() as db:
+                with lock:
+                    in_use.append(db)
+                    peak.append(len(in_use))
+                db.insert_item('numbers', {'id': x})
+                time.sleep(0.005)
+                with lock:
+                    in_use.remove(db)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(work, range(40)))
+
+        self.assertLessEqual(max(peak), 3)
+        self.assertLessEqual(self.pool.stats()['created'], 3)
+        with self.pool.connection() as db:
+            db.cursor.execute('SELECT COUNT(*) FROM numbers')
+            self.assertEqual(40, db.cursor.fetchone()[0])
+
+    def test_connection_recycled_after_max_age(self):
+        with self.pool.connection() as first:
+            pass
+        self.pool.max_age = 0
+        with self.pool.connection() as second:
+            self.assertIsNot(first, second)
+        self.assertEqual(1, self.pool.stats()['recycled'])
+
+    def test_broken_connection_replaced(self):
+        with self.pool.connection() as first:
+            pass
+        # Connection dropped while it sat in the pool.
+        first.connection.close()
+        with self.pool.connection() as second:
+            self.assertIsNot(first, second)
+            self.assertTrue(second.ping())
+        self.assertEqual(1, self.pool.stats()['failed_pings'])
+        self.assertEqual(1, self.pool.stats()['size'])
+
+    def test_connection_broken_while_checked_out_is_discarded(self):
+        with self.pool.connection() as first:
+            first.connection.close()
+        self.assertEqual(0, self.pool.stats()['size'])
+        with self.pool.connection() as second:
+            self.assertIsNot(first, second)
+
+    def test_open_transaction_rolled_back_on_release(self):
+        with self.pool.connection() as db:
+            db.cursor.execute('BEGIN')
+            db.insert_item('numbers', {'id': 1})
+        with self.pool.connection() as db:
+            self.assertFalse(db.connection.in_transaction)
+            db.cursor.execute('SELECT COUNT(*) FROM numbers')
+            self.assertEqual(0, db.cursor.fetchone()[0])
+
+    def test_closed_pool(self):
+        connector = self.pool.acquire()
+        self.pool.close()
+        with self.assertRaises(ValueError):
+            self.pool.acquire()
+        self.pool.release(connector)
+        self.assertFalse(connector.ping())
+        self.assertEqual(0, self.pool.stats()['size'])